@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
+import glob
 import os
+import shutil
+import subprocess
 import sys
 from configparser import ConfigParser
 
 from deploy.shared import (
+    DeployLock,
     check_call,
+    conda_env_lock,
+    enable_resource_sampling,
     get_conda_base,
     get_logger,
     install_mambaforge,
@@ -25,14 +31,27 @@ def get_config(config_file):
     return config
 
 
-def bootstrap(activate_install_env, source_path, local_conda_build):
+def bootstrap(activate_install_env, source_path, local_conda_build,
+              env_path):
 
     print('Creating the polaris conda environment\n')
+    argv = sys.argv[1:]
+    if local_conda_build is not None:
+        argv = argv + ['--local_conda_build', local_conda_build]
+
+    if os.path.realpath(sys.prefix) == os.path.realpath(env_path):
+        # we're already running in the bootstrap environment, so we can
+        # deploy from this process rather than a new interpreter
+        sys.path.insert(0, os.path.join(source_path, 'deploy'))
+        from bootstrap import main as bootstrap_main
+        bootstrap_main(argv)
+        return
+
+    # otherwise, the dependencies of the bootstrap script are only
+    # available once the bootstrap environment is activated
     bootstrap_command = f'{source_path}/deploy/bootstrap.py'
     command = f'{activate_install_env} && ' \
-              f'{bootstrap_command} {" ".join(sys.argv[1:])}'
-    if local_conda_build is not None:
-        command = f'{command} --local_conda_build {local_conda_build}'
+              f'{bootstrap_command} {" ".join(argv)}'
     check_call(command)
 
 
@@ -43,7 +62,7 @@ def setup_install_env(env_name, activate_base, use_local, logger, recreate,
         channels = '--use-local'
     else:
         channels = ''
-    packages = f'progressbar2 jinja2 {mache}'
+    packages = f'progressbar2 jinja2 conda-pack {mache}'
     if recreate or not os.path.exists(env_path):
         print('Setting up a conda environment for installing polaris\n')
         commands = f'{activate_base} && ' \
@@ -53,7 +72,96 @@ def setup_install_env(env_name, activate_base, use_local, logger, recreate,
         commands = f'{activate_base} && ' \
                    f'mamba install -y -n {env_name} {channels} {packages}'
 
+    with conda_env_lock(conda_base, env_name, f'updating {env_name}', logger):
+        check_call(commands, logger=logger)
+
+
+def build_mache_wheel(mache_fork, mache_branch, cache_dir,
+                      activate_install_env, logger):
+    """
+    Update a local bare mirror of a mache fork with the requested branch and
+    build a wheel for the branch's latest commit, unless one was already
+    built for that commit.  The wheel is copied to
+    ``deploy_tmp/wheelhouse/mache`` so it can be installed in each conda
+    environment.
+
+    Parameters
+    ----------
+    mache_fork : str
+        The fork of mache on GitHub (e.g. ``username/mache``)
+
+    mache_branch : str
+        The branch of the fork
+
+    cache_dir : str
+        The directory for mirrors and wheels
+
+    activate_install_env : str
+        Commands to activate the environment used to build the wheel
+
+    logger : logging.Logger
+        A logger for output from the deployment
+
+    Returns
+    -------
+    wheel : str
+        The path to the wheel in ``deploy_tmp/wheelhouse/mache``
+    """
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    mirror = os.path.join(cache_dir, 'mirrors',
+                          f'{mache_fork.replace("/", "_")}.git')
+    if not os.path.exists(mirror):
+        os.makedirs(os.path.dirname(mirror), exist_ok=True)
+        commands = f'git init --bare --quiet {mirror} && ' \
+                   f'git -C {mirror} remote add origin ' \
+                   f'git@github.com:{mache_fork}.git'
+        check_call(commands, logger=logger)
+
+    # only the requested branch is fetched, and only what's new since the
+    # last fetch is transferred
+    commands = f'git -C {mirror} fetch --quiet origin ' \
+               f'+refs/heads/{mache_branch}:refs/heads/{mache_branch}'
     check_call(commands, logger=logger)
+    commit = subprocess.check_output(
+        ['git', '-C', mirror, 'rev-parse',
+         f'refs/heads/{mache_branch}']).decode('utf-8').strip()
+
+    wheel_dir = os.path.join(cache_dir, 'wheels', commit)
+    # deployments building the same commit at the same time wait for the
+    # first one's wheel rather than racing to build and rename their own
+    with DeployLock(cache_dir, f'mache_wheel_{commit}',
+                    f'building a mache wheel for {commit[:12]}',
+                    logger=logger):
+        wheels = glob.glob(os.path.join(wheel_dir, '*.whl'))
+        if len(wheels) == 0:
+            print(f'Building a mache wheel for {mache_fork} {mache_branch} '
+                  f'({commit[:12]})\n')
+            tmp_wheel_dir = f'{wheel_dir}.tmp{os.getpid()}'
+            shutil.rmtree('deploy_tmp/build_mache', ignore_errors=True)
+            # a shallow checkout of just the one commit
+            commands = f'{activate_install_env} && ' \
+                       f'mkdir -p deploy_tmp/build_mache && ' \
+                       f'cd deploy_tmp/build_mache && ' \
+                       f'git clone --quiet --depth 1 ' \
+                       f'--branch {mache_branch} file://{mirror} mache && ' \
+                       f'cd mache && ' \
+                       f'python -m pip wheel --no-deps -w {tmp_wheel_dir} .'
+            check_call(commands, logger=logger)
+            # a directory without a wheel can't be replaced otherwise
+            shutil.rmtree(wheel_dir, ignore_errors=True)
+            os.replace(tmp_wheel_dir, wheel_dir)
+            wheels = glob.glob(os.path.join(wheel_dir, '*.whl'))
+        else:
+            print(f'Using the cached mache wheel for {mache_fork} '
+                  f'{mache_branch} ({commit[:12]})\n')
+            shutil.rmtree('deploy_tmp/build_mache', ignore_errors=True)
+
+    wheelhouse = 'deploy_tmp/wheelhouse/mache'
+    shutil.rmtree(wheelhouse, ignore_errors=True)
+    os.makedirs(wheelhouse)
+    wheel = os.path.join(wheelhouse, os.path.basename(wheels[0]))
+    shutil.copyfile(wheels[0], wheel)
+    return os.path.abspath(wheel)
 
 
 def main():
@@ -87,11 +195,18 @@ def main():
     except OSError:
         pass
 
+    enable_resource_sampling(
+        config, os.path.abspath('deploy_tmp/logs/resources.jsonl'), new=True)
+
     if args.verbose:
         logger = None
+    elif args.json_log:
+        logger = get_logger(
+            log_filename='deploy_tmp/logs/prebootstrap.jsonl',
+            name=__name__, json_lines=True, step='prebootstrap')
     else:
         logger = get_logger(log_filename='deploy_tmp/logs/prebootstrap.log',
-                            name=__name__)
+                            name=__name__, step='prebootstrap')
 
     # install mambaforge if needed
     install_mambaforge(conda_base, activate_base, logger)
@@ -107,17 +222,16 @@ def main():
                       args.recreate, conda_base, mache)
 
     if local_mache:
-        print('Clone and install local mache\n')
+        print('Fetch and install local mache\n')
+        wheel = build_mache_wheel(
+            args.mache_fork, args.mache_branch,
+            config.get('local_mache', 'cache_dir'), activate_install_env,
+            logger)
         commands = f'{activate_install_env} && ' \
-                   f'rm -rf deploy_tmp/build_mache && ' \
-                   f'mkdir -p deploy_tmp/build_mache && ' \
-                   f'cd deploy_tmp/build_mache && ' \
-                   f'git clone -b {args.mache_branch} ' \
-                   f'git@github.com:{args.mache_fork}.git mache && ' \
-                   f'cd mache && ' \
-                   f'python -m pip install .'
-
-        check_call(commands, logger=logger)
+                   f'python -m pip install {wheel}'
+        with DeployLock(conda_base, f'env_{env_name}',
+                        f'installing mache in {env_name}', logger=logger):
+            check_call(commands, logger=logger)
 
     env_type = config.get('deploy', 'env_type')
     if env_type not in ['dev', 'test_release', 'release']:
@@ -128,7 +242,10 @@ def main():
     else:
         local_conda_build = None
 
-    bootstrap(activate_install_env, source_path, local_conda_build)
+    # the bootstrap environment is only locked while it's being updated, so
+    # other deployments sharing the conda base don't wait for this one
+    bootstrap(activate_install_env, source_path, local_conda_build,
+              os.path.join(conda_base, 'envs', env_name))
 
 
 if __name__ == '__main__':
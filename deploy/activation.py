@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import json
+import os
+import re
+import statistics
+import subprocess
+import tempfile
+
+SECTION_PATTERN = re.compile(r'^\s*#\s*polaris-section:\s*(\S+)\s*$')
+PROFILE_TAG = '__polaris_profile__'
+REINSTALL_TAG = '__polaris_reinstall__'
+
+
+def split_sections(script):
+    """
+    Split a load script into the sections marked by
+    ``# polaris-section: <name>`` comments.  Lines before the first marker
+    (or all lines in scripts written before markers were added) are in a
+    section called ``script``.
+
+    Parameters
+    ----------
+    script : str
+        The contents of the load script
+
+    Returns
+    -------
+    sections : list of tuple
+        The name and lines of each section, in order
+    """
+    sections: list = [('script', list())]
+    for line in script.split('\n'):
+        match = SECTION_PATTERN.match(line)
+        if match is not None:
+            sections.append((match.group(1), list()))
+        else:
+            sections[-1][1].append(line)
+    # drop an empty leading section
+    if len(sections) > 1 and all(line.strip() == ''
+                                 for line in sections[0][1]):
+        sections = sections[1:]
+    return sections
+
+
+def instrument(script):
+    """
+    Add a timestamp at the start of each section of a load script and at the
+    end
+    """
+    lines = list()
+    for name, section_lines in split_sections(script):
+        lines.append(_timestamp(name))
+        lines.extend(section_lines)
+    lines.append(_timestamp('end'))
+    return '\n'.join(lines)
+
+
+def profile_script(filename, runs=3):
+    """
+    Time each section of a load script by sourcing an instrumented copy in
+    a clean shell.  The script is sourced with ``NO_POLARIS_REINSTALL=1`` so
+    the reinstall of polaris in dev scripts doesn't change the environment
+    being profiled.  Instead, the reinstall is timed separately as
+    ``pip_dry_run``, a ``pip install --dry-run`` of the same package after
+    the script has been sourced.
+
+    Parameters
+    ----------
+    filename : str
+        The load script
+
+    runs : int, optional
+        The number of times to source the script, the median of which is
+        reported
+
+    Returns
+    -------
+    timings : dict
+        The median time in seconds spent in each section (sections with the
+        same name are added together), plus the ``total`` and, for dev
+        scripts, ``pip_dry_run``
+    """
+    with open(filename) as f:
+        script = f.read()
+    directory = os.path.dirname(os.path.abspath(filename))
+    reinstall = ''
+    if _has_reinstall(script, directory):
+        reinstall = f'\n{_timestamp("start", REINSTALL_TAG)}\n' \
+                    f'python -m pip install --dry-run --no-deps -e . ' \
+                    f'&> /dev/null\n' \
+                    f'{_timestamp("end", REINSTALL_TAG)}'
+    env = dict(os.environ, NO_POLARIS_REINSTALL='1')
+    # the instrumented copy is kept out of the directory of load scripts so
+    # it isn't mistaken for one
+    with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as f:
+        f.write(instrument(script))
+        tmp_filename = f.name
+
+    all_timings: dict = dict()
+    try:
+        for _ in range(runs):
+            # sourcing from the script's directory mimics how dev scripts
+            # are usually sourced
+            process = subprocess.run(
+                ['bash', '--noprofile', '--norc', '-c',
+                 f'source {tmp_filename}{reinstall}'],
+                cwd=directory, env=env, stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE)
+            output = process.stderr.decode('utf-8', errors='replace')
+            timings = _parse_timestamps(output)
+            reinstall_timings = _parse_timestamps(output, REINSTALL_TAG)
+            if 'total' in reinstall_timings:
+                timings['pip_dry_run'] = reinstall_timings['total']
+            for name, seconds in timings.items():
+                all_timings.setdefault(name, list()).append(seconds)
+    finally:
+        os.remove(tmp_filename)
+
+    return {name: statistics.median(values)
+            for name, values in all_timings.items()}
+
+
+def find_scripts(directories):
+    """
+    Find the load scripts in the given directories, skipping symlinks like
+    ``load_latest_polaris.sh`` that point to scripts already included
+    """
+    scripts = list()
+    for directory in directories:
+        directory = os.path.abspath(directory)
+        for pattern in ['load_*polaris*.sh', 'test_polaris*.sh']:
+            for filename in sorted(glob.glob(os.path.join(directory,
+                                                          pattern))):
+                if not os.path.islink(filename) and filename not in scripts:
+                    scripts.append(filename)
+    return scripts
+
+
+def print_table(results, baseline=None):
+    """
+    Print the time in each section of each load script, with the change
+    from a baseline if one is given
+    """
+    names: list = list()
+    for timings in results.values():
+        for name in timings:
+            if name != 'total' and name not in names:
+                names.append(name)
+    names.append('total')
+
+    width = max([len('script')] +
+                [len(os.path.basename(filename)) for filename in results])
+    header = f'{"script":<{width}}'
+    for name in names:
+        header = f'{header}  {name:>14}'
+    print(f'{header}\n(times in ms; change from baseline in parentheses)'
+          if baseline is not None else f'{header}\n(times in ms)')
+
+    for filename, timings in results.items():
+        row = f'{os.path.basename(filename):<{width}}'
+        previous = None
+        if baseline is not None:
+            previous = baseline.get(filename)
+        for name in names:
+            if name not in timings:
+                row = f'{row}  {"-":>14}'
+                continue
+            value = f'{1e3 * timings[name]:.0f}'
+            if previous is not None and name in previous:
+                change = 1e3 * (timings[name] - previous[name])
+                value = f'{value} ({change:+.0f})'
+            row = f'{row}  {value:>14}'
+        print(row)
+
+
+def _has_reinstall(script, directory):
+    # the same conditions under which dev load scripts reinstall polaris
+    return 'NO_POLARIS_REINSTALL' in script and \
+        os.path.exists(os.path.join(directory, 'setup.py')) and \
+        os.path.isdir(os.path.join(directory, 'polaris'))
+
+
+def _timestamp(name, tag=PROFILE_TAG):
+    # EPOCHREALTIME (bash 5) avoids starting a process for each timestamp
+    return f'echo "{tag} {name} ${{EPOCHREALTIME:-$(date +%s.%N)}}" >&2'
+
+
+def _parse_timestamps(output, tag=PROFILE_TAG):
+    stamps = list()
+    for line in output.split('\n'):
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == tag:
+            # some locales use a comma in EPOCHREALTIME
+            stamps.append((parts[1], float(parts[2].replace(',', '.'))))
+
+    timings: dict = dict()
+    for (name, start), (_, end) in zip(stamps[:-1], stamps[1:]):
+        timings[name] = timings.get(name, 0.) + end - start
+    if len(stamps) > 1:
+        timings['total'] = stamps[-1][1] - stamps[0][1]
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time each section of polaris load scripts to find out '
+                    'where activation time goes')
+    parser.add_argument('scripts', nargs='*',
+                        help='The load scripts to profile')
+    parser.add_argument('-d', '--dir', dest='directories', nargs='*',
+                        default=list(),
+                        help='Directories with load scripts to profile')
+    parser.add_argument('-n', '--runs', dest='runs', type=int, default=3,
+                        help='The number of times to source each script')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='A JSON file to save the timings to')
+    parser.add_argument('--baseline', dest='baseline',
+                        help='A JSON file of earlier timings to compare with')
+    args = parser.parse_args()
+
+    scripts = [os.path.abspath(filename) for filename in args.scripts]
+    scripts.extend(find_scripts(args.directories))
+    if len(scripts) == 0:
+        raise ValueError('No load scripts given or found')
+
+    results = dict()
+    for filename in scripts:
+        print(f'Profiling {filename}')
+        results[filename] = profile_script(filename, args.runs)
+    print('')
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
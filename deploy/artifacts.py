@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import platform
+import shutil
+import time
+
+from shared import check_call, log_message
+
+
+def get_artifact_key(specs, channels):
+    """
+    Get a hash identifying a conda environment from the specs and channels it
+    is solved with and the platform it is built for.  Environments with the
+    same key are interchangeable across machines and conda bases.
+
+    The key doesn't depend on the packages the specs resolve to, so an
+    archive freezes any unpinned specs at the versions available when it was
+    packed.  ``is_artifact_current()`` limits how long an archive is reused.
+
+    Parameters
+    ----------
+    specs : list of str
+        The conda match specs for the environment
+
+    channels : str
+        The channel arguments for ``mamba create``
+
+    Returns
+    -------
+    key : str
+        The hash of the environment's inputs
+    """
+    inputs = dict(specs=sorted(specs), channels=channels,
+                  system=platform.system(), arch=platform.machine())
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+def get_artifact_filename(artifact_dir, env_name, key):
+    """
+    Get the packed archive for a conda environment with the given key
+    """
+    return os.path.join(artifact_dir, f'{env_name}_{key[:16]}.tar.gz')
+
+
+def is_artifact_current(filename, max_age_days):
+    """
+    Whether an archive from ``pack_env()`` exists and was packed recently
+    enough to reuse
+
+    Parameters
+    ----------
+    filename : str
+        The archive
+
+    max_age_days : float
+        The age in days after which the archive is solved and packed again,
+        so unpinned specs pick up newer packages, or 0 to reuse archives
+        regardless of age
+
+    Returns
+    -------
+    current : bool
+        Whether the archive can be reused
+    """
+    if not os.path.exists(filename) or \
+            not os.path.exists(f'{filename}.sha256'):
+        return False
+    if max_age_days <= 0.:
+        return True
+    # the hash is written when the archive is packed
+    age = time.time() - os.path.getmtime(f'{filename}.sha256')
+    return age < max_age_days * 24 * 3600
+
+
+def pack_env(env_path, filename, logger, ignore_editable=False):
+    """
+    Pack a conda environment into a compressed, relocatable archive with
+    ``conda-pack`` and write its SHA-256 hash to ``<filename>.sha256``
+
+    Parameters
+    ----------
+    env_path : str
+        The path to the conda environment
+
+    filename : str
+        The archive to write
+
+    logger : logging.Logger
+        A logger for output from the deployment
+
+    ignore_editable : bool, optional
+        Whether to pack environments with packages installed in edit mode,
+        which still point to their source after unpacking
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # the archive is only put in place once it is complete, so others never
+    # unpack a partial one
+    tmp_filename = f'{filename}.tmp{os.getpid()}.tar.gz'
+    commands = f'conda-pack -p {env_path} -o {tmp_filename} --force ' \
+               f'--ignore-missing-files'
+    if ignore_editable:
+        commands = f'{commands} --ignore-editable-packages'
+    check_call(commands, logger=logger)
+    sha256 = _get_sha256(tmp_filename)
+    with open(f'{filename}.sha256.tmp{os.getpid()}', 'w') as f:
+        f.write(f'{sha256}  {os.path.basename(filename)}\n')
+    os.replace(tmp_filename, filename)
+    os.replace(f'{filename}.sha256.tmp{os.getpid()}', f'{filename}.sha256')
+    log_message(logger, f'Packed {env_path} into {filename}')
+
+
+def unpack_env(filename, env_path, logger):
+    """
+    Unpack a conda environment from an archive made by ``pack_env()`` and
+    relocate it to its new prefix with ``conda-unpack``
+
+    Parameters
+    ----------
+    filename : str
+        The archive to unpack
+
+    env_path : str
+        The path to the conda environment, which is replaced if it exists
+
+    logger : logging.Logger
+        A logger for output from the deployment
+
+    Returns
+    -------
+    unpacked : bool
+        Whether the environment was unpacked.  The environment is not
+        unpacked if the archive's hash doesn't match the one recorded when
+        it was packed.
+    """
+    with open(f'{filename}.sha256') as f:
+        expected = f.read().split()[0]
+    sha256 = _get_sha256(filename)
+    if sha256 != expected:
+        log_message(logger, f'Warning: the hash of {filename} does not match '
+                            f'the one recorded when it was packed, so it '
+                            f'will not be used')
+        return False
+
+    tmp_path = f'{env_path}.unpacking'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    shutil.unpack_archive(filename, tmp_path, format='gztar')
+    if os.path.exists(env_path):
+        shutil.rmtree(env_path)
+    os.rename(tmp_path, env_path)
+
+    # conda-unpack rewrites the prefixes in the environment to where it
+    # now lives
+    commands = f'source {env_path}/bin/activate && ' \
+               f'conda-unpack && ' \
+               f'source {env_path}/bin/deactivate'
+    check_call(commands, logger=logger)
+    log_message(logger, f'Unpacked {filename} into {env_path}')
+    return True
+
+
+def _get_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+import json
+import os
+import subprocess
+import sys
+import time
+from configparser import ConfigParser
+
+from resources import get_concurrent_installs, get_node_resources
+from shared import enable_resource_sampling, get_logger, log_message
+
+
+class LocalScheduler:
+    """
+    A stand-in for a batch scheduler that runs each job as a background
+    process on the current node (mostly for testing).  Jobs are queued so
+    that no more than ``concurrent_installs`` run at once.
+    """
+
+    def __init__(self, config):
+        self.concurrent_installs = get_concurrent_installs(
+            config, get_node_resources())
+        self.jobs = dict()
+
+    def submit(self, script_filename, job_name, log_filename):
+        job_id = str(len(self.jobs))
+        self.jobs[job_id] = dict(script_filename=script_filename,
+                                 log_filename=log_filename, process=None,
+                                 cancelled=False)
+        self._start_queued()
+        return job_id
+
+    def is_running(self, job_id):
+        self._start_queued()
+        job = self.jobs[job_id]
+        if job['cancelled']:
+            return False
+        process = job['process']
+        return process is None or process.poll() is None
+
+    def cancel(self, job_id):
+        job = self.jobs[job_id]
+        job['cancelled'] = True
+        if job['process'] is not None and job['process'].poll() is None:
+            job['process'].terminate()
+            job['process'].wait()
+
+    def _start_queued(self):
+        running = [job for job in self.jobs.values() if
+                   job['process'] is not None and
+                   job['process'].poll() is None]
+        slots = self.concurrent_installs - len(running)
+        for job in self.jobs.values():
+            if slots <= 0:
+                break
+            if job['process'] is not None or job['cancelled']:
+                continue
+            with open(job['log_filename'], 'w') as log_file:
+                job['process'] = subprocess.Popen(
+                    ['/bin/bash', job['script_filename']], stdout=log_file,
+                    stderr=subprocess.STDOUT)
+            slots -= 1
+
+
+class SlurmScheduler:
+    """
+    Submits jobs with ``sbatch``, polls them with ``squeue`` and cancels
+    them with ``scancel``
+    """
+
+    # squeue fails now and then when the controller is busy, so it is tried
+    # this many times, waiting twice as long after each failure
+    squeue_attempts = 5
+    squeue_delay = 2.
+
+    def __init__(self, config):
+        # each job gets its own node
+        self.concurrent_installs = 1
+        section = config['spack_batch']
+        self.options = dict()
+        for option in ['account', 'partition', 'qos', 'constraint',
+                       'walltime', 'nodes']:
+            value = section.get(option, '').strip()
+            if value == '' and option in ['account', 'partition', 'qos']:
+                # fall back on the options used for polaris jobs
+                value = _get_parallel_option(config, option)
+            self.options[option] = value
+
+    def submit(self, script_filename, job_name, log_filename):
+        flags = {'account': '--account', 'partition': '--partition',
+                 'qos': '--qos', 'constraint': '--constraint',
+                 'walltime': '--time', 'nodes': '--nodes'}
+        args = ['sbatch', '--parsable', f'--job-name={job_name}',
+                f'--output={log_filename}']
+        for option, flag in flags.items():
+            value = self.options[option]
+            if value != '':
+                args.append(f'{flag}={value}')
+        args.append(script_filename)
+        output = subprocess.check_output(args).decode('utf-8')
+        # the output is "job_id" or "job_id;cluster"
+        return output.strip().split(';')[0]
+
+    def is_running(self, job_id):
+        delay = self.squeue_delay
+        for attempt in range(self.squeue_attempts):
+            process = subprocess.run(
+                ['squeue', '--noheader', '--jobs', job_id, '--format', '%T'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if process.returncode == 0:
+                return process.stdout.decode('utf-8').strip() != ''
+            stderr = process.stderr.decode('utf-8', errors='replace')
+            if 'Invalid job id' in stderr:
+                # the job finished long enough ago that slurm forgot it
+                return False
+            if attempt < self.squeue_attempts - 1:
+                time.sleep(delay)
+                delay *= 2.
+        raise subprocess.CalledProcessError(process.returncode, process.args,
+                                            process.stdout, process.stderr)
+
+    def cancel(self, job_id):
+        subprocess.run(['scancel', job_id], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+
+def get_scheduler(config):
+    """
+    Get a scheduler for spack batch jobs based on the ``system`` option in
+    the ``[spack_batch]`` config section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    Returns
+    -------
+    scheduler : LocalScheduler or SlurmScheduler
+        The scheduler
+    """
+    system = config.get('spack_batch', 'system')
+    schedulers = dict(local=LocalScheduler, slurm=SlurmScheduler)
+    if system not in schedulers:
+        raise ValueError(f'Unexpected batch system for spack builds: '
+                         f'{system}')
+    return schedulers[system](config)
+
+
+def submit_spack_jobs(scheduler, config, entries, source_path, logger):
+    """
+    Submit a batch job to build the spack environment for each entry in the
+    compiler and MPI matrix
+
+    Parameters
+    ----------
+    scheduler : LocalScheduler or SlurmScheduler
+        The scheduler to submit jobs to
+
+    config : configparser.ConfigParser
+        Deployment config options
+
+    entries : list of dict
+        The keyword arguments to ``build_spack_env()`` for each entry,
+        without ``config``, ``env_vars`` or ``logger``
+
+    source_path : str
+        The path to the polaris source
+
+    logger : logging.Logger
+        A logger for output from the deployment
+
+    Returns
+    -------
+    jobs : dict
+        Info about each job, with the spack environment name as keys
+    """
+    job_dir = os.path.abspath(os.path.join(source_path, 'deploy_tmp',
+                                           'spack_jobs'))
+    os.makedirs(job_dir, exist_ok=True)
+
+    config_filename = os.path.join(job_dir, 'deploy.cfg')
+    with open(config_filename, 'w') as f:
+        config.write(f)
+
+    jobs: dict = dict()
+    for entry in entries:
+        spack_env = entry['spack_env']
+        prefix = os.path.join(job_dir, spack_env)
+        job_filename = f'{prefix}.json'
+        result_filename = f'{prefix}.result.json'
+        log_filename = f'{prefix}.log'
+        try:
+            os.remove(result_filename)
+        except OSError:
+            pass
+
+        job = dict(entry, config_filename=config_filename,
+                   result_filename=result_filename,
+                   log_filename=log_filename)
+        with open(job_filename, 'w') as f:
+            json.dump(job, f, indent=2)
+
+        script_filename = f'{prefix}.sh'
+        this_script = os.path.abspath(__file__)
+        with open(script_filename, 'w') as f:
+            f.write(f'#!/bin/bash\n'
+                    f'cd {source_path}\n'
+                    f'{sys.executable} {this_script} {job_filename}\n')
+
+        try:
+            job_id = scheduler.submit(script_filename, job_name=spack_env,
+                                      log_filename=f'{prefix}.out')
+        except BaseException:
+            # the caller can't cancel jobs it hasn't been told about
+            cancel_spack_jobs(scheduler, jobs, logger)
+            raise
+        log_message(logger, f'Submitted job {job_id} to build {spack_env}')
+        jobs[spack_env] = dict(job, job_id=job_id,
+                               out_filename=f'{prefix}.out')
+
+    return jobs
+
+
+def cancel_spack_jobs(scheduler, jobs, logger):
+    """
+    Cancel spack batch jobs that are still queued or running, e.g. because
+    the deployment failed or was interrupted before waiting for them
+
+    Parameters
+    ----------
+    scheduler : LocalScheduler or SlurmScheduler
+        The scheduler the jobs were submitted to
+
+    jobs : dict
+        Info about each job from ``submit_spack_jobs()``
+
+    logger : logging.Logger
+        A logger for output from the deployment
+    """
+    # the most recently submitted first, so a queued job doesn't start when
+    # a running one is cancelled
+    for spack_env, job in reversed(list(jobs.items())):
+        try:
+            if not scheduler.is_running(job['job_id']):
+                continue
+        except subprocess.CalledProcessError:
+            # we can't tell, so cancel it to be safe
+            pass
+        log_message(logger, f'Cancelling job {job["job_id"]} building '
+                            f'{spack_env}')
+        scheduler.cancel(job['job_id'])
+
+
+def wait_for_spack_job(scheduler, job, logger, poll_interval=30):
+    """
+    Wait for a spack batch job to finish, then copy its log into the
+    deployment log and return its result
+
+    Parameters
+    ----------
+    scheduler : LocalScheduler or SlurmScheduler
+        The scheduler the job was submitted to
+
+    job : dict
+        Info about the job from ``submit_spack_jobs()``
+
+    logger : logging.Logger
+        A logger for output from the deployment
+
+    poll_interval : float, optional
+        The time in seconds between checks on the job
+
+    Returns
+    -------
+    result : dict
+        The result of the job, including its ``status`` (``success`` or
+        ``failed``), ``start`` time and ``duration`` in seconds
+    """
+    spack_env = job['spack_env']
+    print(f'Waiting for job {job["job_id"]} to build {spack_env}')
+    while scheduler.is_running(job['job_id']):
+        time.sleep(poll_interval)
+
+    for filename in [job['log_filename'], job['out_filename']]:
+        if not os.path.exists(filename):
+            continue
+        with open(filename) as f:
+            lines = f.read().split('\n')
+        if logger is None:
+            print('\n'.join(lines))
+        else:
+            logger.info(f'\nOutput from {filename}:')
+            for line in lines:
+                logger.info(line)
+
+    if os.path.exists(job['result_filename']):
+        with open(job['result_filename']) as f:
+            result = json.load(f)
+    else:
+        # the job died before it could write its result
+        result = dict(status='failed', start=None, duration=None)
+
+    print(f'  {spack_env}: {result["status"]}')
+    return result
+
+
+def run_spack_job(job_filename):
+    """
+    Build a spack environment on a compute node as part of a batch job
+
+    Parameters
+    ----------
+    job_filename : str
+        A JSON file with the arguments to ``build_spack_env()``
+    """
+    # imported here because the bootstrap script imports this module
+    from bootstrap import build_spack_env
+
+    with open(job_filename) as f:
+        job = json.load(f)
+
+    config = ConfigParser()
+    config.read(job['config_filename'])
+    # the job starts in the polaris source directory
+    enable_resource_sampling(
+        config, os.path.abspath('deploy_tmp/logs/resources.jsonl'))
+
+    logger = get_logger(log_filename=job['log_filename'],
+                        name='spack_job', machine=job['machine'],
+                        compiler=job['compiler'], mpi=job['mpi'],
+                        step='spack_env')
+
+    start = time.time()
+    status = 'failed'
+    try:
+        build_spack_env(config, True, job['machine'], job['compiler'],
+                        job['mpi'], job['spack_env'], job['spack_base'],
+                        job['spack_template_path'], '', job['tmpdir'],
+                        logger, job['concurrent_installs'])
+        status = 'success'
+    finally:
+        result = dict(status=status, start=start,
+                      duration=time.time() - start,
+                      host=os.uname().nodename)
+        with open(job['result_filename'], 'w') as f:
+            json.dump(result, f)
+
+
+def _get_parallel_option(config, option):
+    # mache and polaris machine config files use plural names for lists of
+    # partitions and qos values
+    for name in [option, f'{option}s']:
+        if config.has_option('parallel', name):
+            values = config.get('parallel', name).replace(',', ' ').split()
+            if len(values) > 0:
+                return values[0]
+    return ''
+
+
+if __name__ == '__main__':
+    run_spack_job(sys.argv[1])
@@ -1,29 +1,89 @@
 #!/usr/bin/env python3
 
 import glob
-import grp
-import importlib.resources
+import importlib.util
+import json
+import math
 import os
 import platform
 import shutil
-import stat
+import sqlite3
 import subprocess
+import sys
+import time
+import traceback
 from configparser import ConfigParser
+from contextlib import ExitStack
 from typing import Dict
 
-import progressbar
-from jinja2 import Template
-from mache import MachineInfo, discover_machine
-from mache.spack import get_spack_script, make_spack_env
-from mache.version import __version__ as mache_version
+from artifacts import (
+    get_artifact_filename,
+    get_artifact_key,
+    is_artifact_current,
+    pack_env,
+    unpack_env,
+)
+from batch import (
+    cancel_spack_jobs,
+    get_scheduler,
+    submit_spack_jobs,
+    wait_for_spack_job,
+)
+from history import (
+    DeployHistory,
+    get_entry_durations,
+    get_spack_install_times,
+    record_timing,
+)
+from hooks import (
+    get_pre_commit_env_vars,
+    start_hook_install,
+    wait_for_hook_install,
+)
+from libs import check_loader, consolidate_libs, get_consolidated_lib_dir
+from node_local import get_node_local_activation, pack_node_local_env
+from permissions import prepare_permissions, update_permissions
+from publish import (
+    commit_generations,
+    generations_lock,
+    get_staging_filename,
+    load_generations,
+    publish_file,
+    publish_symlink,
+    stage_generation,
+    unstage_generation,
+)
+from reconcile import (
+    read_spec_file,
+    reconcile_conda_env,
+    write_requested_specs,
+)
+from resources import (
+    get_build_jobs,
+    get_node_resources,
+    get_peak_child_memory_gb,
+    get_staging_size_gb,
+    spack_build_jobs,
+    spack_staging_dir,
+)
 from shared import (
+    DeployLock,
     check_call,
+    conda_env_lock,
+    discover_machine_cached,
+    enable_resource_sampling,
     get_conda_base,
     get_logger,
     get_spack_base,
     install_mambaforge,
+    log_message,
     parse_args,
+    preserve_process_state,
+    set_log_context,
+    spack_env_lock,
 )
+from upstreams import get_upstreams, report_upstream_specs, save_upstreams
+from wheelhouse import install_polaris, install_wheel
 
 
 def get_config(config_file, machine):
@@ -34,11 +94,9 @@ def get_config(config_file, machine):
     config.read(default_config)
 
     if machine is not None:
-        machine_config = \
-            str(importlib.resources.files('mache.machines') /
-                f'{machine}.cfg')
+        machine_config = get_mache_machine_config(machine)
         # it's okay if a given machine isn't part of mache
-        if os.path.exists(machine_config):
+        if machine_config is not None and os.path.exists(machine_config):
             config.read(machine_config)
 
         machine_config = os.path.join(here, '..', 'polaris', 'machines',
@@ -56,6 +114,19 @@ def get_config(config_file, machine):
     return config
 
 
+def get_mache_machine_config(machine):
+    """
+    Get the path to mache's config file for a machine.  The file is found
+    without importing mache, which is slow compared with reading config
+    files.
+    """
+    spec = importlib.util.find_spec('mache')
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    return os.path.join(list(spec.submodule_search_locations)[0], 'machines',
+                        f'{machine}.cfg')
+
+
 def get_version():
     # we can't import polaris because we probably don't have the necessary
     # dependencies, so we get the version by parsing (same approach used in
@@ -70,20 +141,19 @@ def get_version():
     return version
 
 
+def get_mache_version():
+    """
+    Get the version of mache from its package metadata, which is much
+    faster than importing mache
+    """
+    import importlib.metadata
+    return importlib.metadata.version('mache')
+
+
 def get_compilers_mpis(config, machine, compilers, mpis,  # noqa: C901
                        source_path):
 
     unsupported = parse_unsupported(machine, source_path)
-    if machine == 'conda-linux':
-        all_compilers = ['gfortran']
-        all_mpis = ['mpich', 'openmpi']
-    elif machine == 'conda-osx':
-        all_compilers = ['clang']
-        all_mpis = ['mpich', 'openmpi']
-    else:
-        machine_info = MachineInfo(machine)
-        all_compilers = machine_info.compilers
-        all_mpis = machine_info.mpilibs
 
     if not config.has_option('deploy', 'compiler'):
         raise ValueError(f'Machine config file for {machine} is missing a '
@@ -94,6 +164,7 @@ def get_compilers_mpis(config, machine, compilers, mpis,  # noqa: C901
 
     if compilers is not None and compilers[0] == 'all':
         error_on_unsupported = False
+        all_compilers, all_mpis = get_all_compilers_mpis(machine)
         if mpis is not None and mpis[0] == 'all':
             # make a matrix of compilers and mpis
             compilers = list()
@@ -115,6 +186,7 @@ def get_compilers_mpis(config, machine, compilers, mpis,  # noqa: C901
 
     elif mpis is not None and mpis[0] == 'all':
         error_on_unsupported = False
+        _, all_mpis = get_all_compilers_mpis(machine)
         mpis = all_mpis
         if compilers is None:
             compiler = default_compiler
@@ -154,6 +226,66 @@ def get_compilers_mpis(config, machine, compilers, mpis,  # noqa: C901
     return supported_compilers, supported_mpis
 
 
+def get_all_compilers_mpis(machine):
+    """
+    Get all the compilers and MPI libraries mache supports on a machine.
+    This is only needed for ``--compiler all`` or ``--mpi all``, so mache's
+    machine info is only loaded then.
+    """
+    if machine == 'conda-linux':
+        return ['gfortran'], ['mpich', 'openmpi']
+    elif machine == 'conda-osx':
+        return ['clang'], ['mpich', 'openmpi']
+
+    from mache import MachineInfo
+    machine_info = MachineInfo(machine)
+    return machine_info.compilers, machine_info.mpilibs
+
+
+def order_entries(history, machine, compilers, mpis, logger):
+    """
+    Order the compilers and MPI libraries so the entries that took longest
+    in earlier deployments start first.  Entries without any history (e.g.
+    new ones) are assumed to be slow and go first.  Otherwise, the order
+    is unchanged.
+    """
+    if history.filename is None or not os.path.exists(history.filename):
+        return compilers, mpis
+    durations = get_entry_durations(history.filename, machine)
+    entries = sorted(zip(compilers, mpis),
+                     key=lambda entry: -durations.get(entry, math.inf))
+    for compiler, mpi in entries:
+        duration = durations.get((compiler, mpi))
+        duration = 'unknown' if duration is None else f'{duration:.0f} s'
+        log_message(logger, f'Expected time for {compiler} with {mpi}: '
+                            f'{duration}')
+    return [entry[0] for entry in entries], [entry[1] for entry in entries]
+
+
+def report_entries(results, logger):
+    """
+    Print a summary of which compiler and MPI entries succeeded, failed or
+    were skipped and how long each took
+    """
+    if len(results) < 2 and all(result['status'] == 'success'
+                                for result in results):
+        return
+    lines = ['', 'Summary:']
+    for result in results:
+        entry = f'{result["compiler"]}, {result["mpi"]}'
+        status = result['status']
+        if result['step'] is not None:
+            status = f'{status} in {result["step"]}'
+        duration = result['duration']
+        duration = '' if duration is None else f'{duration:.0f} s'
+        lines.append(f'  {entry:<24} {status:<24} {duration:>8}')
+    lines.append('')
+    for line in lines:
+        print(line)
+        if logger is not None:
+            logger.info(line)
+
+
 def get_env_setup(args, config, machine, compiler, mpi, env_type, source_path,
                   conda_base, env_name, polaris_version, logger):
 
@@ -242,10 +374,8 @@ def get_env_setup(args, config, machine, compiler, mpi, env_type, source_path,
 def build_conda_env(config, env_type, recreate, mpi, conda_mpi, version,
                     python, source_path, conda_template_path, conda_base,
                     env_name, env_path, activate_base, use_local,
-                    local_conda_build, logger, local_mache):
-
-    if env_type != 'dev':
-        install_mambaforge(conda_base, activate_base, logger)
+                    local_conda_build, logger, local_mache,
+                    reconcile=False, history=None):
 
     if conda_mpi == 'nompi':
         mpi_prefix = 'nompi'
@@ -271,6 +401,9 @@ def build_conda_env(config, env_type, recreate, mpi, conda_mpi, version,
     activate_env = \
         f'source {base_activation_script} && conda activate {env_name}'
 
+    # imported here (like mache and progressbar) so that --help and the
+    # like don't pay for importing it
+    from jinja2 import Template
     with open(f'{conda_template_path}/conda-dev-spec.template', 'r') as f:
         template = Template(f.read())
 
@@ -286,7 +419,8 @@ def build_conda_env(config, env_type, recreate, mpi, conda_mpi, version,
         replacements = dict(supports_otps=supports_otps,
                             mpi=conda_mpi, openmp=conda_openmp,
                             mpi_prefix=mpi_prefix,
-                            include_mache=not local_mache)
+                            include_mache=not local_mache,
+                            ccache=config.getboolean('ccache', 'enabled'))
 
         for package in ['esmf', 'geometric_features', 'jigsaw', 'jigsawpy',
                         'mache', 'mpas_tools', 'netcdf_c', 'netcdf_fortran',
@@ -298,9 +432,16 @@ def build_conda_env(config, env_type, recreate, mpi, conda_mpi, version,
         spec_filename = f'spec-file-{conda_mpi}.txt'
         with open(spec_filename, 'w') as handle:
             handle.write(spec_file)
+        specs = read_spec_file(spec_filename) + [packages]
     else:
         spec_filename = None
+        # conda packages don't like dashes
+        version_conda = version.replace('-', '')
+        specs = [packages, f'polaris={version_conda}={mpi_prefix}_*']
+        if config.getboolean('ccache', 'enabled'):
+            specs.append('ccache')
 
+    changes = None
     if not os.path.exists(env_path) or recreate:
         print(f'creating {env_name}')
         if env_type == 'dev':
@@ -309,21 +450,23 @@ def build_conda_env(config, env_type, recreate, mpi, conda_mpi, version,
                 f'{activate_base} && ' \
                 f'mamba create -y -n {env_name} {channels} ' \
                 f'--file {spec_filename} {packages}'
-            check_call(commands, logger=logger)
+            with record_timing(history, 'mamba_solves', command='create'):
+                check_call(commands, logger=logger)
 
-            commands = \
-                f'{activate_env} && ' \
-                f'cd {source_path} && ' \
-                f'python -m pip install --no-deps -e .'
-            check_call(commands, logger=logger)
+            install_polaris(activate_env, env_path, source_path, logger)
 
         else:
-            # conda packages don't like dashes
-            version_conda = version.replace('-', '')
-            packages = f'{packages} "polaris={version_conda}={mpi_prefix}_*"'
-            commands = f'{activate_base} && ' \
-                       f'mamba create -y -n {env_name} {channels} {packages}'
-            check_call(commands, logger=logger)
+            build_release_conda_env(config, specs, channels, env_name,
+                                    env_path, activate_base, logger,
+                                    history)
+        write_requested_specs(env_path, specs)
+    elif reconcile:
+        print(f'Reconciling {env_name}\n')
+        changes = reconcile_conda_env(env_path, env_name, specs,
+                                      activate_base, channels, logger,
+                                      history)
+        if env_type == 'dev':
+            install_polaris(activate_env, env_path, source_path, logger)
     else:
         if env_type == 'dev':
             print(f'Updating {env_name}\n')
@@ -332,13 +475,11 @@ def build_conda_env(config, env_type, recreate, mpi, conda_mpi, version,
                 f'{activate_base} && ' \
                 f'mamba install -y -n {env_name} {channels} ' \
                 f'--file {spec_filename} {packages}'
-            check_call(commands, logger=logger)
+            with record_timing(history, 'mamba_solves', command='install'):
+                check_call(commands, logger=logger)
 
-            commands = \
-                f'{activate_env} && ' \
-                f'cd {source_path} && ' \
-                f'python -m pip install --no-deps -e .'
-            check_call(commands, logger=logger)
+            install_polaris(activate_env, env_path, source_path, logger)
+            write_requested_specs(env_path, specs)
         else:
             print(f'{env_name} already exists')
 
@@ -350,6 +491,90 @@ def build_conda_env(config, env_type, recreate, mpi, conda_mpi, version,
             f'pre-commit install'
         check_call(commands, logger=logger)
 
+    optimize_imports(config, env_type, env_path, activate_env, source_path,
+                     logger)
+
+    return changes
+
+
+def build_release_conda_env(config, specs, channels, env_name, env_path,
+                            activate_base, logger, history=None):
+    """
+    Create a release conda environment, unpacking it from a packed artifact
+    of an identical environment if one has been built before (e.g. on
+    another machine) and packing it for reuse otherwise
+    """
+    artifact_dir = config.get('env_artifacts', 'directory').strip()
+    if artifact_dir != '':
+        artifact_dir = os.path.abspath(os.path.expanduser(artifact_dir))
+        key = get_artifact_key(specs, channels)
+        artifact = get_artifact_filename(artifact_dir, env_name, key)
+        max_age_days = config.getfloat('env_artifacts', 'max_age_days')
+        if is_artifact_current(artifact, max_age_days):
+            print(f'Unpacking {env_name} from {artifact}\n')
+            if unpack_env(artifact, env_path, logger):
+                return
+        elif os.path.exists(artifact):
+            log_message(logger, f'{artifact} is more than {max_age_days} '
+                                f'days old, so {env_name} will be solved '
+                                f'and packed again')
+
+    packages = ' '.join(f'"{spec}"' for spec in specs)
+    commands = f'{activate_base} && ' \
+               f'mamba create -y -n {env_name} {channels} {packages}'
+    with record_timing(history, 'mamba_solves', command='create'):
+        check_call(commands, logger=logger)
+
+    if artifact_dir != '' and \
+            config.getboolean('env_artifacts', 'pack'):
+        print(f'Packing {env_name} into {artifact}\n')
+        pack_env(env_path, artifact, logger)
+
+
+def optimize_imports(config, env_type, env_path, activate_env, source_path,
+                     logger):
+    """
+    Precompile the bytecode in a shared conda environment and, optionally,
+    bundle pure-python packages into a zip archive to import from, so
+    imports from a shared file system need fewer metadata operations
+    """
+    section = 'python_imports'
+    script = f'python {source_path}/deploy/imports.py'
+    zip_filename = os.path.join(env_path, 'lib', 'polaris_imports.zip')
+    packages = [package.strip() for package in
+                config.get(section, 'zip_packages').split(',')
+                if package.strip() != '']
+    benchmark = config.getboolean(section, 'benchmark')
+
+    if benchmark:
+        # so this pass doesn't compile the bytecode that's being measured
+        commands = f'{activate_env} && ' \
+                   f'{script} benchmark -m polaris --no_bytecode'
+        check_call(commands, logger=logger)
+
+    # dev environments are updated in place, so their bytecode is left to
+    # be written as it's used
+    if env_type != 'dev' and config.getboolean(section, 'precompile'):
+        print('Precompiling python bytecode\n')
+        mode = config.get(section, 'invalidation_mode')
+        commands = f'{activate_env} && ' \
+                   f'{script} precompile --invalidation_mode {mode}'
+        check_call(commands, logger=logger)
+
+    if len(packages) > 0:
+        print('Bundling pure-python packages into a zip archive\n')
+        commands = f'{activate_env} && ' \
+                   f'{script} bundle {" ".join(packages)} -o {zip_filename}'
+        check_call(commands, logger=logger)
+    elif os.path.exists(zip_filename):
+        os.remove(zip_filename)
+
+    if benchmark:
+        zip_arg = f' --zip {zip_filename}' if len(packages) > 0 else ''
+        commands = f'{activate_env} && ' \
+                   f'{script} benchmark -m polaris{zip_arg}'
+        check_call(commands, logger=logger)
+
 
 def get_env_vars(machine, compiler, mpilib):
 
@@ -376,17 +601,82 @@ def get_env_vars(machine, compiler, mpilib):
                    f'export MV2_ENABLE_AFFINITY=0\n' \
                    f'export MV2_SHOW_CPU_BINDING=1\n'
 
+    # the section markers are used to profile activation
     env_vars = \
         f'{env_vars}' \
+        f'# polaris-section: netcdf_paths\n' \
         f'export NETCDF=$(dirname $(dirname $(which nc-config)))\n' \
         f'export NETCDFF=$(dirname $(dirname $(which nf-config)))\n' \
-        f'export PNETCDF=$(dirname $(dirname $(which pnetcdf-config)))\n'
+        f'export PNETCDF=$(dirname $(dirname $(which pnetcdf-config)))\n' \
+        f'# polaris-section: env_vars\n'
 
     return env_vars
 
 
+def get_ccache_env_vars(config):
+    """
+    Get the environment variables that point CMake builds (e.g. Omega) at
+    ccache and configure the cache
+    """
+    if not config.getboolean('ccache', 'enabled'):
+        return ''
+
+    # these are written to the load script unexpanded, so variables like
+    # $HOME or $SCRATCH are expanded for whoever loads it
+    cache_dir = config.get('ccache', 'cache_dir')
+    max_size = config.get('ccache', 'max_size')
+    base_dir = config.get('ccache', 'base_dir').strip()
+
+    env_vars = f'export CCACHE_DIR={cache_dir}\n' \
+               f'export CCACHE_MAXSIZE={max_size}\n' \
+               f'export CMAKE_C_COMPILER_LAUNCHER=ccache\n' \
+               f'export CMAKE_CXX_COMPILER_LAUNCHER=ccache\n'
+    if base_dir != '':
+        # paths under the base directory are hashed relative to the build
+        # directory, so different checkouts can share cache entries
+        env_vars = f'{env_vars}' \
+                   f'export CCACHE_BASEDIR={base_dir}\n' \
+                   f'export CCACHE_NOHASHDIR=true\n'
+    if config.getboolean('ccache', 'shared'):
+        env_vars = f'{env_vars}' \
+                   f'export CCACHE_UMASK=002\n'
+    return env_vars
+
+
+def report_ccache_stats(script_filename, logger):
+    """
+    Report the hit rate of the compiler cache used by a load script
+    """
+    process = subprocess.run(
+        f'source {script_filename} &> /dev/null && ccache --print-stats',
+        shell=True, executable='/bin/bash', stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    if process.returncode != 0:
+        log_message(logger, 'Could not get ccache statistics')
+        return None
+
+    stats: Dict[str, int] = dict()
+    for line in process.stdout.decode('utf-8').split('\n'):
+        parts = line.split('\t')
+        if len(parts) == 2 and parts[1].strip().isdigit():
+            stats[parts[0]] = int(parts[1])
+    hits = stats.get('direct_cache_hit', 0) + \
+        stats.get('preprocessed_cache_hit', 0)
+    total = hits + stats.get('cache_miss', 0)
+    hit_rate = 100. * hits / total if total > 0 else 0.
+    log_message(logger,
+                f'ccache: {hits} hits and {total - hits} misses '
+                f'({hit_rate:.1f}% hit rate), '
+                f'{stats.get("cache_size_kibibyte", 0) / 1024**2:.2f} GB '
+                f'in the cache')
+    return hit_rate
+
+
 def build_spack_env(config, update_spack, machine, compiler, mpi, spack_env,
-                    spack_base, spack_template_path, env_vars, tmpdir, logger):
+                    spack_base, spack_template_path, env_vars, tmpdir, logger,
+                    concurrent_installs=1):
+
+    from mache.spack import get_spack_script
 
     albany = config.get('deploy', 'albany')
     esmf = config.get('deploy', 'esmf')
@@ -394,7 +684,7 @@ def build_spack_env(config, update_spack, machine, compiler, mpi, spack_env,
     petsc = config.get('deploy', 'petsc')
     scorpio = config.get('deploy', 'scorpio')
 
-    spack_branch_base = f'{spack_base}/spack_for_mache_{mache_version}'
+    spack_branch_base = f'{spack_base}/spack_for_mache_{get_mache_version()}'
 
     specs = list()
 
@@ -427,26 +717,61 @@ def build_spack_env(config, update_spack, machine, compiler, mpi, spack_env,
     if albany != 'None':
         specs.append(f'albany@{albany}+mpas')
 
+    spack_view = f'{spack_branch_base}/var/spack/environments/' \
+                 f'{spack_env}/.spack-env/view'
+    consolidated_libs = config.getboolean('spack_build', 'consolidate_libs')
+    lib_dir = get_consolidated_lib_dir(spack_branch_base, spack_env)
+
     yaml_template: str | None = None
     template_path = f'{spack_template_path}/{machine}_{compiler}_{mpi}.yaml'
     if os.path.exists(template_path):
         yaml_template = template_path
     if update_spack:
-        make_spack_env(spack_path=spack_branch_base, env_name=spack_env,
-                       spack_specs=specs, compiler=compiler, mpi=mpi,
-                       machine=machine,
-                       include_e3sm_lapack=include_e3sm_lapack,
-                       include_e3sm_hdf5_netcdf=e3sm_hdf5_netcdf,
-                       yaml_template=yaml_template, tmpdir=tmpdir)
-
-        # remove ESMC/ESMF include files that interfere with MPAS time keeping
-        include_path = f'{spack_branch_base}/var/spack/environments/' \
-                       f'{spack_env}/.spack-env/view/include'
-        for prefix in ['ESMC', 'esmf']:
-            files = glob.glob(os.path.join(include_path, f'{prefix}*'))
-            for filename in files:
-                os.remove(filename)
-        set_ld_library_path(spack_branch_base, spack_env, logger)
+        prepare_permissions(config, spack_base, logger)
+        upstreams = get_upstreams(config, spack_base, spack_branch_base,
+                                  logger)
+        with spack_env_lock(spack_base, spack_env, f'building {spack_env}',
+                            logger):
+            with spack_staging_dir(config, tmpdir, specs, logger) as \
+                    staging_dir:
+                resources = get_node_resources(
+                    staging_dir, get_staging_size_gb(config, specs))
+                build_jobs, memory_per_job = get_build_jobs(
+                    config, resources, specs, concurrent_installs)
+                in_memory = ' (in memory)' \
+                    if resources['tmpdir_in_memory'] else ''
+                log_message(
+                    logger,
+                    f'Node resources: {resources["cores"]} cores, '
+                    f'{resources["memory_gb"]:.1f} GB memory available, '
+                    f'{resources["tmpdir_free_gb"]:.1f} GB free in '
+                    f'{resources["tmpdir"]}{in_memory}\n'
+                    f'Building {spack_env} with {build_jobs} parallel jobs '
+                    f'({memory_per_job:.1f} GB per job, {concurrent_installs} '
+                    f'concurrent install(s) on this node)')
+
+                with spack_build_jobs(build_jobs, upstreams, logger) as \
+                        spack_env_vars:
+                    make_spack_env_in_subprocess(
+                        spack_env_vars, logger, spack_path=spack_branch_base,
+                        env_name=spack_env, spack_specs=specs,
+                        compiler=compiler, mpi=mpi, machine=machine,
+                        include_e3sm_lapack=include_e3sm_lapack,
+                        include_e3sm_hdf5_netcdf=e3sm_hdf5_netcdf,
+                        yaml_template=yaml_template, tmpdir=staging_dir)
+
+            log_message(
+                logger,
+                f'Peak memory of a single build process so far: '
+                f'{get_peak_child_memory_gb():.2f} GB')
+
+            if len(upstreams) > 0:
+                save_upstreams(spack_branch_base, upstreams)
+                report_upstream_specs(spack_branch_base, spack_env,
+                                      upstreams, logger)
+
+            update_spack_view(spack_branch_base, spack_env, spack_view,
+                              consolidated_libs, lib_dir, logger)
 
     spack_script = get_spack_script(
         spack_path=spack_branch_base, env_name=spack_env, compiler=compiler,
@@ -455,10 +780,12 @@ def build_spack_env(config, update_spack, machine, compiler, mpi, spack_env,
         include_e3sm_hdf5_netcdf=e3sm_hdf5_netcdf,
         yaml_template=yaml_template)
 
-    spack_view = f'{spack_branch_base}/var/spack/environments/' \
-                 f'{spack_env}/.spack-env/view'
     env_vars = f'{env_vars}' \
                f'export PIO={spack_view}\n'
+    if consolidated_libs and os.path.exists(lib_dir):
+        env_vars = f'{env_vars}' \
+                   f'export LD_LIBRARY_PATH={lib_dir}' \
+                   f'${{LD_LIBRARY_PATH:+:$LD_LIBRARY_PATH}}\n'
     if albany != 'None':
         albany_flag_filename = f'{spack_view}/export_albany.in'
         if not os.path.exists(albany_flag_filename):
@@ -495,6 +822,113 @@ def build_spack_env(config, update_spack, machine, compiler, mpi, spack_env,
     return spack_branch_base, spack_script, env_vars
 
 
+def make_spack_env_in_subprocess(env, logger, **kwargs):
+    """
+    Call mache's ``make_spack_env()`` with the given keyword arguments in a
+    python subprocess with the environment variables ``env``.  mache runs
+    spack itself, and spack only finds its user config scope through the
+    environment, which this process shouldn't change.
+    """
+    filename = os.path.abspath(f'make_spack_env_{kwargs["env_name"]}.json')
+    with open(filename, 'w') as f:
+        json.dump(kwargs, f, indent=2)
+    code = 'import json, sys\n' \
+           'from mache.spack import make_spack_env\n' \
+           'with open(sys.argv[1]) as f:\n' \
+           '    make_spack_env(**json.load(f))'
+    check_call(f'{sys.executable} -c "{code}" {filename}', env=env,
+               logger=logger)
+
+
+def submit_spack_batch_jobs(args, config, machine, compilers, mpis,
+                            env_type, source_path, conda_base,
+                            polaris_version, spack_template_path,
+                            e3sm_machine, generations, logger):
+    entries = list()
+    for compiler, mpi in zip(compilers, mpis):
+        spack_base = get_matrix_spack_base(args, config, e3sm_machine,
+                                           compiler)
+        if spack_base is None:
+            continue
+        spack_env = get_env_setup(args, config, machine, compiler, mpi,
+                                  env_type, source_path, conda_base,
+                                  args.env_name, polaris_version, logger)[-1]
+        spack_env = stage_spack_env(generations, spack_env, spack_base,
+                                    args.update_spack)
+        entries.append(dict(machine=machine, compiler=compiler, mpi=mpi,
+                            spack_env=spack_env, spack_base=spack_base,
+                            spack_template_path=spack_template_path,
+                            tmpdir=args.tmpdir))
+
+    scheduler = get_scheduler(config)
+    for entry in entries:
+        entry['concurrent_installs'] = scheduler.concurrent_installs
+    spack_jobs = submit_spack_jobs(scheduler, config, entries, source_path,
+                                   logger)
+    return scheduler, spack_jobs
+
+
+def stage_spack_env(generations, spack_env, spack_base, update_spack):
+    if generations is None:
+        return spack_env
+    mache_version = get_mache_version()
+    env_root = f'{spack_base}/spack_for_mache_{mache_version}/var/spack/' \
+               f'environments'
+    return stage_generation(generations, 'spack', spack_env, env_root,
+                            update_spack)
+
+
+def remove_retired_envs(retired, conda_base, activate_base, spack_bases,
+                        logger):
+    for env_name in retired['conda']:
+        print(f'Removing retired conda environment {env_name}\n')
+        with conda_env_lock(conda_base, env_name, f'removing {env_name}',
+                            logger):
+            commands = f'{activate_base} && ' \
+                       f'conda env remove -y -n {env_name}'
+            check_call(commands, logger=logger)
+
+    for env_name in retired['spack']:
+        for spack_base in spack_bases:
+            spack_branch_base = \
+                f'{spack_base}/spack_for_mache_{get_mache_version()}'
+            env_path = f'{spack_branch_base}/var/spack/environments/' \
+                       f'{env_name}'
+            if not os.path.exists(env_path):
+                continue
+            print(f'Removing retired spack environment {env_name}\n')
+            with spack_env_lock(spack_base, env_name,
+                                f'removing {env_name}', logger):
+                commands = \
+                    f'source {spack_branch_base}/share/spack/setup-env.sh ' \
+                    f'&& spack env remove -y {env_name}'
+                check_call(commands, logger=logger)
+
+
+def get_matrix_spack_base(args, config, e3sm_machine, compiler):
+    if args.spack_base is not None:
+        spack_base = args.spack_base
+    elif e3sm_machine and compiler is not None:
+        spack_base = get_spack_base(args.spack_base, config)
+    else:
+        spack_base = None
+    return spack_base
+
+
+def update_spack_view(spack_branch_base, spack_env, spack_view,
+                      consolidated_libs, lib_dir, logger):
+    # remove ESMC/ESMF include files that interfere with MPAS time keeping
+    include_path = f'{spack_view}/include'
+    for prefix in ['ESMC', 'esmf']:
+        files = glob.glob(os.path.join(include_path, f'{prefix}*'))
+        for filename in files:
+            os.remove(filename)
+    if consolidated_libs:
+        consolidate_libs(spack_view, lib_dir, logger)
+    else:
+        set_ld_library_path(spack_branch_base, spack_env, logger)
+
+
 def set_ld_library_path(spack_branch_base, spack_env, logger):
     commands = \
         f'source {spack_branch_base}/share/spack/setup-env.sh && ' \
@@ -506,7 +940,8 @@ def set_ld_library_path(spack_branch_base, spack_env, logger):
 
 def write_load_polaris(template_path, activ_path, conda_base, env_type,
                        activ_suffix, prefix, env_name, spack_script, machine,
-                       env_vars, conda_env_only, source_path, without_openmp):
+                       env_vars, conda_env_only, source_path, without_openmp,
+                       staging=False, node_local=None):
 
     try:
         os.makedirs(activ_path)
@@ -541,6 +976,16 @@ def write_load_polaris(template_path, activ_path, conda_base, env_type,
         env_vars = f'{env_vars}\n' \
                    f'export POLARIS_BRANCH={source_path}'
 
+    zip_filename = os.path.join(conda_base, 'envs', env_name, 'lib',
+                                'polaris_imports.zip')
+    if os.path.exists(zip_filename):
+        # bundled packages are imported from the zip archive ahead of
+        # site-packages (in the shared or node-local copy of the environment)
+        env_vars = f'{env_vars}\n' \
+                   f'export PYTHONPATH=${{CONDA_PREFIX}}/lib/' \
+                   f'polaris_imports.zip${{PYTHONPATH:+:$PYTHONPATH}}'
+
+    from jinja2 import Template
     filename = f'{template_path}/load_polaris.template'
     with open(filename, 'r') as f:
         template = Template(f.read())
@@ -554,6 +999,7 @@ def write_load_polaris(template_path, activ_path, conda_base, env_type,
                # update the polaris installation to point here
                mkdir -p deploy_tmp/logs
                echo Reinstalling polaris package in edit mode...
+               rm -f ${CONDA_PREFIX}/conda-meta/polaris_polaris_hash.txt
                python -m pip install --no-deps -e . &> deploy_tmp/logs/install_polaris.log
                echo Done.
                echo
@@ -563,7 +1009,7 @@ def write_load_polaris(template_path, activ_path, conda_base, env_type,
         update_polaris = ''
 
     script = template.render(conda_base=conda_base, polaris_env=env_name,
-                             env_vars=env_vars,
+                             node_local=node_local, env_vars=env_vars,
                              spack=spack_script,
                              update_polaris=update_polaris)
 
@@ -580,8 +1026,14 @@ def write_load_polaris(template_path, activ_path, conda_base, env_type,
 
     script = '\n'.join(lines)
 
-    print(f'Writing:\n   {script_filename}\n')
-    with open(script_filename, 'w') as handle:
+    if staging:
+        # the script will be published once it has been checked
+        out_filename = get_staging_filename(script_filename)
+    else:
+        out_filename = script_filename
+
+    print(f'Writing:\n   {out_filename}\n')
+    with open(out_filename, 'w') as handle:
         handle.write(script)
 
     return script_filename
@@ -619,139 +1071,6 @@ def test_command(command, env, package, logger):
     print(f'  {package} passes')
 
 
-def update_permissions(config, env_type, activ_path,  # noqa: C901
-                       directories):
-
-    if not config.has_option('e3sm_unified', 'group'):
-        return
-
-    group = config.get('e3sm_unified', 'group')
-
-    new_uid = os.getuid()
-    new_gid = grp.getgrnam(group).gr_gid
-
-    print('changing permissions on activation scripts')
-
-    read_perm = (stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP |
-                 stat.S_IWGRP | stat.S_IROTH)
-    exec_perm = (stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR |
-                 stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP |
-                 stat.S_IROTH | stat.S_IXOTH)
-
-    mask = stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO
-
-    if env_type != 'dev':
-
-        activation_files = glob.glob('{}/*_polaris*.sh'.format(
-            activ_path))
-        for file_name in activation_files:
-            os.chmod(file_name, read_perm)
-            os.chown(file_name, new_uid, new_gid)
-
-    print('changing permissions on environments')
-
-    # first the base directories that don't seem to be included in
-    # os.walk()
-    for directory in directories:
-        try:
-            dir_stat = os.stat(directory)
-        except OSError:
-            continue
-
-        perm = dir_stat.st_mode & mask
-
-        if dir_stat.st_uid != new_uid:
-            # current user doesn't own this dir so let's move on
-            continue
-
-        if perm == exec_perm and dir_stat.st_gid == new_gid:
-            continue
-
-        try:
-            os.chown(directory, new_uid, new_gid)
-            os.chmod(directory, exec_perm)
-        except OSError:
-            continue
-
-    files_and_dirs = []
-    for base in directories:
-        for root, dirs, files in os.walk(base):
-            files_and_dirs.extend(dirs)
-            files_and_dirs.extend(files)
-
-    widgets = [progressbar.Percentage(), ' ', progressbar.Bar(),
-               ' ', progressbar.ETA()]
-    bar = progressbar.ProgressBar(widgets=widgets,
-                                  maxval=len(files_and_dirs)).start()
-    progress = 0
-    for base in directories:
-        for root, dirs, files in os.walk(base):
-            for directory in dirs:
-                progress += 1
-                try:
-                    bar.update(progress)
-                except ValueError:
-                    pass
-
-                directory = os.path.join(root, directory)
-
-                try:
-                    dir_stat = os.stat(directory)
-                except OSError:
-                    continue
-
-                if dir_stat.st_uid != new_uid:
-                    # current user doesn't own this dir so let's move on
-                    continue
-
-                perm = dir_stat.st_mode & mask
-
-                if perm == exec_perm and dir_stat.st_gid == new_gid:
-                    continue
-
-                try:
-                    os.chown(directory, new_uid, new_gid)
-                    os.chmod(directory, exec_perm)
-                except OSError:
-                    continue
-
-            for file_name in files:
-                progress += 1
-                try:
-                    bar.update(progress)
-                except ValueError:
-                    pass
-                file_name = os.path.join(root, file_name)
-                try:
-                    file_stat = os.stat(file_name)
-                except OSError:
-                    continue
-
-                if file_stat.st_uid != new_uid:
-                    # current user doesn't own this file so let's move on
-                    continue
-
-                perm = file_stat.st_mode & mask
-
-                if perm & stat.S_IXUSR:
-                    # executable, so make sure others can execute it
-                    new_perm = exec_perm
-                else:
-                    new_perm = read_perm
-
-                if perm == new_perm and file_stat.st_gid == new_gid:
-                    continue
-
-                try:
-                    os.chown(file_name, new_uid, new_gid)
-                    os.chmod(file_name, new_perm)
-                except OSError:
-                    continue
-
-    bar.finish()
-    print('  done.')
-
-
 def parse_unsupported(machine, source_path):
     with open(os.path.join(source_path, 'deploy', 'unsupported.txt'), 'r') \
             as f:
@@ -794,47 +1113,287 @@ def check_supported(library, machine, compiler, mpi, source_path):
                      f'on {machine}')
 
 
-def main():  # noqa: C901
-    args = parse_args(bootstrap=True)
+def main(argv=None):
+    args = parse_args(bootstrap=True, argv=argv)
 
     if args.verbose:
         logger = None
+    elif args.json_log:
+        logger = get_logger(log_filename='deploy_tmp/logs/bootstrap.jsonl',
+                            name=__name__, json_lines=True)
     else:
         logger = get_logger(log_filename='deploy_tmp/logs/bootstrap.log',
                             name=__name__)
 
-    source_path = os.getcwd()
+    results = Deployer(args, logger).build()
+    failed = [result for result in results if result['status'] != 'success']
+    if len(failed) > 0:
+        raise ValueError(f'{len(failed)} of {len(results)} compiler and MPI '
+                         f'entries failed or were skipped, see the summary '
+                         f'above')
+
+
+class Deployer:
+    """
+    Deploys polaris conda and spack environments and their load scripts
+    from within a python process, so automation can drive several
+    deployments from one long-lived process without starting and
+    activating a new interpreter (or parsing the config again) for each.
+
+    The deployment is planned, built and (optionally) checked again
+    afterwards::
+
+        args = parse_args(bootstrap=True,
+                          argv=['--conda', conda_base, '--conda_env_only'])
+        deployer = Deployer(args, logger)
+        for entry in deployer.plan():
+            print(entry['conda_env_name'])
+        results = deployer.build()
+        deployer.check()
+
+    The process must be running in an environment with the dependencies of
+    this script (like ``polaris_bootstrap``).  The deployment scripts
+    import each other as top-level modules rather than as a package, so
+    ``deploy/`` must be on ``sys.path`` to import this one::
+
+        sys.path.insert(0, os.path.join(source_path, 'deploy'))
+        from bootstrap import Deployer
+        from shared import parse_args
+
+    ``build()`` can be called more than once, e.g. after fixing what made
+    an entry fail, and each build is recorded in the history separately.
+
+    Attributes
+    ----------
+    args : argparse.Namespace
+        The command-line arguments from ``parse_args(bootstrap=True)``
+
+    logger : logging.Logger or None
+        A logger for output from the deployment, or ``None`` to print
+        output to the terminal
+
+    history : history.DeployHistory
+        The timing and outcome of each step of the deployment
+
+    source_path : str
+        The polaris source being deployed
+
+    config : configparser.ConfigParser
+        Deployment config options, once planned
+
+    entries : list of dict
+        The compilers, MPI libraries and environments to deploy, once
+        planned
+
+    results : list of dict
+        The outcome of deploying each entry, once built
+    """
+
+    def __init__(self, args, logger=None, history=None, source_path=None):
+        self.args = args
+        self.logger = logger
+        self.history = DeployHistory() if history is None else history
+        if source_path is None:
+            source_path = os.getcwd()
+        self.source_path = os.path.abspath(source_path)
+        self.polaris_version = None
+        self.machine = None
+        self.e3sm_machine = False
+        self.config = None
+        self.env_type = None
+        self.conda_base = None
+        self.entries = None
+        self.results = None
+
+    def plan(self):
+        """
+        Work out what to deploy without building anything: the machine,
+        config options, conda base and, for each compiler and MPI library
+        (slowest first), the conda and spack environments
+
+        Returns
+        -------
+        entries : list of dict
+            The ``compiler``, ``mpi``, ``conda_env_name``,
+            ``conda_env_path``, ``spack_env``, ``activ_path`` and whether
+            to ``recreate`` the conda environment for each entry
+        """
+        args = self.args
+        logger = self.logger
+        history = self.history
+        source_path = self.source_path
+        os.makedirs(f'{source_path}/deploy_tmp/logs', exist_ok=True)
+
+        polaris_version = get_version()
+
+        machine = None
+        if not args.conda_env_only:
+            if args.machine is None:
+                machine = discover_machine_cached()
+            else:
+                machine = args.machine
+
+        e3sm_machine = machine is not None
+
+        if machine is None and not args.conda_env_only:
+            if platform.system() == 'Linux':
+                machine = 'conda-linux'
+            elif platform.system() == 'Darwin':
+                machine = 'conda-osx'
+
+        config = get_config(args.config_file, machine)
+        set_log_context(logger, machine=machine)
+
+        env_type = config.get('deploy', 'env_type')
+        if env_type not in ['dev', 'test_release', 'release']:
+            raise ValueError(f'Unexpected env_type: {env_type}')
+        if env_type == 'release' and args.reconcile:
+            # reconciling changes the current generation in place, while
+            # it may be in use
+            raise ValueError('--reconcile can\'t be used for release '
+                             'environments; use --recreate to build a new '
+                             'generation instead')
+        history.set_run_info(config, machine, env_type, polaris_version,
+                             get_mache_version())
+        shared = (env_type != 'dev')
+        conda_base = get_conda_base(args.conda_base, config, shared=shared,
+                                    warn=False)
+        conda_base = os.path.abspath(conda_base)
+
+        if machine is None:
+            compilers = [None]
+            mpis = ['nompi']
+        else:
+            compilers, mpis = get_compilers_mpis(
+                config, machine, args.compilers, args.mpis, source_path)
+            compilers, mpis = order_entries(history, machine, compilers,
+                                            mpis, logger)
+
+            # write out a log file for use by matrix builds
+            with open(f'{source_path}/deploy_tmp/logs/matrix.log', 'w') as f:
+                f.write(f'{machine}\n')
+                for compiler, mpi in zip(compilers, mpis):
+                    f.write(f'{compiler}, {mpi}\n')
+
+            print('Configuring environment(s) for the following compilers '
+                  'and MPI libraries:')
+            for compiler, mpi in zip(compilers, mpis):
+                print(f'  {compiler}, {mpi}')
+            print('')
+
+        entries = list()
+        for compiler, mpi in zip(compilers, mpis):
+            _, recreate, _, _, _, activ_path, conda_env_path, \
+                conda_env_name, _, spack_env = get_env_setup(
+                    args, config, machine, compiler, mpi, env_type,
+                    source_path, conda_base, args.env_name, polaris_version,
+                    logger)
+            if get_matrix_spack_base(args, config, e3sm_machine,
+                                     compiler) is None:
+                spack_env = None
+            entries.append(dict(compiler=compiler, mpi=mpi,
+                                conda_env_name=conda_env_name,
+                                conda_env_path=conda_env_path,
+                                spack_env=spack_env, activ_path=activ_path,
+                                recreate=recreate))
+
+        self.polaris_version = polaris_version
+        self.machine = machine
+        self.e3sm_machine = e3sm_machine
+        self.config = config
+        self.env_type = env_type
+        self.conda_base = conda_base
+        self.entries = entries
+        return entries
+
+    def build(self):
+        """
+        Build the environments and write the load scripts for each entry
+        in the plan (planning first if that hasn't been done), then update
+        permissions on shared directories.  The deployment is added to the
+        history when it finishes.  The working directory, umask and
+        resource sampling of this process are left as they were.
+
+        Returns
+        -------
+        results : list of dict
+            The ``compiler``, ``mpi``, ``status`` (``success``, ``failed``
+            or ``skipped``), the ``step`` an entry failed in, its
+            ``duration`` and, if it succeeded, the ``script_filename`` of
+            its load script and its ``conda_env_name``
+        """
+        if self.entries is None:
+            self.plan()
+        self.results = None
+        # so steps from an earlier build aren't recorded again
+        self.history.reset()
+        try:
+            with ExitStack() as stack:
+                # deployment changes the working directory, umask and
+                # resource sampling, which are restored afterwards
+                stack.enter_context(preserve_process_state())
+                results = deploy(self, stack)
+        except BaseException:
+            self._finish_history('failed')
+            raise
+        if all(result['status'] == 'success' for result in results):
+            self._finish_history('success')
+        else:
+            # with --keep_going, the entries that succeeded are still
+            # recorded
+            self._finish_history('partial')
+        self.results = results
+        return results
+
+    def _finish_history(self, status):
+        # the history is just for reporting, so a locked or broken database
+        # shouldn't fail (or hide the error from) the deployment
+        try:
+            self.history.finish(status)
+        except (sqlite3.Error, OSError) as e:
+            log_message(self.logger, f'Warning: the deployment could not '
+                                     f'be added to the history in '
+                                     f'{self.history.filename}: {e}')
+
+    def check(self):
+        """
+        Check that the load script of each entry that was built activates
+        a conda environment with the expected packages
+        """
+        if self.results is None:
+            raise ValueError('Nothing has been built to check')
+        for result in self.results:
+            if result['status'] == 'success':
+                check_env(result['script_filename'],
+                          result['conda_env_name'], self.logger)
+
+
+def deploy(deployer, stack):  # noqa: C901
+    """
+    Build the environments and write the load scripts for each entry in a
+    deployer's plan.  Locks held across steps are entered into ``stack``
+    (a ``contextlib.ExitStack``) so they are released if deployment fails.
+    """
+    args = deployer.args
+    logger = deployer.logger
+    history = deployer.history
+    source_path = deployer.source_path
     conda_template_path = f'{source_path}/deploy'
     spack_template_path = f'{source_path}/deploy/spack'
-
-    polaris_version = get_version()
-
+    polaris_version = deployer.polaris_version
     local_mache = args.mache_fork is not None and args.mache_branch is not None
-
-    machine = None
-    if not args.conda_env_only:
-        if args.machine is None:
-            machine = discover_machine()
-        else:
-            machine = args.machine
-
-    e3sm_machine = machine is not None
-
-    if machine is None and not args.conda_env_only:
-        if platform.system() == 'Linux':
-            machine = 'conda-linux'
-        elif platform.system() == 'Darwin':
-            machine = 'conda-osx'
-
-    config = get_config(args.config_file, machine)
-
-    env_type = config.get('deploy', 'env_type')
-    if env_type not in ['dev', 'test_release', 'release']:
-        raise ValueError(f'Unexpected env_type: {env_type}')
-    shared = (env_type != 'dev')
-    conda_base = get_conda_base(args.conda_base, config, shared=shared,
-                                warn=False)
-    conda_base = os.path.abspath(conda_base)
+    machine = deployer.machine
+    e3sm_machine = deployer.e3sm_machine
+    config = deployer.config
+    env_type = deployer.env_type
+    conda_base = deployer.conda_base
+    compilers = [entry['compiler'] for entry in deployer.entries]
+    mpis = [entry['mpi'] for entry in deployer.entries]
+
+    # relative paths like deploy_tmp are in the polaris source
+    os.chdir(source_path)
+    enable_resource_sampling(
+        config, f'{source_path}/deploy_tmp/logs/resources.jsonl')
 
     source_activation_scripts = \
         f'source {conda_base}/etc/profile.d/conda.sh && ' \
@@ -842,145 +1401,341 @@ def main():  # noqa: C901
 
     activate_base = f'{source_activation_scripts} && conda activate'
 
-    if machine is None:
-        compilers = [None]
-        mpis = ['nompi']
-    else:
-        compilers, mpis = get_compilers_mpis(config, machine, args.compilers,
-                                             args.mpis, source_path)
-
-        # write out a log file for use by matrix builds
-        with open('deploy_tmp/logs/matrix.log', 'w') as f:
-            f.write(f'{machine}\n')
-            for compiler, mpi in zip(compilers, mpis):
-                f.write(f'{compiler}, {mpi}\n')
-
-        print('Configuring environment(s) for the following compilers and MPI '
-              'libraries:')
-        for compiler, mpi in zip(compilers, mpis):
-            print(f'  {compiler}, {mpi}')
-        print('')
-
     previous_conda_env = None
 
     permissions_dirs = []
     activ_path = None
 
-    for compiler, mpi in zip(compilers, mpis):
-
-        python, recreate, conda_mpi, activ_suffix, env_suffix, \
-            activ_path, conda_env_path, conda_env_name, activate_env, \
-            spack_env = get_env_setup(args, config, machine, compiler, mpi,
-                                      env_type, source_path, conda_base,
-                                      args.env_name, polaris_version, logger)
-
-        build_dir = f'deploy_tmp/build{activ_suffix}'
-
-        try:
-            shutil.rmtree(build_dir)
-        except OSError:
-            pass
+    generations = None
+    generations_activ_path = os.path.abspath(os.path.join(conda_base, '..'))
+    # environments whose activation scripts have been published
+    published_envs: set = set()
+    retired: dict = dict(conda=list(), spack=list())
+    # closed once all entries have been deployed (or if deployment fails)
+    publishing = stack.enter_context(ExitStack())
+    if env_type == 'release':
+        # shared release environments are built as a new generation
+        # alongside the current one and published atomically once checked
+        publishing.enter_context(generations_lock(
+            generations_activ_path, 'deploying polaris release environments',
+            logger=logger))
+        generations = load_generations(generations_activ_path)
+        # the environments of published scripts become current even if a
+        # later entry fails or deployment is interrupted, so the next
+        # deployment doesn't stage over them
+        publishing.callback(lambda: retired.update(commit_generations(
+            generations, generations_activ_path, published_envs)))
+    spack_bases = set()
+
+    spack_jobs: Dict[str, Dict] = dict()
+    scheduler = None
+    hook_process = None
+    hook_log = f'{source_path}/deploy_tmp/logs/pre_commit_hooks.log'
+    if args.spack_batch and args.update_spack and machine is not None:
+        # build the spack environments on compute nodes while we build the
+        # conda environments
+        scheduler, spack_jobs = submit_spack_batch_jobs(
+            args, config, machine, compilers, mpis, env_type, source_path,
+            conda_base, polaris_version, spack_template_path, e3sm_machine,
+            generations, logger)
+        # jobs that haven't finished when deployment ends (because it failed
+        # or was interrupted) are cancelled rather than left building
+        stack.callback(cancel_spack_jobs, scheduler, spack_jobs, logger)
+
+    node_local = None
+    results: list = list()
+    # conda environments that failed, so entries using them are skipped
+    failed_conda_envs: set = set()
+    entries = list(zip(compilers, mpis))
+    for index, (compiler, mpi) in enumerate(entries):
+        start = time.time()
+        base_conda_env = None
+        base_spack_env = None
         try:
-            os.makedirs(build_dir)
-        except FileExistsError:
-            pass
-
-        os.chdir(build_dir)
-
-        if args.spack_base is not None:
-            spack_base = args.spack_base
-        elif e3sm_machine and compiler is not None:
-            spack_base = get_spack_base(args.spack_base, config)
-        else:
-            spack_base = None
-
-        if spack_base is not None and args.update_spack:
-            # even if this is not a release, we need to update permissions on
-            # shared system libraries
-            permissions_dirs.append(spack_base)
-
-        if previous_conda_env != conda_env_name:
-            build_conda_env(
-                config, env_type, recreate, mpi, conda_mpi, polaris_version,
-                python, source_path, conda_template_path, conda_base,
-                conda_env_name, conda_env_path, activate_base, args.use_local,
-                args.local_conda_build, logger, local_mache)
-
-            if local_mache:
-                print('Install local mache\n')
-                commands = f'source {conda_base}/etc/profile.d/conda.sh && ' \
-                           f'source {conda_base}/etc/profile.d/mamba.sh && ' \
-                           f'conda activate {conda_env_name} && ' \
-                           'cd ../build_mache/mache && ' \
-                           'python -m pip install .'
-                check_call(commands, logger=logger)
-
-            previous_conda_env = conda_env_name
-
-            if env_type != 'dev':
-                permissions_dirs.append(conda_base)
-
-        spack_script = ''
-        if compiler is not None:
-            env_vars = get_env_vars(machine, compiler, mpi)
-            if spack_base is not None:
-                spack_branch_base, spack_script, env_vars = build_spack_env(
-                    config, args.update_spack, machine, compiler, mpi,
-                    spack_env, spack_base, spack_template_path, env_vars,
-                    args.tmpdir, logger)
-                spack_script = f'echo Loading Spack environment...\n' \
-                               f'{spack_script}\n' \
-                               f'echo Done.\n' \
-                               f'echo\n'
+            set_log_context(logger, compiler=compiler, mpi=mpi, step='setup')
+            history.set_entry(compiler, mpi)
+            history.start_step('setup')
+
+            python, recreate, conda_mpi, activ_suffix, env_suffix, \
+                activ_path, conda_env_path, conda_env_name, activate_env, \
+                spack_env = get_env_setup(
+                    args, config, machine, compiler, mpi, env_type,
+                    source_path, conda_base, args.env_name, polaris_version,
+                    logger)
+            base_conda_env = conda_env_name
+            base_spack_env = spack_env
+
+            if conda_env_name in failed_conda_envs:
+                log_message(logger, f'Skipping {compiler} with {mpi} because '
+                                    f'the conda environment {conda_env_name} '
+                                    f'failed')
+                history.drop_entry()
+                results.append(dict(compiler=compiler, mpi=mpi,
+                                    status='skipped', step=None,
+                                    duration=None))
+                continue
+
+            build_dir = f'deploy_tmp/build{activ_suffix}'
+
+            try:
+                shutil.rmtree(build_dir)
+            except OSError:
+                pass
+            try:
+                os.makedirs(build_dir)
+            except FileExistsError:
+                pass
+
+            os.chdir(build_dir)
+
+            spack_base = get_matrix_spack_base(args, config, e3sm_machine,
+                                               compiler)
+
+            if generations is not None:
+                conda_env_name = stage_generation(
+                    generations, 'conda', conda_env_name,
+                    os.path.join(conda_base, 'envs'), recreate)
+                conda_env_path = os.path.join(conda_base, 'envs',
+                                              conda_env_name)
+                if spack_base is not None:
+                    spack_env = stage_spack_env(generations, spack_env,
+                                                spack_base, args.update_spack)
+                    spack_bases.add(spack_base)
+
+            if spack_base is not None and args.update_spack:
+                # even if this is not a release, we need to update permissions
+                # on shared system libraries
+                permissions_dirs.append(spack_base)
+
+            if previous_conda_env != conda_env_name:
+                set_log_context(logger, step='conda_env')
+                history.start_step('conda_env')
+                history.add_cache_result(
+                    hit=os.path.exists(conda_env_path) and not recreate)
+                if env_type != 'dev':
+                    install_mambaforge(conda_base, activate_base, logger)
+                    prepare_permissions(config, conda_base, logger)
+                # other deployments may be using the same base and package
+                # cache
+                with conda_env_lock(conda_base, conda_env_name,
+                                    f'building {conda_env_name}', logger):
+                    changes = build_conda_env(
+                        config, env_type, recreate, mpi, conda_mpi,
+                        polaris_version, python, source_path,
+                        conda_template_path, conda_base, conda_env_name,
+                        conda_env_path, activate_base, args.use_local,
+                        args.local_conda_build, logger, local_mache,
+                        reconcile=args.reconcile, history=history)
+                if changes is not None:
+                    history.add_metrics(
+                        reconciled_installs=len(changes['install']),
+                        reconciled_removals=len(changes['remove']))
+
+                if local_mache:
+                    print('Install local mache\n')
+                    # the wheel was built once by configure_polaris_envs.py
+                    wheel = glob.glob(os.path.join(
+                        source_path, 'deploy_tmp', 'wheelhouse', 'mache',
+                        '*.whl'))[0]
+                    activate = \
+                        f'source {conda_base}/etc/profile.d/conda.sh && ' \
+                        f'source {conda_base}/etc/profile.d/mamba.sh && ' \
+                        f'conda activate {conda_env_name}'
+                    install_wheel(activate, conda_env_path, 'mache', wheel,
+                                  logger)
+
+                # the archive is made once the environment is complete
+                archive = pack_node_local_env(config, env_type, conda_base,
+                                              conda_env_name, conda_env_path,
+                                              logger)
+                node_local = None
+                if archive is not None:
+                    node_local = get_node_local_activation(
+                        config, conda_env_name, archive)
+
+                if env_type == 'dev' and hook_process is None:
+                    # the hook environments are the same for all conda envs
+                    hook_process = start_hook_install(config, activate_env,
+                                                      source_path, hook_log)
+
+                previous_conda_env = conda_env_name
+
+                if env_type != 'dev':
+                    permissions_dirs.append(conda_base)
+
+            spack_script = ''
+            if compiler is not None:
+                env_vars = get_env_vars(machine, compiler, mpi)
+                env_vars = f'{env_vars}{get_ccache_env_vars(config)}'
+                if spack_base is not None:
+                    set_log_context(logger, step='spack_env')
+                    history.start_step('spack_env')
+                    update_spack = args.update_spack
+                    build_start = time.time()
+                    if spack_env in spack_jobs:
+                        poll_interval = config.getfloat('spack_batch',
+                                                        'poll_interval')
+                        result = wait_for_spack_job(
+                            scheduler, spack_jobs[spack_env], logger,
+                            poll_interval)
+                        if result['status'] != 'success':
+                            raise ValueError(
+                                f'The batch job building the spack '
+                                f'environment {spack_env} failed.  See:\n'
+                                f'   {spack_jobs[spack_env]["log_filename"]}')
+                        # the batch job already built the spack environment
+                        update_spack = False
+                        build_start = result['start']
+                        history.add_metrics(batch_duration=result['duration'])
+                    history.add_cache_result(hit=not args.update_spack)
+                    spack_branch_base, spack_script, env_vars = \
+                        build_spack_env(
+                            config, update_spack, machine, compiler, mpi,
+                            spack_env, spack_base, spack_template_path,
+                            env_vars, args.tmpdir, logger)
+                    if args.update_spack:
+                        history.add_metrics(
+                            spack_package_seconds=get_spack_install_times(
+                                spack_branch_base, build_start))
+                    spack_script = f'echo Loading Spack environment...\n' \
+                                   f'{spack_script}\n' \
+                                   f'echo Done.\n' \
+                                   f'echo\n'
+                else:
+                    env_vars = \
+                        f'{env_vars}' \
+                        f'export PIO={conda_env_path}\n' \
+                        f'export OPENMP_INCLUDE=-I"{conda_env_path}/include"\n'
             else:
-                env_vars = \
-                    f'{env_vars}' \
-                    f'export PIO={conda_env_path}\n' \
-                    f'export OPENMP_INCLUDE=-I"{conda_env_path}/include"\n'
-        else:
-            env_vars = ''
+                env_vars = ''
 
-        if env_type == 'dev':
-            if args.env_name is not None:
-                prefix = 'load_{}'.format(args.env_name)
+            if env_type == 'dev':
+                env_vars = f'{env_vars}{get_pre_commit_env_vars(config)}'
+                if args.env_name is not None:
+                    prefix = 'load_{}'.format(args.env_name)
+                else:
+                    prefix = 'load_dev_polaris_{}'.format(polaris_version)
+            elif env_type == 'test_release':
+                prefix = 'test_polaris_{}'.format(polaris_version)
             else:
-                prefix = 'load_dev_polaris_{}'.format(polaris_version)
-        elif env_type == 'test_release':
-            prefix = 'test_polaris_{}'.format(polaris_version)
-        else:
-            prefix = 'load_polaris_{}'.format(polaris_version)
-
-        script_filename = write_load_polaris(
-            conda_template_path, activ_path, conda_base, env_type,
-            activ_suffix, prefix, conda_env_name, spack_script, machine,
-            env_vars, args.conda_env_only, source_path, args.without_openmp)
-
-        if args.check:
-            check_env(script_filename, conda_env_name, logger)
-
-        if env_type == 'release' and not (args.with_albany or
-                                          args.with_netlib_lapack or
-                                          args.with_petsc):
-            # make a symlink to the activation script
-            link = os.path.join(activ_path,
-                                f'load_latest_polaris_{compiler}_{mpi}.sh')
-            check_call(f'ln -sfn {script_filename} {link}')
-
-            default_compiler = config.get('deploy', 'compiler')
-            default_mpi = config.get('deploy',
-                                     'mpi_{}'.format(default_compiler))
-            if compiler == default_compiler and mpi == default_mpi:
-                # make a default symlink to the activation script
-                link = os.path.join(activ_path, 'load_latest_polaris.sh')
-                check_call(f'ln -sfn {script_filename} {link}')
-        os.chdir(source_path)
-
-    commands = '{} && conda clean -y -p -t'.format(activate_base)
-    check_call(commands, logger=logger)
+                prefix = 'load_polaris_{}'.format(polaris_version)
+
+            history.start_step('load_script')
+            staging = generations is not None
+            script_filename = write_load_polaris(
+                conda_template_path, activ_path, conda_base, env_type,
+                activ_suffix, prefix, conda_env_name, spack_script, machine,
+                env_vars, args.conda_env_only, source_path,
+                args.without_openmp, staging=staging,
+                node_local=node_local)
+
+            if staging:
+                staged_filename = get_staging_filename(script_filename)
+            else:
+                staged_filename = script_filename
+
+            if args.check:
+                set_log_context(logger, step='check')
+                history.start_step('check')
+                check_env(staged_filename, conda_env_name, logger)
+                loader_command = config.get('spack_build',
+                                            'loader_check_command').strip()
+                if spack_base is not None and loader_command != '':
+                    result = check_loader(staged_filename, loader_command,
+                                          logger)
+                    history.add_metrics(
+                        loader_wall_time=result['wall_time'],
+                        loader_search_attempts=result['search_attempts'])
+                if compiler is not None and \
+                        config.getboolean('ccache', 'enabled'):
+                    hit_rate = report_ccache_stats(staged_filename, logger)
+                    history.add_metrics(ccache_hit_rate=hit_rate)
+
+            if staging:
+                publish_file(staged_filename, script_filename)
+                published_envs.add(('conda', base_conda_env))
+                if spack_base is not None:
+                    published_envs.add(('spack', base_spack_env))
+
+            if env_type == 'release' and not (args.with_albany or
+                                              args.with_netlib_lapack or
+                                              args.with_petsc):
+                # make a symlink to the activation script
+                link = os.path.join(activ_path,
+                                    f'load_latest_polaris_{compiler}_{mpi}.sh')
+                publish_symlink(script_filename, link)
+
+                default_compiler = config.get('deploy', 'compiler')
+                default_mpi = config.get('deploy',
+                                         'mpi_{}'.format(default_compiler))
+                if compiler == default_compiler and mpi == default_mpi:
+                    # make a default symlink to the activation script
+                    link = os.path.join(activ_path, 'load_latest_polaris.sh')
+                    publish_symlink(script_filename, link)
+            os.chdir(source_path)
+        except Exception:
+            os.chdir(source_path)
+            step = history.step
+            history.drop_entry()
+            results.append(dict(compiler=compiler, mpi=mpi,
+                                status='failed', step=step,
+                                duration=time.time() - start))
+            if step == 'conda_env' and base_conda_env is not None:
+                failed_conda_envs.add(base_conda_env)
+            if generations is not None:
+                # the current generations stay current
+                if step == 'conda_env' and base_conda_env is not None:
+                    unstage_generation(generations, 'conda',
+                                       base_conda_env)
+                if base_spack_env is not None:
+                    unstage_generation(generations, 'spack',
+                                       base_spack_env)
+            if not args.keep_going:
+                results.extend(
+                    dict(compiler=compiler, mpi=mpi, status='skipped',
+                         step=None, duration=None)
+                    for compiler, mpi in entries[index + 1:])
+                report_entries(results, logger)
+                raise
+            log_message(logger, f'Error: deploying {compiler} with {mpi} '
+                                f'failed in the {step} step, continuing '
+                                f'with the remaining entries:\n'
+                                f'{traceback.format_exc()}')
+            continue
+        results.append(dict(compiler=compiler, mpi=mpi, status='success',
+                            step=None, duration=time.time() - start,
+                            script_filename=script_filename,
+                            conda_env_name=conda_env_name))
+
+    report_entries(results, logger)
+
+    set_log_context(logger, compiler=None, mpi=None, step='finalize')
+    history.set_entry(None, None)
+    history.start_step('finalize')
+    publishing.close()
+    if generations is not None:
+        remove_retired_envs(retired, conda_base, activate_base, spack_bases,
+                            logger)
+
+    with DeployLock(conda_base, 'pkgs', 'conda clean', logger=logger):
+        commands = '{} && conda clean -y -p -t'.format(activate_base)
+        check_call(commands, logger=logger)
+
+    wait_for_hook_install(hook_process, hook_log, logger)
 
     if args.update_spack or env_type != 'dev':
         # we need to update permissions on shared stuff
-        update_permissions(config, env_type, activ_path, permissions_dirs)
+        history.start_step('permissions')
+        # wait for other deployments to finish with these directories
+        with ExitStack() as stack:
+            for directory in dict.fromkeys(permissions_dirs):
+                stack.enter_context(DeployLock(
+                    directory, 'base', 'updating permissions',
+                    logger=logger))
+            update_permissions(config, env_type, activ_path,
+                               permissions_dirs)
+
+    return results
 
 
 if __name__ == '__main__':
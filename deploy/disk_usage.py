@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+
+from publish import get_generation_name, load_generations
+from shared import (
+    DeployLock,
+    check_call,
+    conda_env_lock,
+    get_conda_base,
+    get_deployed_marker,
+    get_spack_base,
+)
+from upstreams import read_upstreams
+
+# the conda environments that polaris deploys (other than polaris_bootstrap)
+# are named after the type of environment and the polaris version
+POLARIS_ENV_PATTERN = re.compile(r'^(dev_|test_)?polaris_\d')
+
+
+def get_config(config_file, machine):
+    # we can't load polaris so we find the config files
+    here = os.path.abspath(os.path.dirname(__file__))
+    config = ConfigParser()
+    config.read(os.path.join(here, 'default.cfg'))
+    if machine is not None:
+        machine_config = os.path.join(here, '..', 'polaris', 'machines',
+                                      f'{machine}.cfg')
+        if not os.path.exists(machine_config):
+            raise FileNotFoundError(
+                f'Could not find a config file for this machine at '
+                f'polaris/machines/{machine}.cfg')
+        config.read(machine_config)
+    if config_file is not None:
+        config.read(config_file)
+    return config
+
+
+def find_items(conda_base, spack_base, build_roots, activ_paths):
+    """
+    Find the environments and build directories whose disk usage is
+    tracked.  Only conda environments that are named like polaris
+    environments or are used by polaris activation scripts or generations
+    are included, since the conda base may have other environments.  The
+    package cache of the conda base comes after its environments, so it
+    only counts the packages that aren't linked into any of them.
+
+    Parameters
+    ----------
+    conda_base : str or None
+        The conda base with environments in ``envs``
+
+    spack_base : str or None
+        The spack base with ``spack_for_mache_<version>`` trees
+
+    build_roots : list of str
+        Polaris checkouts with ``deploy_tmp/build*`` directories
+
+    activ_paths : list of str
+        Directories with polaris activation scripts
+
+    Returns
+    -------
+    items : list of dict
+        The ``kind``, ``name`` and ``path`` of each item
+    """
+    items = list()
+    if conda_base is not None:
+        polaris_envs = get_polaris_envs(activ_paths)
+        for path in sorted(glob.glob(os.path.join(conda_base, 'envs', '*'))):
+            name = os.path.basename(path)
+            if not os.path.isdir(path) or name == 'polaris_bootstrap':
+                continue
+            if POLARIS_ENV_PATTERN.match(name) or name in polaris_envs:
+                items.append(dict(kind='conda', name=name, path=path))
+        path = os.path.join(conda_base, 'pkgs')
+        if os.path.isdir(path):
+            items.append(dict(kind='pkgs', name='pkgs', path=path))
+    if spack_base is not None:
+        pattern = os.path.join(spack_base, 'spack_for_mache_*')
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isdir(path):
+                items.append(dict(kind='spack', name=os.path.basename(path),
+                                  path=path))
+    for root in build_roots:
+        pattern = os.path.join(root, 'deploy_tmp', 'build*')
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isdir(path):
+                items.append(dict(kind='build', name=os.path.basename(path),
+                                  path=path))
+    return items
+
+
+def get_polaris_envs(activ_paths):
+    """
+    Get the names of conda environments that polaris activation scripts
+    activate or that are generations of published environments
+    """
+    names = set()
+    for activ_path in activ_paths:
+        for filename in glob.glob(os.path.join(activ_path, '*_polaris*.sh')):
+            if not os.path.isfile(filename):
+                continue
+            with open(filename) as f:
+                names.update(re.findall(r'(?:conda|mamba) activate (\S+)',
+                                        f.read()))
+        generations = load_generations(activ_path)
+        for name, entry in generations['conda'].items():
+            for key in ['current', 'previous', 'staged']:
+                if entry.get(key) is not None:
+                    names.add(get_generation_name(name, entry[key]))
+    return names
+
+
+def is_deployed_conda_base(conda_base, config):
+    """
+    Whether a conda base was installed by a polaris deployment: either the
+    shared base from the ``polaris_envs`` config option or one marked by
+    ``install_mambaforge()``.  Environments are only removed from such bases.
+    """
+    if config.has_option('paths', 'polaris_envs'):
+        shared_base = get_conda_base(None, config, shared=True)
+        if os.path.realpath(shared_base) == os.path.realpath(conda_base):
+            return True
+    return os.path.exists(get_deployed_marker(conda_base))
+
+
+def update_index(index, items, threads):
+    """
+    Update the size of each item in the index, scanning the items in
+    parallel.  Sizes are the space allocated on disk, and files with
+    several hard links (e.g. between conda environments and the package
+    cache) are only counted in the first item (in the order of ``items``)
+    that has them.  Directories whose modification time hasn't changed
+    since the last scan are not listed again, so only their own ``stat`` is
+    needed.  Files that change size in place without their directory
+    changing are not noticed until the directory changes.
+
+    Parameters
+    ----------
+    index : dict
+        The index from ``load_index()``, updated in place
+
+    items : list of dict
+        The items from ``find_items()``
+
+    threads : int
+        The number of threads used to scan items
+    """
+    directories = index.setdefault('directories', dict())
+
+    def scan(item):
+        return _scan_tree(item['path'], directories)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(scan, items))
+
+    scanned = dict()
+    tracked = set()
+    seen = set()
+    for item, (size, links, dirs) in zip(items, results):
+        for device, inode, allocated in links:
+            if (device, inode) not in seen:
+                seen.add((device, inode))
+                size += allocated
+        scanned[item['path']] = dict(item, size=size)
+        tracked.update(dirs)
+
+    # forget directories that no longer exist under any item
+    for path in list(directories.keys()):
+        if path not in tracked:
+            directories.pop(path)
+
+    index['items'] = scanned
+    index['updated'] = time.time()
+
+
+def update_last_used(index, activ_paths):
+    """
+    Find when each item was last used from the access time of activation
+    scripts that refer to it, falling back on when it was last modified
+    """
+    scripts = list()
+    for activ_path in activ_paths:
+        for filename in glob.glob(os.path.join(activ_path, '*_polaris*.sh')):
+            if os.path.isfile(filename) and not os.path.islink(filename):
+                with open(filename) as f:
+                    scripts.append((os.stat(filename).st_atime, f.read()))
+
+    for item in index['items'].values():
+        last_used = _get_modified_time(item)
+        pattern = re.compile(rf'\b{re.escape(item["name"])}\b')
+        for atime, content in scripts:
+            if item['kind'] != 'build' and pattern.search(content):
+                last_used = max(last_used, atime)
+        item['last_used'] = last_used
+
+
+def get_protected(activ_paths, spack_base=None):
+    """
+    Get the names of items that must not be removed: the bootstrap
+    environment, anything used by an activation script (including the
+    previous versions kept for rollback) and spack trees that other spack
+    trees use as upstreams
+    """
+    protected = {'base', 'polaris_bootstrap'}
+    for activ_path in activ_paths:
+        for filename in glob.glob(os.path.join(activ_path, '*_polaris*')):
+            if os.path.islink(filename) or not os.path.isfile(filename):
+                continue
+            with open(filename) as f:
+                content = f.read()
+            protected.update(re.findall(r'(?:conda|mamba) activate (\S+)',
+                                        content))
+            protected.update(re.findall(r'(spack_for_mache_[^/\s]+)',
+                                        content))
+    if spack_base is not None:
+        for path in glob.glob(os.path.join(spack_base, 'spack_for_mache_*')):
+            protected.update(read_upstreams(path))
+    return protected
+
+
+def plan_removal(index, quota_gb, protected):
+    """
+    Choose the least recently used items to remove so that the total size
+    is within the quota.  The package cache is never removed, just cleaned
+    with ``clean_package_cache()``.
+    """
+    items = list(index['items'].values())
+    total = sum(item['size'] for item in items)
+    quota = quota_gb * 1024**3
+    remove = list()
+    for item in sorted(items, key=lambda item: item['last_used']):
+        if total <= quota:
+            break
+        if item['kind'] == 'pkgs' or item['name'] in protected:
+            continue
+        remove.append(item)
+        total -= item['size']
+    return remove, total
+
+
+def remove_item(item, activ_paths):
+    """
+    Remove an item and any activation scripts that refer to it
+    """
+    print(f'Removing {item["kind"]} {item["path"]}')
+    shutil.rmtree(item['path'], onerror=_make_writable)
+    if item['kind'] == 'build':
+        return
+    pattern = re.compile(rf'\b{re.escape(item["name"])}\b')
+    for activ_path in activ_paths:
+        for filename in glob.glob(os.path.join(activ_path, '*_polaris*')):
+            if os.path.islink(filename) or not os.path.isfile(filename):
+                continue
+            with open(filename) as f:
+                if pattern.search(f.read()) is None:
+                    continue
+            print(f'  removing activation script {filename}')
+            os.remove(filename)
+
+
+def clean_package_cache(conda_base):
+    """
+    Remove the packages and tarballs in the package cache of a conda base
+    that no environment uses, as deployments do when they finish
+    """
+    print(f'Cleaning the package cache in {conda_base}')
+    with DeployLock(conda_base, 'pkgs', 'conda clean'):
+        commands = f'source {conda_base}/etc/profile.d/conda.sh && ' \
+                   f'conda activate && ' \
+                   f'conda clean -y -p -t'
+        check_call(commands)
+
+
+def load_index(filename):
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    return dict()
+
+
+def save_index(index, filename):
+    tmp_filename = f'{filename}.tmp{os.getpid()}'
+    with open(tmp_filename, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_filename, filename)
+
+
+def print_table(index):
+    print(f'{"size (GB)":>10}  {"last used":<16}  {"kind":<6}  path')
+    items = sorted(index['items'].values(), key=lambda item: item['last_used'])
+    for item in items:
+        last_used = time.strftime('%Y-%m-%d %H:%M',
+                                  time.localtime(item['last_used']))
+        print(f'{item["size"] / 1024**3:10.2f}  {last_used:<16}  '
+              f'{item["kind"]:<6}  {item["path"]}')
+    total = sum(item['size'] for item in items)
+    print(f'{total / 1024**3:10.2f}  total')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Index the disk usage of polaris conda and spack '
+                    'environments and remove the least recently used ones')
+    parser.add_argument('command', choices=['index', 'gc'],
+                        help='"index" to update and show the disk-usage '
+                             'index, "gc" to also remove the least recently '
+                             'used environments to meet the quota')
+    parser.add_argument('-m', '--machine', dest='machine',
+                        help='The name of the machine for loading machine-'
+                             'related config options')
+    parser.add_argument('--conda', dest='conda_base',
+                        help='Path to the conda base')
+    parser.add_argument('--spack', dest='spack_base',
+                        help='Path to the spack base')
+    parser.add_argument('-f', '--config_file', dest='config_file',
+                        help='Config file to override deployment config '
+                             'options')
+    parser.add_argument('--index', dest='index',
+                        help='The index file (next to the conda base by '
+                             'default)')
+    parser.add_argument('--quota', dest='quota', type=float,
+                        help='The quota in GB (overrides quota_gb in the '
+                             '[disk_usage] config section)')
+    parser.add_argument('--dry_run', dest='dry_run', action='store_true',
+                        help='Show what "gc" would remove without removing '
+                             'anything')
+    args = parser.parse_args()
+
+    config = get_config(args.config_file, args.machine)
+    shared = args.conda_base is None and config.has_option('paths',
+                                                           'polaris_envs')
+    conda_base = get_conda_base(args.conda_base, config, shared=shared)
+    try:
+        spack_base = get_spack_base(args.spack_base, config)
+    except ValueError:
+        spack_base = None
+
+    activ_paths = [os.path.abspath(os.path.join(conda_base, '..'))]
+    source_path = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                               '..'))
+    if source_path not in activ_paths:
+        activ_paths.append(source_path)
+
+    index_filename = args.index
+    if index_filename is None:
+        index_filename = os.path.join(activ_paths[0],
+                                      '.polaris_disk_usage.json')
+
+    items = find_items(conda_base, spack_base, [source_path], activ_paths)
+    index = load_index(index_filename)
+    threads = config.getint('disk_usage', 'scan_threads')
+    update_index(index, items, threads)
+    update_last_used(index, activ_paths)
+    save_index(index, index_filename)
+    print_table(index)
+
+    if args.command != 'gc':
+        return
+
+    quota_gb = args.quota
+    if quota_gb is None:
+        quota_gb = config.getfloat('disk_usage', 'quota_gb')
+    protected = get_protected(activ_paths, spack_base)
+    deployed = is_deployed_conda_base(conda_base, config)
+    if not deployed:
+        print(f'\nNot removing conda environments from {conda_base} because '
+              f'it was not installed by a polaris deployment')
+        protected.update(item['name'] for item in index['items'].values()
+                         if item['kind'] == 'conda')
+    elif not args.dry_run:
+        # unused packages are freed first, since that may be all it takes
+        print('')
+        clean_package_cache(conda_base)
+        update_index(index, items, threads)
+    remove, total = plan_removal(index, quota_gb, protected)
+    if total > quota_gb * 1024**3:
+        print(f'\nWarning: {total / 1024**3:.2f} GB remains in use after '
+              f'removing all unprotected environments, above the quota of '
+              f'{quota_gb} GB')
+    if len(remove) == 0:
+        print('\nNothing to remove')
+        return
+
+    print('')
+    for item in remove:
+        if args.dry_run:
+            print(f'Would remove {item["kind"]} {item["path"]} '
+                  f'({item["size"] / 1024**3:.2f} GB)')
+        elif item['kind'] == 'conda':
+            with conda_env_lock(conda_base, item['name'],
+                                f'removing {item["name"]}', None):
+                remove_item(item, activ_paths)
+            index['items'].pop(item['path'])
+        elif item['kind'] == 'spack':
+            # a whole spack tree, so no one can be building in it
+            with DeployLock(spack_base, 'base', f'removing {item["name"]}'):
+                remove_item(item, activ_paths)
+            index['items'].pop(item['path'])
+        else:
+            remove_item(item, activ_paths)
+            index['items'].pop(item['path'])
+
+    if args.dry_run:
+        return
+
+    if any(item['kind'] == 'conda' for item in remove):
+        # the packages of removed environments are now unused
+        clean_package_cache(conda_base)
+    items = find_items(conda_base, spack_base, [source_path], activ_paths)
+    update_index(index, items, threads)
+    update_last_used(index, activ_paths)
+    save_index(index, index_filename)
+
+
+def _scan_tree(path, directories):
+    # returns the total size of files under path with a single link, the
+    # device, inode and size of those with more than one, and the
+    # directories scanned
+    total = 0
+    links = list()
+    scanned = list()
+    stack = [path]
+    while len(stack) > 0:
+        directory = stack.pop()
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            continue
+        scanned.append(directory)
+        cached = directories.get(directory)
+        # indices from before hard links were tracked are scanned again
+        if cached is None or cached['mtime'] != mtime or \
+                'links' not in cached:
+            cached = _scan_directory(directory, mtime)
+            directories[directory] = cached
+        total += cached['size']
+        links.extend(cached['links'])
+        stack.extend(os.path.join(directory, name)
+                     for name in cached['subdirs'])
+    return total, links, scanned
+
+
+def _scan_directory(directory, mtime):
+    size = 0
+    links = list()
+    subdirs = list()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                        continue
+                    info = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                # the space allocated, which differs from the size for
+                # sparse files and those smaller than a block
+                allocated = info.st_blocks * 512
+                if info.st_nlink > 1:
+                    links.append([info.st_dev, info.st_ino, allocated])
+                else:
+                    size += allocated
+    except OSError:
+        pass
+    return dict(mtime=mtime, size=size, links=links, subdirs=subdirs)
+
+
+def _get_modified_time(item):
+    history = os.path.join(item['path'], 'conda-meta', 'history')
+    for path in [history, item['path']]:
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            continue
+    return 0.
+
+
+def _make_writable(function, path, excinfo):
+    # spack makes its installs read-only
+    os.chmod(os.path.dirname(path), stat.S_IRWXU)
+    os.chmod(path, stat.S_IRWXU)
+    function(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import json
+import os
+import re
+import socket
+import sqlite3
+import statistics
+import time
+from configparser import ConfigParser
+from contextlib import closing, contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    start REAL,
+    duration REAL,
+    status TEXT,
+    host TEXT,
+    machine TEXT,
+    env_type TEXT,
+    polaris_version TEXT,
+    mache_version TEXT,
+    pins TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id INTEGER REFERENCES runs(id),
+    compiler TEXT,
+    mpi TEXT,
+    step TEXT,
+    duration REAL,
+    cache_hits INTEGER,
+    cache_misses INTEGER,
+    metrics TEXT
+);
+"""
+
+
+class DeployHistory:
+    """
+    Records the timing and outcome of each step of a deployment and appends
+    them to a local SQLite database when the deployment finishes
+
+    Attributes
+    ----------
+    run : dict
+        Information about the deployment as a whole
+
+    steps : list of dict
+        The steps recorded so far
+    """
+
+    def __init__(self):
+        self.filename = None
+        self.run: dict = dict(host=socket.gethostname(), machine=None,
+                              env_type=None, polaris_version=None,
+                              mache_version=None, pins=None)
+        self.reset()
+
+    def reset(self):
+        """
+        Start recording a new deployment, keeping the information from
+        ``set_run_info()``
+        """
+        self.start = time.time()
+        self.run.update(start=self.start)
+        self.run.pop('status', None)
+        self.run.pop('duration', None)
+        self.steps = list()
+        self._entry = dict(compiler=None, mpi=None)
+        self._current = None
+
+    def set_run_info(self, config, machine, env_type, polaris_version,
+                     mache_version):
+        """
+        Set information about the deployment once the config is known
+
+        Parameters
+        ----------
+        config : configparser.ConfigParser
+            Deployment config options, including the ``database`` option in
+            the ``[history]`` section and the version pins in ``[deploy]``
+
+        machine : str
+            The machine
+
+        env_type : str
+            The type of environment
+
+        polaris_version : str
+            The version of polaris being deployed
+
+        mache_version : str
+            The version of mache used to deploy
+        """
+        if config.has_option('history', 'database'):
+            filename = config.get('history', 'database').strip()
+            if filename != '':
+                self.filename = os.path.abspath(os.path.expanduser(filename))
+        self.run.update(machine=machine, env_type=env_type,
+                        polaris_version=polaris_version,
+                        mache_version=mache_version,
+                        pins=json.dumps(dict(config.items('deploy'))))
+
+    def set_entry(self, compiler, mpi):
+        """
+        Set the compiler and MPI library for the following steps
+        """
+        self._end_step()
+        self._entry = dict(compiler=compiler, mpi=mpi)
+
+    @property
+    def step(self):
+        """
+        The name of the current step, if any
+        """
+        if self._current is None:
+            return None
+        return self._current['step']
+
+    def drop_entry(self):
+        """
+        Drop the steps recorded for the current compiler and MPI library
+        (e.g. because one of them failed) so their partial timings aren't
+        mistaken for those of a complete deployment
+        """
+        self._current = None
+        self.steps = [step for step in self.steps
+                      if step['compiler'] != self._entry['compiler'] or
+                      step['mpi'] != self._entry['mpi']]
+
+    def start_step(self, step):
+        """
+        Start timing a step, ending the previous one
+        """
+        self._end_step()
+        self._current = dict(self._entry, step=step, start=time.time(),
+                             cache_hits=0, cache_misses=0, metrics=dict())
+
+    def add_cache_result(self, hit, count=1):
+        """
+        Record cache hits or misses for the current step
+        """
+        if self._current is None:
+            return
+        key = 'cache_hits' if hit else 'cache_misses'
+        self._current[key] += count
+
+    def add_metrics(self, **metrics):
+        """
+        Record other metrics for the current step
+        """
+        if self._current is not None:
+            self._current['metrics'].update(metrics)
+
+    def append_metric(self, metric, value):
+        """
+        Append a value to a metric of the current step that is a list (e.g.
+        one timing for each of several commands)
+        """
+        if self._current is not None:
+            self._current['metrics'].setdefault(metric, list()).append(value)
+
+    def finish(self, status):
+        """
+        End the deployment and append it to the database
+
+        Parameters
+        ----------
+        status : str
+            The outcome of the deployment: ``success``, ``failed`` or
+        ``partial`` (some compiler and MPI entries failed with
+        ``--keep_going``)
+        """
+        self._end_step()
+        if self.filename is None:
+            return
+        self.run.update(status=status,
+                        duration=time.time() - self.start)
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with closing(_connect(self.filename)) as connection, connection:
+            keys = list(self.run.keys())
+            cursor = connection.execute(
+                f'INSERT INTO runs ({", ".join(keys)}) '
+                f'VALUES ({", ".join("?" for _ in keys)})',
+                [self.run[key] for key in keys])
+            run_id = cursor.lastrowid
+            connection.executemany(
+                'INSERT INTO steps (run_id, compiler, mpi, step, duration, '
+                'cache_hits, cache_misses, metrics) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, step['compiler'], step['mpi'], step['step'],
+                  step['duration'], step['cache_hits'],
+                  step['cache_misses'], json.dumps(step['metrics']))
+                 for step in self.steps])
+
+    def _end_step(self):
+        if self._current is None:
+            return
+        step = self._current
+        step['duration'] = time.time() - step.pop('start')
+        self.steps.append(step)
+        self._current = None
+
+
+def get_step_history(filename, machine=None, max_runs=20):
+    """
+    Get the durations and cache hits of each step in recent successful (or
+    partially successful) deployments, oldest first
+
+    Parameters
+    ----------
+    filename : str
+        The database
+
+    machine : str, optional
+        Only include deployments on this machine
+
+    max_runs : int, optional
+        The maximum number of runs of each step to include
+
+    Returns
+    -------
+    history : dict
+        Lists of dicts with ``run_id``, ``start``, ``duration``,
+        ``cache_hits`` and ``cache_misses`` with the machine, compiler, MPI
+        library and step as keys
+    """
+    query = 'SELECT runs.id, runs.start, runs.machine, steps.compiler, ' \
+            'steps.mpi, steps.step, steps.duration, steps.cache_hits, ' \
+            'steps.cache_misses FROM steps JOIN runs ON steps.run_id = ' \
+            'runs.id WHERE runs.status IN (?, ?)'
+    params = ['success', 'partial']
+    if machine is not None:
+        query = f'{query} AND runs.machine = ?'
+        params.append(machine)
+    query = f'{query} ORDER BY runs.start'
+
+    history: dict = dict()
+    with closing(_connect(filename)) as connection:
+        for row in connection.execute(query, params):
+            run_id, start, row_machine, compiler, mpi, step, duration, \
+                hits, misses = row
+            key = (row_machine, compiler, mpi, step)
+            history.setdefault(key, list()).append(
+                dict(run_id=run_id, start=start, duration=duration,
+                     cache_hits=hits, cache_misses=misses))
+
+    for key in history:
+        history[key] = history[key][-max_runs:]
+    return history
+
+
+def get_entry_durations(filename, machine):
+    """
+    Get the typical time to deploy each compiler and MPI library on a
+    machine, the sum of the median duration of each of its steps.  Runs
+    where a step had to build something (had cache misses) are used where
+    possible, since those are the slow ones worth starting first.
+
+    Parameters
+    ----------
+    filename : str
+        The database
+
+    machine : str
+        The machine
+
+    Returns
+    -------
+    durations : dict
+        The typical duration in seconds with the compiler and MPI library
+        as keys
+    """
+    durations: dict = dict()
+    history = get_step_history(filename, machine)
+    for (_, compiler, mpi, _), runs in history.items():
+        if compiler is None:
+            # the finalize step isn't part of any entry
+            continue
+        built = [run['duration'] for run in runs if run['cache_misses'] > 0]
+        if len(built) == 0:
+            built = [run['duration'] for run in runs]
+        durations[(compiler, mpi)] = \
+            durations.get((compiler, mpi), 0.) + statistics.median(built)
+    return durations
+
+
+def find_regressions(history, factor, min_runs, min_seconds=0.):
+    """
+    Find steps whose latest duration is noticeably longer than the median
+    of their earlier durations with the same cache result (with or without
+    cache misses)
+
+    Parameters
+    ----------
+    history : dict
+        The history from ``get_step_history()``
+
+    factor : float
+        How many times the median a step must take to be flagged
+
+    min_runs : int
+        The number of earlier runs with the same cache result needed before
+        a step can be flagged
+
+    min_seconds : float, optional
+        Steps whose latest duration is shorter than this are never flagged,
+        since small absolute changes in quick steps are just noise
+
+    Returns
+    -------
+    regressions : list of tuple
+        The key, latest duration and median duration of each flagged step
+    """
+    regressions = list()
+    for key, runs in history.items():
+        # steps that had to build something (had cache misses) take much
+        # longer than those that didn't, so the latest run is only compared
+        # with earlier runs of the same kind
+        built = runs[-1]['cache_misses'] > 0
+        earlier = [run['duration'] for run in runs[:-1]
+                   if (run['cache_misses'] > 0) == built]
+        if len(earlier) < min_runs:
+            continue
+        median = statistics.median(earlier)
+        latest = runs[-1]['duration']
+        if latest < min_seconds:
+            continue
+        if median > 0. and latest > factor * median:
+            regressions.append((key, latest, median))
+    return regressions
+
+
+@contextmanager
+def record_timing(history, metric, **info):
+    """
+    Time a block (e.g. a single mamba solve) and, if it succeeds, append
+    its ``seconds`` along with ``info`` to a list metric of the current
+    step.  Nothing is recorded if ``history`` is ``None``.
+    """
+    start = time.time()
+    yield
+    if history is not None:
+        history.append_metric(metric,
+                              dict(info, seconds=time.time() - start))
+
+
+def get_spack_install_times(spack_path, since):
+    """
+    Get how long spack took to install each package it installed after a
+    given time, from the ``install_times.json`` that spack writes into the
+    prefix of each package
+
+    Parameters
+    ----------
+    spack_path : str
+        The spack clone with the default install tree
+        (``opt/spack/<arch>/<compiler>/<name>-<version>-<hash>``)
+
+    since : float
+        Only packages installed after this time are included
+
+    Returns
+    -------
+    install_times : dict
+        The install time in seconds with the package names as keys
+    """
+    install_times = dict()
+    pattern = os.path.join(spack_path, 'opt', 'spack', '*', '*', '*',
+                           '.spack', 'install_times.json')
+    for filename in glob.glob(pattern):
+        prefix = os.path.dirname(os.path.dirname(filename))
+        match = re.match(r'(.+)-[^-]+-[a-z0-9]{32}$',
+                         os.path.basename(prefix))
+        try:
+            if match is None or os.path.getmtime(filename) < since:
+                continue
+            with open(filename) as f:
+                total = json.load(f)['total']
+        except (OSError, ValueError, KeyError):
+            continue
+        if isinstance(total, dict):
+            total = total.get('seconds')
+        if isinstance(total, (int, float)):
+            install_times[match.group(1)] = total
+    return install_times
+
+
+def print_report(history, regressions):
+    print(f'{"machine":<14} {"compiler":<10} {"mpi":<10} {"step":<12} '
+          f'{"runs":>4} {"median (s)":>10} {"latest (s)":>10} '
+          f'{"cache hits":>10}')
+    for key in sorted(history, key=lambda key: [str(k) for k in key]):
+        runs = history[key]
+        machine, compiler, mpi, step = [str(k) for k in key]
+        median = statistics.median(run['duration'] for run in runs)
+        hits = sum(run['cache_hits'] for run in runs)
+        total = hits + sum(run['cache_misses'] for run in runs)
+        hit_rate = f'{100. * hits / total:.0f}%' if total > 0 else '-'
+        print(f'{machine:<14} {compiler:<10} {mpi:<10} {step:<12} '
+              f'{len(runs):>4} {median:>10.1f} {runs[-1]["duration"]:>10.1f} '
+              f'{hit_rate:>10}')
+
+    if len(regressions) == 0:
+        print('\nNo steps are noticeably slower than their history')
+        return
+
+    print('\nSteps noticeably slower than their history:')
+    for key, latest, median in regressions:
+        machine, compiler, mpi, step = [str(k) for k in key]
+        print(f'  {step} ({machine}, {compiler}, {mpi}): {latest:.1f} s vs. '
+              f'a median of {median:.1f} s')
+
+
+def _connect(filename):
+    connection = sqlite3.connect(filename, timeout=60.)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def main():
+    here = os.path.abspath(os.path.dirname(__file__))
+    config = ConfigParser()
+    config.read(os.path.join(here, 'default.cfg'))
+
+    parser = argparse.ArgumentParser(
+        description='Report trends in deployment history and flag steps that '
+                    'have become noticeably slower')
+    parser.add_argument('--db', dest='database',
+                        default=config.get('history', 'database'),
+                        help='The deployment history database')
+    parser.add_argument('-m', '--machine', dest='machine',
+                        help='Only report deployments on this machine')
+    parser.add_argument('--max_runs', dest='max_runs', type=int, default=20,
+                        help='The number of recent runs of each step to '
+                             'consider')
+    parser.add_argument('--min_seconds', dest='min_seconds', type=float,
+                        default=config.getfloat('history',
+                                                'regression_min_seconds'),
+                        help='Steps that took less time than this (in '
+                             'seconds) are not reported as regressions')
+    args = parser.parse_args()
+
+    filename = os.path.abspath(os.path.expanduser(args.database))
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f'No deployment history found at {filename}')
+
+    history = get_step_history(filename, args.machine, args.max_runs)
+    regressions = find_regressions(
+        history, factor=config.getfloat('history', 'regression_factor'),
+        min_runs=config.getint('history', 'regression_min_runs'),
+        min_seconds=args.min_seconds)
+    print_report(history, regressions)
+
+
+if __name__ == '__main__':
+    main()
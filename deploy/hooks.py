@@ -0,0 +1,90 @@
+import os
+import subprocess
+
+from shared import log_message
+
+
+def get_pre_commit_home(config):
+    """
+    Get the cache directory for pre-commit hook environments, or ``None`` to
+    use pre-commit's default (``~/.cache/pre-commit``)
+    """
+    home = config.get('pre_commit', 'home').strip()
+    if home == '':
+        return None
+    return os.path.abspath(os.path.expandvars(os.path.expanduser(home)))
+
+
+def get_pre_commit_env_vars(config):
+    """
+    Get the environment variables that point pre-commit at the shared cache
+    of hook environments in dev load scripts
+    """
+    home = get_pre_commit_home(config)
+    if home is None:
+        return ''
+    return f'export PRE_COMMIT_HOME={home}\n'
+
+
+def start_hook_install(config, activate_env, source_path, log_filename):
+    """
+    Start building the pre-commit hook environments in the background.
+    pre-commit keys its environments by the repository, revision and
+    dependencies of each hook, so environments with the same hook config
+    reuse what is already in the cache.
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    activate_env : str
+        Commands to activate a conda environment with pre-commit
+
+    source_path : str
+        The polaris checkout with the pre-commit config
+
+    log_filename : str
+        A log file for output from pre-commit
+
+    Returns
+    -------
+    process : subprocess.Popen or None
+        The background process, or ``None`` if prewarming is disabled
+    """
+    if not config.getboolean('pre_commit', 'prewarm'):
+        return None
+
+    env = dict(os.environ)
+    home = get_pre_commit_home(config)
+    commands = f'{activate_env} && cd {source_path}'
+    if home is not None:
+        os.makedirs(home, exist_ok=True)
+        env['PRE_COMMIT_HOME'] = home
+        if config.getboolean('pre_commit', 'shared'):
+            # others in the group need to be able to add to the cache
+            commands = f'umask 002 && {commands}'
+    commands = f'{commands} && pre-commit install-hooks'
+
+    print(f'Building pre-commit hook environments in the background, see '
+          f'{log_filename}\n')
+    with open(log_filename, 'w') as log_file:
+        process = subprocess.Popen(commands, env=env, shell=True,
+                                   executable='/bin/bash', stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+    return process
+
+
+def wait_for_hook_install(process, log_filename, logger):
+    """
+    Wait for the pre-commit hook environments to be built.  A failure isn't
+    fatal because pre-commit will try again on the first commit.
+    """
+    if process is None:
+        return
+    returncode = process.wait()
+    if returncode == 0:
+        log_message(logger, 'pre-commit hook environments are ready')
+    else:
+        log_message(logger, f'Warning: building pre-commit hook environments '
+                            f'failed, see {log_filename}')
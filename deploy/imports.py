@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Reduce the file-system calls made when python packages are imported from a
+shared conda environment.  This script is run with the python from the
+environment itself so the bytecode matches its python version.
+"""
+import argparse
+import compileall
+import glob
+import json
+import os
+import py_compile
+import re
+import shutil
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import zipfile
+
+ZIP_NAME = 'polaris_imports.zip'
+
+
+def precompile(invalidation_mode):
+    """
+    Compile the bytecode for all modules in site-packages so nothing needs to
+    be written (or checked for writing) at runtime
+
+    Parameters
+    ----------
+    invalidation_mode : {'timestamp', 'checked-hash', 'unchecked-hash'}
+        How python decides if the bytecode is out of date.
+        ``unchecked-hash`` skips checking the source file at import, saving
+        a ``stat`` of each module, so it should only be used where the
+        source is not edited in place.
+    """
+    mode = getattr(py_compile.PycInvalidationMode,
+                   invalidation_mode.replace('-', '_').upper())
+    site_packages = sysconfig.get_paths()['purelib']
+    success = compileall.compile_dir(site_packages, quiet=1, workers=0,
+                                     invalidation_mode=mode)
+    if not success:
+        # a few packages ship modules that only work with other python
+        # versions (e.g. test data), which is fine
+        print('Warning: some modules could not be compiled')
+
+
+def bundle(packages, filename):
+    """
+    Copy pure-python packages from site-packages into a zip archive with
+    their bytecode so they can be imported from a single file, which is put
+    ahead of site-packages on ``PYTHONPATH``
+
+    Parameters
+    ----------
+    packages : list of str
+        The import names of the packages to bundle.  Packages with compiled
+        extensions, or that are not installed, are skipped.
+
+    filename : str
+        The zip archive to write
+    """
+    site_packages = sysconfig.get_paths()['purelib']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bundled = list()
+        for package in packages:
+            src = os.path.join(site_packages, package)
+            if os.path.isdir(src):
+                if _has_extensions(src):
+                    print(f'Skipping {package}: it has compiled extensions')
+                    continue
+                shutil.copytree(src, os.path.join(tmpdir, package),
+                                ignore=shutil.ignore_patterns('__pycache__'))
+            elif os.path.isfile(f'{src}.py'):
+                shutil.copy2(f'{src}.py', tmpdir)
+            else:
+                print(f'Skipping {package}: it is not in {site_packages}')
+                continue
+            bundled.append(package)
+
+        # zipimport only finds bytecode next to the source (not in
+        # __pycache__)
+        compileall.compile_dir(tmpdir, quiet=1, legacy=True, workers=0)
+
+        tmp_filename = f'{filename}.tmp{os.getpid()}'
+        with zipfile.ZipFile(tmp_filename, 'w', zipfile.ZIP_STORED) as zf:
+            for root, _, files in os.walk(tmpdir):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    zf.write(path, os.path.relpath(path, tmpdir))
+        os.replace(tmp_filename, filename)
+
+    print(f'Bundled {", ".join(bundled)} into {filename}')
+
+
+def benchmark(module, zip_filename=None, bytecode=True):
+    """
+    Count the file-system calls made when importing a module, with
+    ``strace`` if it is available or counting only the files opened and
+    directories listed otherwise
+
+    Parameters
+    ----------
+    module : str
+        The module to import
+
+    zip_filename : str, optional
+        A zip archive of bundled packages to import from
+
+    bytecode : bool, optional
+        Whether to use (and write) bytecode in the environment.  Without
+        it, the import is measured as it would be before the environment
+        is precompiled, without compiling anything into the environment.
+
+    Returns
+    -------
+    counts : dict
+        The number of calls of each type
+    """
+    env = dict(os.environ)
+    if zip_filename is not None:
+        env['PYTHONPATH'] = os.pathsep.join(
+            [zip_filename] +
+            [path for path in [os.environ.get('PYTHONPATH')] if path])
+    with tempfile.TemporaryDirectory() as pycache_prefix:
+        if not bytecode:
+            # bytecode is only looked for in the empty scratch directory
+            # and none is written
+            env['PYTHONDONTWRITEBYTECODE'] = '1'
+            env['PYTHONPYCACHEPREFIX'] = pycache_prefix
+        return _count_calls(module, env)
+
+
+def _count_calls(module, env):
+    # the counts include starting python, which is the same with or without
+    # the zip archive
+    code = f'import {module}'
+    if shutil.which('strace') is not None:
+        with tempfile.NamedTemporaryFile(suffix='.strace') as f:
+            subprocess.check_call(
+                ['strace', '-f', '-c', '-o', f.name, '-e', 'trace=%file',
+                 sys.executable, '-c', code], env=env)
+            with open(f.name) as summary:
+                return _parse_strace_summary(summary.read())
+
+    # python has no audit events for stat, so only opens and directory
+    # listings can be counted this way
+    code = 'import json, sys\n' \
+           'counts = dict()\n' \
+           'def hook(event, args):\n' \
+           '    if event in ["open", "os.listdir", "os.scandir"]:\n' \
+           '        counts[event] = counts.get(event, 0) + 1\n' \
+           'sys.addaudithook(hook)\n' \
+           f'import {module}\n' \
+           'print(json.dumps(counts))\n'
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return json.loads(output.decode('utf-8').strip().split('\n')[-1])
+
+
+def _has_extensions(path):
+    for pattern in ['*.so', '*.pyd', '*.dylib']:
+        if len(glob.glob(os.path.join(path, '**', pattern),
+                         recursive=True)) > 0:
+            return True
+    return False
+
+
+def _parse_strace_summary(summary):
+    counts = dict()
+    for line in summary.split('\n'):
+        match = re.match(r'^\s*[\d.]+\s+[\d.]+\s+\d+\s+(\d+)\s+(?:\d+\s+)?'
+                         r'(\w+)\s*$', line)
+        if match is not None:
+            calls, name = match.groups()
+            counts[name] = int(calls)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Precompile and bundle python packages in a conda '
+                    'environment to reduce the file-system calls made on '
+                    'import')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparser = subparsers.add_parser(
+        'precompile', help='Compile the bytecode for all of site-packages')
+    subparser.add_argument('--invalidation_mode', dest='invalidation_mode',
+                           default='timestamp',
+                           choices=['timestamp', 'checked-hash',
+                                    'unchecked-hash'],
+                           help='How python decides if the bytecode is out '
+                                'of date')
+
+    subparser = subparsers.add_parser(
+        'bundle', help='Bundle pure-python packages into a zip archive')
+    subparser.add_argument('packages', nargs='+',
+                           help='The import names of the packages')
+    subparser.add_argument('-o', '--output', dest='output',
+                           default=os.path.join(sys.prefix, 'lib', ZIP_NAME),
+                           help='The zip archive to write')
+
+    subparser = subparsers.add_parser(
+        'benchmark', help='Count the file-system calls made by an import')
+    subparser.add_argument('-m', '--module', dest='module',
+                           default='polaris', help='The module to import')
+    subparser.add_argument('--zip', dest='zip_filename',
+                           help='A zip archive of bundled packages to import '
+                                'from')
+    subparser.add_argument('--no_bytecode', dest='bytecode',
+                           action='store_false',
+                           help='Import without reading or writing bytecode '
+                                'in the environment, as before it is '
+                                'precompiled')
+
+    args = parser.parse_args()
+    if args.command == 'precompile':
+        precompile(args.invalidation_mode)
+    elif args.command == 'bundle':
+        bundle(args.packages, args.output)
+    else:
+        counts = benchmark(args.module, args.zip_filename, args.bytecode)
+        print(json.dumps(dict(module=args.module, zip=args.zip_filename,
+                              bytecode=args.bytecode, calls=counts)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import glob
+import os
+import re
+import shutil
+import subprocess
+
+from shared import log_message
+
+
+def get_consolidated_lib_dir(spack_branch_base, spack_env):
+    """
+    Get the directory with links to all the shared libraries in a spack
+    environment's view
+    """
+    return os.path.join(spack_branch_base, 'var', 'spack', 'environments',
+                        spack_env, 'polaris_libs')
+
+
+def consolidate_libs(spack_view, lib_dir, logger):
+    """
+    Link the shared libraries from a spack view's ``lib`` and ``lib64``
+    directories into a single directory, so the dynamic loader only needs
+    to search one directory for them.  Each link points directly at the
+    library in its package's prefix rather than through the view.
+
+    Parameters
+    ----------
+    spack_view : str
+        The view of the spack environment
+
+    lib_dir : str
+        The directory to create
+
+    logger : logging.Logger
+        A logger for output from the deployment
+    """
+    tmp_dir = f'{lib_dir}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    count = 0
+    for subdir in ['lib', 'lib64']:
+        pattern = os.path.join(spack_view, subdir, '*.so*')
+        for filename in sorted(glob.glob(pattern)):
+            name = os.path.basename(filename)
+            link = os.path.join(tmp_dir, name)
+            if os.path.lexists(link):
+                # lib takes precedence over lib64, as in the view
+                continue
+            target = os.path.realpath(filename)
+            if not os.path.isfile(target):
+                continue
+            os.symlink(target, link)
+            count += 1
+
+    shutil.rmtree(lib_dir, ignore_errors=True)
+    os.rename(tmp_dir, lib_dir)
+    log_message(logger, f'Linked {count} shared libraries into {lib_dir}')
+
+
+def measure_loader(activate, command, runs=5):
+    """
+    Measure how long the dynamic loader takes to start a binary and how many
+    paths it tries while searching for its libraries
+
+    Parameters
+    ----------
+    activate : str
+        Commands to activate the environment the binary runs in
+
+    command : str
+        The binary to run (with arguments, e.g. ``ncdump -h``) that exits
+        quickly
+
+    runs : int, optional
+        The number of times to run the binary, the fastest of which is
+        reported
+
+    Returns
+    -------
+    result : dict
+        The ``wall_time`` in seconds, ``loader_cycles`` reported by the
+        loader and the number of library ``search_attempts``
+    """
+    # the command may exit with an error (e.g. for missing arguments) after
+    # the libraries have been loaded, which is fine.  Only the command is
+    # timed, not the activation.
+    process = subprocess.run(
+        f'{activate} && TIMEFORMAT=%R && for i in $(seq {runs}); do '
+        f'{{ time {command} > /dev/null 2>&1 ; }} 2>&1; done', shell=True,
+        executable='/bin/bash', stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    wall_times = [float(line) for line in
+                  process.stdout.decode('utf-8').split('\n')
+                  if re.match(r'^\d+\.\d+$', line.strip())]
+
+    # LD_DEBUG is only set for the command so activation isn't included
+    process = subprocess.run(
+        f'{activate} && LD_DEBUG=libs,statistics {command}', shell=True,
+        executable='/bin/bash', stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    output = process.stderr.decode('utf-8', errors='replace')
+
+    search_attempts = len(re.findall(r'trying file=', output))
+    match = re.search(r'total startup time in dynamic loader:\s*([\d,]+)',
+                      output)
+    loader_cycles = None
+    if match is not None:
+        loader_cycles = int(match.group(1).replace(',', ''))
+
+    wall_time = min(wall_times) if len(wall_times) > 0 else None
+    return dict(wall_time=wall_time, loader_cycles=loader_cycles,
+                search_attempts=search_attempts)
+
+
+def check_loader(script_filename, command, logger):
+    """
+    Report the dynamic loader's startup time for a test binary using an
+    activation script
+    """
+    print(f'Measuring loader startup time for {command}')
+    result = measure_loader(f'source {script_filename} &> /dev/null', command)
+    wall_time = result['wall_time']
+    wall_time = 'unknown' if wall_time is None else f'{wall_time:.3f} s'
+    cycles = result['loader_cycles']
+    cycles = 'unknown' if cycles is None else f'{cycles:,}'
+    log_message(logger,
+                f'Loader startup for "{command}": {wall_time} wall time, '
+                f'{cycles} loader cycles, '
+                f'{result["search_attempts"]} library search attempts')
+    return result
@@ -0,0 +1,171 @@
+import glob
+import hashlib
+import os
+
+from artifacts import get_artifact_filename, pack_env
+from shared import log_message
+
+
+def get_env_key(env_path):
+    """
+    Get a hash of the contents of a conda environment: the conda history
+    (which records every change conda has made, including packages that
+    were reinstalled or changed without a new version or build) and the
+    packages installed with pip by the deployment
+    """
+    sha256 = hashlib.sha256()
+    conda_meta = os.path.join(env_path, 'conda-meta')
+    with open(os.path.join(conda_meta, 'history'), 'rb') as f:
+        sha256.update(f.read())
+    for filename in sorted(os.listdir(conda_meta)):
+        if filename.startswith('polaris_') and filename.endswith('.txt'):
+            # the hashes of polaris, mache, etc. installed with pip
+            with open(os.path.join(conda_meta, filename), 'rb') as f:
+                sha256.update(f.read())
+    return sha256.hexdigest()
+
+
+def pack_node_local_env(config, env_type, conda_base, env_name, env_path,
+                        logger):
+    """
+    Pack a conda environment so load scripts can unpack it on node-local
+    storage, unless an archive of the same contents already exists
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    env_type : {'dev', 'test_release', 'release'}
+        The type of environment
+
+    conda_base : str
+        The conda base, where the archives are kept in ``node_local``
+
+    env_name : str
+        The name of the conda environment
+
+    env_path : str
+        The path to the conda environment
+
+    logger : logging.Logger
+        A logger for output from the deployment
+
+    Returns
+    -------
+    archive : dict or None
+        The ``filename`` and ``key`` of the archive, and the ``size_kb`` of
+        the unpacked environment, or ``None`` if node-local staging is
+        disabled (for this type of environment)
+    """
+    if not config.getboolean('node_local_env', 'enabled'):
+        return None
+    if env_type == 'dev' and \
+            config.getboolean('node_local_env', 'shared_only'):
+        return None
+
+    key = get_env_key(env_path)
+    archive_dir = os.path.join(conda_base, 'node_local')
+    filename = get_artifact_filename(archive_dir, env_name, key)
+    if os.path.exists(filename) and os.path.exists(f'{filename}.sha256'):
+        log_message(logger, f'{env_name} is unchanged since it was packed '
+                            f'into {filename}')
+    else:
+        # the environment may have editable packages like polaris itself,
+        # which are left pointing at their source
+        pack_env(env_path, filename, logger, ignore_editable=True)
+        # older archives of this environment are no longer used by new load
+        # scripts
+        pattern = get_artifact_filename(archive_dir, env_name, '*')
+        for old_filename in glob.glob(pattern):
+            if old_filename != filename:
+                for path in [old_filename, f'{old_filename}.sha256']:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    return dict(filename=filename, key=key, size_kb=_get_size_kb(env_path))
+
+
+def get_node_local_activation(config, env_name, archive):
+    """
+    Get the commands for a load script that unpack a conda environment on
+    node-local storage (once per node for each version of the environment)
+    and activate it, falling back on the shared environment if there is no
+    suitable node-local directory or the environment can't be unpacked
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    env_name : str
+        The name of the shared conda environment
+
+    archive : dict
+        The archive from ``pack_node_local_env()``
+
+    Returns
+    -------
+    script : str
+        The commands for the load script
+    """
+    dirs = config.get('node_local_env', 'dirs').replace(',', ' ').split()
+    only_in_jobs = config.getboolean('node_local_env', 'only_in_jobs')
+    local_name = f'{env_name}_{archive["key"][:16]}'
+    filename = archive['filename']
+
+    if only_in_jobs:
+        condition = '-n "${SLURM_JOB_ID:-${PBS_JOBID:-}}" && ' \
+                    '-z "${POLARIS_NO_NODE_LOCAL_ENV:-}"'
+    else:
+        condition = '-z "${POLARIS_NO_NODE_LOCAL_ENV:-}"'
+
+    # the lock makes other tasks on the same node wait while one unpacks
+    # the environment, and a partly unpacked environment (without
+    # .complete) is unpacked again
+    return f"""
+        polaris_local_env=""
+        if [[ {condition} && -f {filename} ]]; then
+           for polaris_local_dir in {' '.join(dirs)}; do
+              if [[ -d ${{polaris_local_dir}} && -w ${{polaris_local_dir}} ]] && \\
+                    (( $(df -Pk ${{polaris_local_dir}} | awk 'NR==2 {{print $4}}') > {archive['size_kb']} )); then
+                 polaris_local_env=${{polaris_local_dir}}/polaris_envs_${{USER:-$(id -un)}}/{local_name}
+                 break
+              fi
+           done
+        fi
+        if [[ -n "${{polaris_local_env}}" ]]; then
+           mkdir -p $(dirname ${{polaris_local_env}})
+           (
+              flock 9
+              if [[ ! -f ${{polaris_local_env}}/.complete ]]; then
+                 echo Unpacking conda environment in ${{polaris_local_env}}
+                 rm -rf ${{polaris_local_env}}
+                 mkdir -p ${{polaris_local_env}} && \\
+                    tar -xzf {filename} -C ${{polaris_local_env}} && \\
+                    (source ${{polaris_local_env}}/bin/activate && conda-unpack) && \\
+                    touch ${{polaris_local_env}}/.complete
+              fi
+           ) 9> ${{polaris_local_env}}.lock
+        fi
+        if [[ -n "${{polaris_local_env}}" && -f ${{polaris_local_env}}/.complete ]]; then
+           mamba activate ${{polaris_local_env}}
+        else
+           mamba activate {env_name}
+        fi
+        unset polaris_local_dir
+        unset polaris_local_env
+        """  # noqa: E501
+
+
+def _get_size_kb(env_path):
+    size = 0
+    for root, _, files in os.walk(env_path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size // 1024
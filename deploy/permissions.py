@@ -0,0 +1,193 @@
+import glob
+import grp
+import os
+import shutil
+import stat
+import subprocess
+
+from shared import log_message
+
+READ_PERM = (stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP |
+             stat.S_IROTH)
+EXEC_PERM = (stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP |
+             stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+# new directories in a setgid directory inherit its group (and the setgid
+# bit), so files created in them get the right group without a chown
+DIR_PERM = EXEC_PERM | stat.S_ISGID
+MASK = stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO
+DIR_MASK = MASK | stat.S_ISGID
+
+
+def get_group_id(config):
+    """
+    Get the ID of the group that shared environments belong to, from the
+    ``group`` option in ``[e3sm_unified]``, or ``None`` if there is no group
+    """
+    if not config.has_option('e3sm_unified', 'group'):
+        return None
+    return grp.getgrnam(config.get('e3sm_unified', 'group')).gr_gid
+
+
+def prepare_permissions(config, directory, logger):
+    """
+    Set up a shared directory before building in it, so that new files and
+    directories get the group and permissions that ``update_permissions()``
+    would otherwise have to fix one by one afterwards.  The directory is
+    given the group and made setgid so new files and directories inherit
+    the group.  Where ``setfacl`` is available, a default ACL gives new
+    files group write permission regardless of the umask of the processes
+    creating them.  The umask of this process (and so of the conda and
+    spack processes it starts) is set to match.
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    directory : str
+        The shared directory, such as the conda or spack base
+
+    logger : logging.Logger
+        A logger for output from the deployment
+    """
+    gid = get_group_id(config)
+    if gid is None:
+        return
+
+    os.umask(~EXEC_PERM & MASK)
+
+    os.makedirs(directory, exist_ok=True)
+    dir_stat = os.stat(directory)
+    if dir_stat.st_uid != os.getuid():
+        # only the owner can change the group and mode
+        return
+    if dir_stat.st_gid != gid or dir_stat.st_mode & DIR_MASK != DIR_PERM:
+        os.chown(directory, -1, gid)
+        os.chmod(directory, DIR_PERM)
+
+    if shutil.which('setfacl') is not None:
+        # X only gives execute permission to directories and files that are
+        # already executable
+        process = subprocess.run(
+            ['setfacl', '-d', '-m', 'u::rwX,g::rwX,o::rX', directory],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            # some file systems don't support ACLs, which is fine
+            log_message(logger, f'Could not set a default ACL on '
+                                f'{directory}: '
+                                f'{process.stderr.decode("utf-8").strip()}')
+
+
+def update_permissions(config, env_type, activ_path, directories):
+    """
+    Make sure the activation scripts and everything in the shared
+    directories belong to the group and have the right permissions.  After
+    ``prepare_permissions()``, this is usually just a check, and only the
+    files and directories that need it are changed.
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    env_type : {'dev', 'test_release', 'release'}
+        The type of environment
+
+    activ_path : str
+        The directory with the activation scripts
+
+    directories : list of str
+        The shared directories, such as the conda and spack bases
+    """
+    new_gid = get_group_id(config)
+    if new_gid is None:
+        return
+
+    new_uid = os.getuid()
+
+    print('changing permissions on activation scripts')
+
+    if env_type != 'dev':
+
+        activation_files = glob.glob('{}/*_polaris*.sh'.format(
+            activ_path))
+        for file_name in activation_files:
+            os.chmod(file_name, READ_PERM)
+            os.chown(file_name, new_uid, new_gid)
+
+    print('checking permissions on environments')
+
+    changes = _find_permission_changes(directories, new_uid, new_gid)
+    if len(changes) == 0:
+        print('  nothing to change.')
+        return
+
+    print(f'changing permissions on {len(changes)} files and directories')
+
+    # imported here because there is usually nothing to change
+    import progressbar
+
+    widgets = [progressbar.Percentage(), ' ', progressbar.Bar(),
+               ' ', progressbar.ETA()]
+    bar = progressbar.ProgressBar(widgets=widgets,
+                                  maxval=len(changes)).start()
+    for progress, (path, new_perm) in enumerate(changes):
+        try:
+            bar.update(progress + 1)
+        except ValueError:
+            pass
+        try:
+            os.chown(path, new_uid, new_gid)
+            os.chmod(path, new_perm)
+        except OSError:
+            continue
+
+    bar.finish()
+    print('  done.')
+
+
+def _find_permission_changes(directories, uid, gid):
+    """
+    Find the files and directories owned by the current user that don't
+    have the right group or permissions, and the permissions they should
+    have
+    """
+    changes: list = list()
+    # first the base directories that aren't included in os.walk()
+    for directory in dict.fromkeys(directories):
+        _check_path(directory, True, uid, gid, changes)
+
+    for base in dict.fromkeys(directories):
+        for root, dirs, files in os.walk(base):
+            for directory in dirs:
+                _check_path(os.path.join(root, directory), True, uid, gid,
+                            changes)
+            for file_name in files:
+                _check_path(os.path.join(root, file_name), False, uid, gid,
+                            changes)
+    return changes
+
+
+def _check_path(path, is_dir, uid, gid, changes):
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return
+
+    if path_stat.st_uid != uid:
+        # current user doesn't own this so let's move on
+        return
+
+    if is_dir:
+        perm = path_stat.st_mode & DIR_MASK
+        new_perm = DIR_PERM
+    else:
+        perm = path_stat.st_mode & MASK
+        if perm & stat.S_IXUSR:
+            # executable, so make sure others can execute it
+            new_perm = EXEC_PERM
+        else:
+            new_perm = READ_PERM
+
+    if perm != new_perm or path_stat.st_gid != gid:
+        changes.append((path, new_perm))
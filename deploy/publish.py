@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import json
+import os
+import re
+
+from shared import DeployLock
+
+
+def load_generations(activ_path):
+    """
+    Load the generations of shared conda and spack environments that have
+    been published in a directory of activation scripts
+
+    Parameters
+    ----------
+    activ_path : str
+        The directory with the activation scripts
+
+    Returns
+    -------
+    generations : dict
+        The ``current``, ``previous`` and ``staged`` generation of each
+        ``conda`` and ``spack`` environment
+    """
+    filename = _get_generations_filename(activ_path)
+    if os.path.exists(filename):
+        with open(filename) as f:
+            generations = json.load(f)
+    else:
+        generations = dict()
+    for kind in ['conda', 'spack']:
+        generations.setdefault(kind, dict())
+    return generations
+
+
+def generations_lock(activ_path, purpose, logger=None):
+    """
+    Get an exclusive lock on the generations published in a directory of
+    activation scripts.  A deployment holds it from ``load_generations()``
+    through ``commit_generations()`` so concurrent deployments don't lose
+    each other's generations.
+
+    Parameters
+    ----------
+    activ_path : str
+        The directory with the activation scripts
+
+    purpose : str
+        What the lock is held for, reported to anyone waiting for it
+
+    logger : logging.Logger, optional
+        A logger for messages about waiting for the lock
+
+    Returns
+    -------
+    lock : DeployLock
+        The lock, which has not yet been acquired
+    """
+    return DeployLock(activ_path, 'generations', purpose, logger=logger)
+
+
+def get_generation_name(name, generation):
+    """
+    Get the name of a generation of an environment.  The first generation
+    has the original name so existing environments remain the same.
+    """
+    if generation == 0:
+        return name
+    return f'{name}_g{generation}'
+
+
+def stage_generation(generations, kind, name, env_root, rebuild):
+    """
+    Choose the generation of an environment to build.  If the current
+    generation exists and is to be rebuilt, a new generation is staged
+    alongside it so the current one is untouched until the new one is
+    published.
+
+    Parameters
+    ----------
+    generations : dict
+        The generations from ``load_generations()``
+
+    kind : {'conda', 'spack'}
+        The kind of environment
+
+    name : str
+        The name of the environment without a generation suffix
+
+    env_root : str
+        The directory containing environments of this kind
+
+    rebuild : bool
+        Whether the environment is being recreated or updated
+
+    Returns
+    -------
+    staged_name : str
+        The name of the environment to build
+    """
+    entry = generations[kind].setdefault(
+        name, dict(current=0, previous=None))
+    if entry.get('staged') is None:
+        current_name = get_generation_name(name, entry['current'])
+        exists = os.path.exists(os.path.join(env_root, current_name))
+        if exists and rebuild:
+            # after a rollback, the previous generation may be newer than
+            # the current one
+            latest = max(entry['current'], entry['previous'] or 0)
+            entry['staged'] = latest + 1
+        else:
+            entry['staged'] = entry['current']
+    return get_generation_name(name, entry['staged'])
+
+
+def unstage_generation(generations, kind, name):
+    """
+    Drop the staged generation of an environment that failed to build, so
+    the current generation stays current when the others are committed
+
+    Parameters
+    ----------
+    generations : dict
+        The generations from ``load_generations()``
+
+    kind : {'conda', 'spack'}
+        The kind of environment
+
+    name : str
+        The name of the environment without a generation suffix
+    """
+    entry = generations[kind].get(name)
+    if entry is not None:
+        entry.pop('staged', None)
+
+
+def commit_generations(generations, activ_path, published=None):
+    """
+    Make the staged generations current after their activation scripts
+    have been published, keeping the previous generation for rollback
+
+    Parameters
+    ----------
+    generations : dict
+        The generations from ``load_generations()``
+
+    activ_path : str
+        The directory with the activation scripts
+
+    published : set of tuple, optional
+        The ``(kind, name)`` of each environment used by a published
+        activation script.  If given, other staged generations are dropped
+        and their current generations stay current.
+
+    Returns
+    -------
+    retired : dict
+        Lists of ``conda`` and ``spack`` environments that are no longer
+        the current or previous generation and are not used by any
+        activation script, so they can be removed
+    """
+    retired: dict = dict(conda=list(), spack=list())
+    for kind in ['conda', 'spack']:
+        for name, entry in generations[kind].items():
+            staged = entry.pop('staged', None)
+            if staged is None or staged == entry['current']:
+                continue
+            if published is not None and (kind, name) not in published:
+                continue
+            old = entry['previous']
+            entry['previous'] = entry['current']
+            entry['current'] = staged
+            if old is None:
+                continue
+            old_name = get_generation_name(name, old)
+            if not _is_referenced(activ_path, old_name):
+                retired[kind].append(old_name)
+
+    _write_atomic(_get_generations_filename(activ_path),
+                  json.dumps(generations, indent=2))
+    return retired
+
+
+def get_staging_filename(filename):
+    """
+    Get the name of the file that an activation script is written to before
+    it is checked and published
+    """
+    return f'{filename}.staging'
+
+
+def publish_file(staged_filename, filename):
+    """
+    Atomically replace a file with a staged copy, keeping the old file as
+    ``<filename>.previous`` for rollback.  Anyone sourcing the file sees
+    either the old or the new version, never a partial one.
+    """
+    if os.path.exists(filename):
+        _replace_with_link(filename, f'{filename}.previous')
+    os.replace(staged_filename, filename)
+
+
+def publish_symlink(target, link):
+    """
+    Atomically point a symlink at a new target
+    """
+    tmp_link = f'{link}.tmp{os.getpid()}'
+    try:
+        os.remove(tmp_link)
+    except OSError:
+        pass
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link)
+
+
+def rollback(filename):
+    """
+    Swap an activation script with its previous version, and make the
+    generations of environments it uses current again so they aren't
+    retired by the next deployment
+
+    Parameters
+    ----------
+    filename : str
+        The activation script to roll back (or a symlink to it)
+    """
+    filename = os.path.realpath(filename)
+    previous = f'{filename}.previous'
+    if not os.path.exists(previous):
+        raise FileNotFoundError(f'No previous version of {filename} to roll '
+                                f'back to')
+    activ_path = os.path.dirname(filename)
+    with generations_lock(activ_path,
+                          f'rolling back {os.path.basename(filename)}'):
+        tmp_filename = f'{filename}.tmp{os.getpid()}'
+        _replace_with_link(filename, tmp_filename)
+        os.replace(previous, filename)
+        os.replace(tmp_filename, previous)
+
+        if not os.path.exists(_get_generations_filename(activ_path)):
+            return
+        with open(filename) as f:
+            content = f.read()
+        generations = load_generations(activ_path)
+        for kind in ['conda', 'spack']:
+            for name, entry in generations[kind].items():
+                restored = entry['previous']
+                if restored is None:
+                    continue
+                restored_name = get_generation_name(name, restored)
+                pattern = rf'\b{re.escape(restored_name)}\b'
+                if re.search(pattern, content) is not None:
+                    entry['previous'] = entry['current']
+                    entry['current'] = restored
+        _write_atomic(_get_generations_filename(activ_path),
+                      json.dumps(generations, indent=2))
+
+
+def _get_generations_filename(activ_path):
+    return os.path.join(activ_path, '.polaris_generations.json')
+
+
+def _is_referenced(activ_path, env_name):
+    pattern = re.compile(rf'\b{re.escape(env_name)}\b')
+    for filename in glob.glob(os.path.join(activ_path, '*_polaris*')):
+        if os.path.islink(filename) or not os.path.isfile(filename):
+            continue
+        with open(filename) as f:
+            if pattern.search(f.read()):
+                return True
+    return False
+
+
+def _replace_with_link(filename, link_filename):
+    # a hard link keeps the old file (and its permissions) without a moment
+    # where either name is missing
+    tmp_filename = f'{link_filename}.tmp{os.getpid()}'
+    try:
+        os.remove(tmp_filename)
+    except OSError:
+        pass
+    os.link(filename, tmp_filename)
+    os.replace(tmp_filename, link_filename)
+
+
+def _write_atomic(filename, content):
+    tmp_filename = f'{filename}.tmp{os.getpid()}'
+    with open(tmp_filename, 'w') as f:
+        f.write(content)
+    os.replace(tmp_filename, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Roll back published polaris activation scripts to the '
+                    'previous generation of their environments')
+    parser.add_argument('scripts', nargs='+',
+                        help='The activation scripts to roll back')
+    args = parser.parse_args()
+    for filename in args.scripts:
+        rollback(filename)
+        print(f'Rolled back {filename}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+import glob
+import json
+import os
+import re
+
+from history import record_timing
+from shared import check_call, log_message
+
+
+def reconcile_conda_env(env_path, env_name, specs, activate_base, channels,
+                        logger, history=None):
+    """
+    Bring an existing conda environment in line with the requested specs by
+    installing, updating or removing only the packages that differ, rather
+    than solving for the full spec again.  All the requested specs are
+    passed to ``mamba install`` as constraints with ``--freeze-installed``,
+    so packages that already match stay as they are, and packages that are
+    no longer requested are only removed if nothing else depends on them.
+    The environment is checked against the specs afterwards.
+
+    Parameters
+    ----------
+    env_path : str
+        The path to the conda environment
+
+    env_name : str
+        The name of the conda environment
+
+    specs : list of str
+        The requested conda match specs (e.g. ``esmf=8.2.0=nompi_*``)
+
+    activate_base : str
+        Commands to activate the conda base environment
+
+    channels : str
+        The channel arguments for ``mamba install``
+
+    logger : logging.Logger
+        A logger for output from the deployment
+
+    history : history.DeployHistory, optional
+        The deployment history, to which the time of each mamba solve is
+        added as a ``mamba_solves`` metric
+
+    Returns
+    -------
+    changes : dict
+        The specs that were ``installed`` (new or updated) and the package
+        names that were ``removed``
+    """
+    installed = get_installed_packages(env_path)
+    previous = read_requested_specs(env_path)
+    changes = get_changes(specs, installed, previous)
+
+    kept = get_dependencies(installed, changes['remove'])
+    for name in kept:
+        log_message(logger, f'Keeping {name}, which is no longer requested '
+                            f'but other packages depend on')
+    changes['remove'] = [name for name in changes['remove']
+                         if name not in kept]
+
+    if len(changes['install']) > 0:
+        # the unchanged specs keep the solver from moving packages off
+        # their pins
+        quoted = ' '.join(f'"{spec}"' for spec in specs)
+        commands = f'{activate_base} && ' \
+                   f'mamba install -y -n {env_name} {channels} ' \
+                   f'--freeze-installed {quoted}'
+        with record_timing(history, 'mamba_solves', command='install'):
+            check_call(commands, logger=logger)
+
+    if len(changes['remove']) > 0:
+        # --force removes just these packages, not the packages that
+        # depend on them (there are none left, see above)
+        commands = f'{activate_base} && ' \
+                   f'mamba remove -y -n {env_name} --force ' \
+                   f'{" ".join(changes["remove"])}'
+        with record_timing(history, 'mamba_solves', command='remove'):
+            check_call(commands, logger=logger)
+
+    installed = get_installed_packages(env_path)
+    mismatched = get_changes(specs, installed, list())['install']
+    if len(mismatched) > 0:
+        raise ValueError(f'Reconciling {env_name} left packages that don\'t '
+                         f'match the requested specs: '
+                         f'{", ".join(mismatched)}')
+    leftover = [name for name in changes['remove'] if name in installed]
+    if len(leftover) > 0:
+        raise ValueError(f'Reconciling {env_name} failed to remove: '
+                         f'{", ".join(leftover)}')
+
+    write_requested_specs(env_path, specs)
+
+    if len(changes['install']) == 0 and len(changes['remove']) == 0:
+        log_message(logger, f'{env_name} already matches the requested '
+                            f'packages')
+    else:
+        message = f'Reconciled {env_name}:'
+        for spec in changes['install']:
+            message = f'{message}\n  installed or updated: {spec}'
+        for name in changes['remove']:
+            message = f'{message}\n  removed: {name}'
+        log_message(logger, message)
+    print(f'Reconciled {env_name}: {len(changes["install"])} installed or '
+          f'updated, {len(changes["remove"])} removed\n')
+
+    return changes
+
+
+def get_changes(specs, installed, previous):
+    """
+    Find the specs that aren't satisfied by the installed packages and the
+    packages that were requested before but no longer are
+
+    Parameters
+    ----------
+    specs : list of str
+        The requested conda match specs
+
+    installed : dict
+        The ``version`` and ``build`` of each installed package
+
+    previous : list of str
+        The specs requested when the environment was last built
+
+    Returns
+    -------
+    changes : dict
+        The specs to ``install`` and the package names to ``remove``
+    """
+    install = list()
+    requested = set()
+    for spec in specs:
+        name, version, build = parse_match_spec(spec)
+        requested.add(name)
+        record = installed.get(name)
+        if record is None or \
+                not version_matches(record['version'], version) or \
+                not _glob_matches(record['build'], build):
+            install.append(spec)
+
+    remove = list()
+    for spec in previous:
+        name = parse_match_spec(spec)[0]
+        if name not in requested and name in installed and \
+                name not in remove:
+            remove.append(name)
+
+    return dict(install=install, remove=remove)
+
+
+def get_dependencies(installed, names):
+    """
+    Find which of the given packages other installed packages (not among
+    those given) depend on
+    """
+    depended_on = set()
+    for name, record in installed.items():
+        if name not in names:
+            depended_on.update(record['depends'])
+    return [name for name in names if name in depended_on]
+
+
+def get_installed_packages(env_path):
+    """
+    Read the installed packages from the ``conda-meta`` records of an
+    environment, which is much faster than ``conda list``
+    """
+    installed = dict()
+    for filename in glob.glob(os.path.join(env_path, 'conda-meta',
+                                           '*.json')):
+        with open(filename) as f:
+            record = json.load(f)
+        # dependencies are match specs like "python >=3.9,<3.10.0a0"
+        depends = [dependency.split()[0]
+                   for dependency in record.get('depends', list())
+                   if dependency.strip() != '']
+        installed[record['name']] = dict(version=record['version'],
+                                         build=record['build'],
+                                         depends=depends)
+    return installed
+
+
+def read_spec_file(filename):
+    """
+    Read the match specs from a conda spec file
+    """
+    specs = list()
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line != '':
+                specs.append(line)
+    return specs
+
+
+def read_requested_specs(env_path):
+    filename = _get_requested_filename(env_path)
+    if not os.path.exists(filename):
+        return list()
+    return read_spec_file(filename)
+
+
+def write_requested_specs(env_path, specs):
+    """
+    Record the specs an environment was built with, so packages that are
+    dropped from the spec later can be removed
+    """
+    with open(_get_requested_filename(env_path), 'w') as f:
+        f.write('\n'.join(specs))
+        f.write('\n')
+
+
+def parse_match_spec(spec):
+    """
+    Split a conda match spec into its name, version constraint and build
+    string (``None`` if not given)
+    """
+    spec = spec.strip().strip('"').strip("'").replace(' ', '')
+    # e.g. conda-forge::ffmpeg
+    spec = spec.split('::')[-1]
+    match = re.match(r'^([A-Za-z0-9_.\-]+)(.*)$', spec)
+    if match is None:
+        raise ValueError(f'Could not parse conda spec: {spec}')
+    name, rest = match.groups()
+    if rest == '':
+        return name, None, None
+    if rest.startswith('=') and not rest.startswith('=='):
+        parts = rest[1:].split('=', 1)
+        version = parts[0]
+        build = parts[1] if len(parts) > 1 else None
+        if not version.endswith('*') and version != '*':
+            # "=1.2" means "1.2.*" in conda
+            version = f'{version}*'
+        return name, version, build
+    return name, rest, None
+
+
+def version_matches(version, constraint):
+    """
+    Whether a version satisfies a conda version constraint like ``1.2*``,
+    ``>=2.0,<3.0`` or ``==1.0``
+    """
+    if constraint is None or constraint in ['', '*']:
+        return True
+    if '|' in constraint:
+        return any(version_matches(version, part) for part in
+                   constraint.split('|'))
+    for part in constraint.split(','):
+        match = re.match(r'^(>=|<=|==|!=|>|<)?(.*)$', part)
+        if match is None:
+            raise ValueError(f'Could not parse version constraint: {part}')
+        op, target = match.groups()
+        if op is None:
+            if not _version_glob_matches(version, target):
+                return False
+            continue
+        if op in ['==', '!='] and '*' in target:
+            matches = _version_glob_matches(version, target)
+            if matches != (op == '=='):
+                return False
+            continue
+        comparison = _compare_versions(version, target)
+        if not {'>=': comparison >= 0, '<=': comparison <= 0,
+                '==': comparison == 0, '!=': comparison != 0,
+                '>': comparison > 0, '<': comparison < 0}[op]:
+            return False
+    return True
+
+
+def _version_glob_matches(version, pattern):
+    if '*' not in pattern:
+        return _compare_versions(version, pattern) == 0
+    prefix = pattern.rstrip('*').rstrip('.')
+    if prefix == '':
+        return True
+    if '*' in prefix:
+        return _glob_matches(version, pattern)
+    # compare components, so 1.16.0* matches 1.16.0rc1 and 1.16.0.1 but not
+    # 1.16.01 or 1.160
+    prefix_parts = _split_version(prefix)
+    return _split_version(version)[:len(prefix_parts)] == prefix_parts
+
+
+def _glob_matches(value, pattern):
+    if pattern is None:
+        return True
+    regex = '^' + '.*'.join(re.escape(part) for part in pattern.split('*'))
+    return re.match(f'{regex}$', value) is not None
+
+
+def _compare_versions(first, second):
+    first_parts = _split_version(first)
+    second_parts = _split_version(second)
+    length = max(len(first_parts), len(second_parts))
+    first_parts.extend([0] * (length - len(first_parts)))
+    second_parts.extend([0] * (length - len(second_parts)))
+    for a, b in zip(first_parts, second_parts):
+        if a == b:
+            continue
+        if isinstance(a, int) and isinstance(b, int):
+            return -1 if a < b else 1
+        # numbers sort after strings like "rc" or "dev" (pre-releases)
+        if isinstance(a, int):
+            return 1
+        if isinstance(b, int):
+            return -1
+        return -1 if a < b else 1
+    return 0
+
+
+def _split_version(version):
+    parts: list = list()
+    for part in re.findall(r'\d+|[A-Za-z]+', version):
+        parts.append(int(part) if part.isdigit() else part.lower())
+    return parts
+
+
+def _get_requested_filename(env_path):
+    # conda only reads the *.json files in conda-meta
+    return os.path.join(env_path, 'conda-meta', 'polaris_requested_specs.txt')
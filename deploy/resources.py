@@ -0,0 +1,356 @@
+import os
+import resource
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from shared import log_message
+
+
+def get_node_resources(tmpdir=None, staging_size_gb=0.):
+    """
+    Detect the cores, memory and temporary disk space available on this node
+
+    Parameters
+    ----------
+    tmpdir : str, optional
+        The temporary directory spack will build in (the system's temporary
+        directory by default)
+
+    staging_size_gb : float, optional
+        The space in GB that staging and building will take up in
+        ``tmpdir``.  If ``tmpdir`` is in memory (e.g. ``/dev/shm``), this is
+        subtracted from the available memory.
+
+    Returns
+    -------
+    resources : dict
+        The number of ``cores`` this process may use, the available memory
+        ``memory_gb`` in GB, the ``tmpdir``, its free space
+        ``tmpdir_free_gb`` in GB and whether it is ``tmpdir_in_memory``
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+
+    if tmpdir is None:
+        tmpdir = tempfile.gettempdir()
+
+    memory_gb = _get_available_memory_gb()
+    in_memory = is_memory_backed(tmpdir)
+    if in_memory:
+        # MemAvailable doesn't yet include the staged builds
+        memory_gb = max(0., memory_gb - staging_size_gb)
+
+    return dict(cores=cores, memory_gb=memory_gb, tmpdir=tmpdir,
+                tmpdir_free_gb=shutil.disk_usage(tmpdir).free / 1024**3,
+                tmpdir_in_memory=in_memory)
+
+
+def is_memory_backed(path):
+    """
+    Whether a directory is on a file system in memory (``tmpfs`` or
+    ``ramfs``), like ``/dev/shm`` and, on some systems, ``/tmp``
+    """
+    path = os.path.realpath(path)
+    fs_type = None
+    mount_point = ''
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                # the longest mount point containing the path is the one
+                # the path is on
+                mount = parts[1]
+                if (path == mount or
+                        path.startswith(f'{mount.rstrip("/")}/')) and \
+                        len(mount) >= len(mount_point):
+                    mount_point = mount
+                    fs_type = parts[2]
+    except OSError:
+        return False
+    return fs_type in ['tmpfs', 'ramfs']
+
+
+def get_staging_size_gb(config, specs):
+    """
+    Get the estimated space in GB needed to stage and build the given spack
+    specs from the ``staging_size_gb`` and ``heavy_staging_size_gb`` options
+    in the ``[spack_build]`` config section
+    """
+    section = config['spack_build']
+    heavy_count = len(_get_heavy_packages(section, specs))
+    return section.getfloat('staging_size_gb') + \
+        heavy_count * section.getfloat('heavy_staging_size_gb')
+
+
+def get_concurrent_installs(config, resources):
+    """
+    Get the number of spack installs that can run at the same time on this
+    node from the ``concurrent_installs`` and ``cores_per_install`` options
+    in the ``[spack_build]`` config section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    resources : dict
+        The resources from ``get_node_resources()``
+
+    Returns
+    -------
+    concurrent_installs : int
+        The number of concurrent spack installs
+    """
+    option = config.get('spack_build', 'concurrent_installs')
+    if option != 'auto':
+        return max(1, int(option))
+
+    cores_per_install = config.getint('spack_build', 'cores_per_install')
+    memory_per_job = config.getfloat('spack_build', 'memory_per_job')
+    by_cores = resources['cores'] // cores_per_install
+    by_memory = int(resources['memory_gb'] //
+                    (cores_per_install * memory_per_job))
+    return max(1, min(by_cores, by_memory))
+
+
+def get_build_jobs(config, resources, specs, concurrent_installs=1):
+    """
+    Get the number of parallel jobs (``-j``) for each spack install from the
+    cores and memory available to it
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    resources : dict
+        The resources from ``get_node_resources()``
+
+    specs : list of str
+        The spack specs to be installed
+
+    concurrent_installs : int, optional
+        The number of spack installs sharing this node
+
+    Returns
+    -------
+    build_jobs : int
+        The number of parallel jobs for each spack install
+
+    memory_per_job : float
+        The memory in GB allowed for each of these jobs
+    """
+    section = config['spack_build']
+
+    memory_per_job = section.getfloat('memory_per_job')
+    if len(_get_heavy_packages(section, specs)) > 0:
+        # spack uses the same -j for every package in an install, so the
+        # memory-hungry packages set the limit for all of them
+        memory_per_job = section.getfloat('memory_per_heavy_job')
+
+    option = section.get('build_jobs')
+    if option != 'auto':
+        return max(1, int(option)), memory_per_job
+
+    cores = resources['cores'] // concurrent_installs
+    memory_gb = resources['memory_gb'] / concurrent_installs
+    build_jobs = min(cores, int(memory_gb // memory_per_job))
+    return max(1, build_jobs), memory_per_job
+
+
+@contextmanager
+def spack_staging_dir(config, tmpdir, specs, logger=None):
+    """
+    A context manager that finds a fast, node-local directory with enough
+    free space for staging and building spack packages if no ``tmpdir`` was
+    given, and deletes it afterwards
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    tmpdir : str or None
+        A temporary directory supplied by the user with ``--tmpdir``, which
+        is used as is
+
+    specs : list of str
+        The spack specs to be installed
+
+    logger : logging.Logger, optional
+        A logger for output from the deployment
+
+    Yields
+    ------
+    staging_dir : str or None
+        The directory to stage and build in, or ``None`` to leave the choice
+        to spack if no candidate directory had enough space
+    """
+    if tmpdir is not None:
+        yield tmpdir
+        return
+
+    section = config['spack_build']
+    required_gb = get_staging_size_gb(config, specs)
+
+    staging_dir = None
+    candidates = section.get('staging_dirs').replace(',', ' ').split()
+    for candidate in candidates:
+        candidate = os.path.expandvars(os.path.expanduser(candidate))
+        try:
+            free_gb = shutil.disk_usage(candidate).free / 1024**3
+        except OSError:
+            continue
+        if free_gb < required_gb:
+            log_message(logger,
+                        f'Skipping {candidate} for spack staging: '
+                        f'{free_gb:.1f} GB free but about {required_gb:.1f} '
+                        f'GB needed')
+            continue
+        if is_memory_backed(candidate):
+            memory_gb = _get_available_memory_gb()
+            # leave at least enough memory for one build job
+            if memory_gb - required_gb < section.getfloat('memory_per_job'):
+                log_message(logger,
+                            f'Skipping {candidate} for spack staging: it is '
+                            f'in memory and {memory_gb:.1f} GB is available '
+                            f'but about {required_gb:.1f} GB is needed for '
+                            f'staging')
+                continue
+        try:
+            staging_dir = tempfile.mkdtemp(prefix='polaris_spack_',
+                                           dir=candidate)
+        except OSError:
+            continue
+        break
+
+    if staging_dir is None:
+        log_message(logger,
+                    'No node-local directory has enough space for spack '
+                    'staging, leaving the choice to spack')
+    else:
+        log_message(logger, f'Staging spack builds in {staging_dir}')
+
+    try:
+        yield staging_dir
+    finally:
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+@contextmanager
+def spack_build_jobs(build_jobs, upstreams=None, logger=None):
+    """
+    A context manager that makes a temporary spack user config scope with
+    ``config:build_jobs`` and, optionally, upstream install trees added to a
+    copy of the deployer's own user config (e.g. the mirrors, compilers and
+    proxies in ``~/.spack``).  mache runs spack itself, so the setting can't
+    be passed with ``spack -c`` or an extra ``-C`` scope.  Instead, the
+    environment for the process running spack points at the scope, leaving
+    the environment of this process (which may be shared with other
+    threads) alone.
+
+    Parameters
+    ----------
+    build_jobs : int
+        The number of parallel jobs for each package spack installs
+
+    upstreams : dict, optional
+        Install trees whose packages spack should reuse rather than build,
+        with names as keys
+
+    logger : logging.Logger, optional
+        A logger for output from the deployment
+
+    Yields
+    ------
+    env : dict
+        The environment variables for the process running spack
+    """
+    original = os.environ.get('SPACK_USER_CONFIG_PATH')
+    user_scope = os.path.expanduser(
+        original if original is not None else '~/.spack')
+    with tempfile.TemporaryDirectory(prefix='spack_config_') as tmpdir:
+        config_path = os.path.join(tmpdir, 'user')
+        if os.path.isdir(user_scope):
+            shutil.copytree(user_scope, config_path,
+                            ignore=_ignore_non_config)
+            log_message(logger, f'Using the spack user config in '
+                                f'{user_scope} with build_jobs: '
+                                f'{build_jobs}')
+        else:
+            os.makedirs(config_path)
+        _update_spack_config(os.path.join(config_path, 'config.yaml'),
+                             'config', dict(build_jobs=build_jobs))
+        if upstreams:
+            _update_spack_config(
+                os.path.join(config_path, 'upstreams.yaml'), 'upstreams',
+                {name: dict(install_tree=install_tree)
+                 for name, install_tree in upstreams.items()})
+        yield dict(os.environ, SPACK_USER_CONFIG_PATH=config_path)
+
+
+def get_peak_child_memory_gb():
+    """
+    Get the peak resident memory of the largest child process that has
+    finished so far, in GB
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024**2
+
+
+def _ignore_non_config(directory, names):
+    # only config files (at the top level and in platform subdirectories
+    # like linux) are copied, not caches or bootstrapped tools
+    ignore = list()
+    for name in names:
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            if name in ['bootstrap', 'cache', 'reports', 'test']:
+                ignore.append(name)
+        elif not name.endswith('.yaml'):
+            ignore.append(name)
+    return ignore
+
+
+def _update_spack_config(filename, section, values):
+    # pyyaml comes with mache, and only spack builds need it
+    import yaml
+    data = None
+    if os.path.exists(filename):
+        with open(filename) as f:
+            data = yaml.safe_load(f)
+    if not isinstance(data, dict):
+        data = dict()
+    # "section::" means the section replaces those of lower scopes
+    key = f'{section}::' if f'{section}::' in data else section
+    if not isinstance(data.get(key), dict):
+        data[key] = dict()
+    data[key].update(values)
+    with open(filename, 'w') as f:
+        yaml.safe_dump(data, f, default_flow_style=False)
+
+
+def _get_heavy_packages(section, specs):
+    heavy_packages = section.get('memory_heavy_packages').replace(',', ' ')
+    heavy_packages = heavy_packages.split()
+    packages = [spec.split('@')[0].split('+')[0] for spec in specs]
+    return [package for package in packages if package in heavy_packages]
+
+
+def _get_available_memory_gb():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    pages = os.sysconf('SC_PHYS_PAGES')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    return pages * page_size / 1024**3
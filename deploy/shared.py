@@ -1,14 +1,22 @@
 import argparse
+import fcntl
+import getpass
+import glob
+import json
 import logging
 import os
 import platform
+import re
 import shutil
+import socket
 import subprocess
 import sys
-from urllib.request import Request, urlopen
+import threading
+import time
+from contextlib import contextmanager
 
 
-def parse_args(bootstrap):
+def parse_args(bootstrap, argv=None):
     parser = argparse.ArgumentParser(
         description='Deploy a compass conda environment')
     parser.add_argument("-m", "--machine", dest="machine",
@@ -35,6 +43,13 @@ def parse_args(bootstrap):
                              "for building E3SM components)")
     parser.add_argument("--recreate", dest="recreate", action='store_true',
                         help="Recreate the environment if it exists")
+    parser.add_argument("--reconcile", dest="reconcile", action='store_true',
+                        help="Update an existing conda environment by "
+                             "installing, updating or removing only the "
+                             "packages that differ from the spec, rather "
+                             "than solving for the full spec again (not "
+                             "for release environments, which are rebuilt "
+                             "as a new generation with --recreate)")
     parser.add_argument("-f", "--config_file", dest="config_file",
                         help="Config file to override deployment config "
                              "options")
@@ -51,6 +66,12 @@ def parse_args(bootstrap):
                         action='store_true',
                         help="If the shared spack environment should be "
                              "created or recreated.")
+    parser.add_argument("--spack_batch", dest="spack_batch",
+                        action='store_true',
+                        help="Build the spack environment for each compiler "
+                             "and MPI library as a separate batch job, using "
+                             "the [spack_batch] config options.  Only used "
+                             "with --update_spack.")
     parser.add_argument("--tmpdir", dest="tmpdir",
                         help="A temporary directory for building spack "
                              "packages")
@@ -71,16 +92,27 @@ def parse_args(bootstrap):
                         help="If this flag is included, OPENMP=false will "
                              "be added to the load script.  By default, MPAS "
                              "builds will be with OpenMP (OPENMP=true).")
+    parser.add_argument("--keep_going", dest="keep_going",
+                        action='store_true',
+                        help="If deploying one compiler and MPI library "
+                             "fails, go on to the others and report which "
+                             "failed at the end, rather than stopping.")
     parser.add_argument("--verbose", dest="verbose",
                         action='store_true',
                         help="Print all output to the terminal, rather than "
                              "log files (usually for debugging).")
+    parser.add_argument("--json_log", dest="json_log", action='store_true',
+                        help="Write log files as JSON lines, with the "
+                             "machine, compiler, MPI library, deployment "
+                             "step and process ID on each record.")
     if bootstrap:
         parser.add_argument("--local_conda_build", dest="local_conda_build",
                             type=str,
                             help="A path for conda packages (for testing).")
 
-    args = parser.parse_args(sys.argv[1:])
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
 
     if (args.mache_fork is None) != (args.mache_branch is None):
         raise ValueError('You must supply both or neither of '
@@ -123,6 +155,58 @@ def get_spack_base(spack_base, config):
     return spack_base
 
 
+def discover_machine_cached():
+    """
+    Discover the E3SM machine we're on with mache, caching the result for
+    this host so later deployments don't need to import mache to find it.
+    The cache is ``~/.cache/polaris/machines.json`` unless the
+    ``POLARIS_MACHINE_CACHE`` environment variable gives another file (or is
+    empty to not use a cache).  Only hosts on a known machine are cached.
+
+    Returns
+    -------
+    machine : str or None
+        The machine, or ``None`` if this isn't a known E3SM machine
+    """
+    cache_filename = os.environ.get('POLARIS_MACHINE_CACHE',
+                                    '~/.cache/polaris/machines.json')
+    cache_filename = os.path.expanduser(cache_filename)
+    host = socket.gethostname()
+    cache: dict = dict()
+    if cache_filename != '':
+        try:
+            with open(cache_filename) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if not isinstance(cache, dict):
+            cache = dict()
+        if isinstance(cache.get(host), str):
+            return cache[host]
+
+    # imported here because importing mache is slow compared with reading
+    # the cache
+    from mache import discover_machine
+    machine = discover_machine()
+    if machine is None or cache_filename == '':
+        return machine
+
+    cache[host] = machine
+    tmp_filename = f'{cache_filename}.{host}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_filename)),
+                    exist_ok=True)
+        with open(tmp_filename, 'w') as f:
+            json.dump(cache, f, indent=2)
+        # other deployments on the same file system may read the cache at
+        # the same time
+        os.replace(tmp_filename, cache_filename)
+    except OSError:
+        # the cache is just for speed
+        pass
+    return machine
+
+
 def check_call(commands, env=None, logger=None):
     command_list = commands.replace(' && ', '; ').split('; ')
     print_command = '\n   '.join(command_list)
@@ -134,26 +218,301 @@ def check_call(commands, env=None, logger=None):
     if logger is None:
         process = subprocess.Popen(commands, env=env, executable='/bin/bash',
                                    shell=True)
+        sampler = _start_sampler(process.pid)
         process.wait()
     else:
         process = subprocess.Popen(commands, stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE, env=env,
                                    executable='/bin/bash', shell=True)
+        sampler = _start_sampler(process.pid)
         stdout, stderr = process.communicate()
 
         if stdout:
             stdout_decoded = stdout.decode('utf-8')
             for line in stdout_decoded.split('\n'):
-                logger.info(line)
+                logger.info(line, extra=dict(pid=process.pid))
         if stderr:
             stderr_decoded = stderr.decode('utf-8')
             for line in stderr_decoded.split('\n'):
-                logger.error(line)
+                logger.error(line, extra=dict(pid=process.pid))
+
+    if sampler is not None:
+        _write_samples(sampler, commands, process.returncode, logger)
 
     if process.returncode != 0:
         raise subprocess.CalledProcessError(process.returncode, commands)
 
 
+def enable_resource_sampling(config, filename, new=False):
+    """
+    Sample the resources used by each command that ``check_call()`` runs
+    (and all of its child processes) through ``/proc``, and append a
+    summary of each command to a JSON-lines file
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options, including the ``[resource_sampling]``
+        section
+
+    filename : str
+        The JSON-lines file to append to
+
+    new : bool, optional
+        Whether to start a new file, removing results from earlier
+        deployments
+    """
+    if not config.has_section('resource_sampling') or \
+            not config.getboolean('resource_sampling', 'enabled') or \
+            not os.path.exists('/proc/self/stat'):
+        return
+    if new:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+    _resource_sampling.update(
+        filename=filename,
+        interval=config.getfloat('resource_sampling', 'interval'))
+
+
+class ResourceSampler:
+    """
+    Samples a process and all of its descendants through ``/proc`` in a
+    background thread, recording the peak resident memory, number of open
+    files and number of processes of the whole tree, and the CPU time and
+    bytes read and written by each process.  Processes working in a spack
+    build stage are also attributed to the package being built.
+    """
+
+    # spack stage directories are named spack-stage-<name>-<version>-<hash>
+    stage_pattern = re.compile(r'spack-stage-(.+)-[^-/]+-[a-z0-9]{32}')
+
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.start_time = time.time()
+        self.peak_rss = 0
+        self.peak_open_files = 0
+        self.peak_processes = 0
+        # the latest counters of each process seen, keyed by pid and start
+        # time in case a pid is reused
+        self._processes: dict = dict()
+        self._packages: dict = dict()
+        self._ticks = os.sysconf('SC_CLK_TCK')
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and return a summary of the resources used
+
+        Returns
+        -------
+        summary : dict
+            The wall time, total CPU time and average number of busy cores,
+            peak memory, bytes read and written (from storage and in total,
+            including pipes and the page cache), peak open files and
+            processes, and the same for each spack package that was built
+        """
+        self._stop.set()
+        self._thread.join()
+        wall_time = time.time() - self.start_time
+        summary = self._summarize(self._processes.values(), wall_time)
+        summary.update(peak_rss_gb=self.peak_rss / 1024**3,
+                       peak_open_files=self.peak_open_files,
+                       peak_processes=self.peak_processes)
+        packages = dict()
+        for name, package in self._packages.items():
+            processes = [self._processes[key] for key in package['keys']]
+            packages[name] = self._summarize(
+                processes, package['last'] - package['first'])
+            packages[name]['peak_rss_gb'] = package['peak_rss'] / 1024**3
+        summary['packages'] = packages
+        return summary
+
+    def _run(self):
+        while True:
+            self._sample()
+            if self._stop.wait(self.interval):
+                break
+
+    def _sample(self):
+        now = time.time()
+        stats = _read_process_stats()
+        children: dict = dict()
+        for pid, stat in stats.items():
+            children.setdefault(stat['ppid'], list()).append(pid)
+        tree = [self.pid]
+        index = 0
+        while index < len(tree):
+            tree.extend(children.get(tree[index], list()))
+            index += 1
+
+        rss = 0
+        open_files = 0
+        package_rss: dict = dict()
+        for pid in tree:
+            if pid not in stats:
+                continue
+            stat = stats[pid]
+            key = (pid, stat['start'])
+            process = self._processes.setdefault(
+                key, dict(cpu_time=0., read_bytes=0, write_bytes=0,
+                          read_chars=0, write_chars=0))
+            process['cpu_time'] = stat['cpu_ticks'] / self._ticks
+            process.update(_read_process_io(pid))
+            process_rss = stat['rss_pages'] * self._page_size
+            rss += process_rss
+            try:
+                open_files += len(os.listdir(f'/proc/{pid}/fd'))
+            except OSError:
+                pass
+
+            package = self._get_package(pid)
+            if package is not None:
+                entry = self._packages.setdefault(
+                    package, dict(keys=set(), first=now, last=now,
+                                  peak_rss=0))
+                entry['keys'].add(key)
+                entry['last'] = now
+                package_rss[package] = \
+                    package_rss.get(package, 0) + process_rss
+
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_open_files = max(self.peak_open_files, open_files)
+        self.peak_processes = max(self.peak_processes, len(tree))
+        for package, value in package_rss.items():
+            entry = self._packages[package]
+            entry['peak_rss'] = max(entry['peak_rss'], value)
+
+    def _get_package(self, pid):
+        try:
+            cwd = os.readlink(f'/proc/{pid}/cwd')
+        except OSError:
+            return None
+        match = ResourceSampler.stage_pattern.search(cwd)
+        if match is None:
+            return None
+        return match.group(1)
+
+    @staticmethod
+    def _summarize(processes, wall_time):
+        cpu_time = sum(process['cpu_time'] for process in processes)
+        summary = dict(wall_time=wall_time, cpu_time=cpu_time,
+                       busy_cores=cpu_time / wall_time if wall_time > 0.
+                       else None)
+        for key in ['read_bytes', 'write_bytes', 'read_chars',
+                    'write_chars']:
+            summary[key] = sum(process[key] for process in processes)
+        return summary
+
+
+# the settings from enable_resource_sampling()
+_resource_sampling: dict = dict(filename=None, interval=None)
+
+
+@contextmanager
+def preserve_process_state():
+    """
+    A context manager that restores the working directory, umask and
+    resource sampling settings of this process afterwards, since deployment
+    changes them and may be run from a long-lived process
+    """
+    cwd = os.getcwd()
+    umask = os.umask(0)
+    os.umask(umask)
+    sampling = dict(_resource_sampling)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+        os.umask(umask)
+        _resource_sampling.update(sampling)
+
+
+def _start_sampler(pid):
+    if _resource_sampling['filename'] is None:
+        return None
+    sampler = ResourceSampler(pid, _resource_sampling['interval'])
+    sampler.start()
+    return sampler
+
+
+def _write_samples(sampler, commands, returncode, logger):
+    summary = sampler.stop()
+    record = dict(time=sampler.start_time, command=commands,
+                  returncode=returncode)
+    if logger is not None:
+        for log_filter in logger.filters:
+            if isinstance(log_filter, DeployContextFilter):
+                record.update(log_filter.get_context())
+    record.update(summary)
+    line = f'{json.dumps(record)}\n'.encode('utf-8')
+    # each record is appended in a single write so records from concurrent
+    # deployment steps and batch jobs don't get mixed up
+    fd = os.open(_resource_sampling['filename'],
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+    busy_cores = summary['busy_cores']
+    busy_cores = 'unknown' if busy_cores is None else f'{busy_cores:.1f}'
+    log_message(logger,
+                f'Resources: {summary["wall_time"]:.1f} s, '
+                f'{summary["cpu_time"]:.1f} s of CPU time '
+                f'({busy_cores} busy cores), '
+                f'{summary["peak_rss_gb"]:.2f} GB peak memory, '
+                f'{summary["read_bytes"] / 1024**3:.2f} GB read and '
+                f'{summary["write_bytes"] / 1024**3:.2f} GB written, '
+                f'{summary["peak_open_files"]} peak open files')
+
+
+def _read_process_stats():
+    """
+    Read the parent, start time, CPU time and resident memory of every
+    process from ``/proc``
+    """
+    stats = dict()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                content = f.read()
+        except OSError:
+            # the process has finished
+            continue
+        # the command name is in parentheses and may contain spaces
+        fields = content[content.rfind(')') + 2:].split()
+        stats[int(entry)] = dict(ppid=int(fields[1]),
+                                 cpu_ticks=int(fields[11]) + int(fields[12]),
+                                 start=int(fields[19]),
+                                 rss_pages=int(fields[21]))
+    return stats
+
+
+def _read_process_io(pid):
+    keys = dict(read_bytes='read_bytes', write_bytes='write_bytes',
+                rchar='read_chars', wchar='write_chars')
+    counters = dict()
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                if name in keys:
+                    counters[keys[name]] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
 def install_mambaforge(conda_base, activate_base, logger):
     if not os.path.exists(conda_base):
         print('Installing Mambaforge')
@@ -166,6 +525,9 @@ def install_mambaforge(conda_base, activate_base, logger):
         mambaforge = f'Mambaforge-{system}-x86_64.sh'
         url = f'https://github.com/conda-forge/miniforge/releases/latest/download/{mambaforge}'  # noqa: E501
         print(url)
+        # imported here because urllib.request is slow to import and is
+        # only needed the first time
+        from urllib.request import Request, urlopen
         req = Request(url, headers={'User-Agent': 'Mozilla/5.0'})
         f = urlopen(req)
         html = f.read()
@@ -176,6 +538,11 @@ def install_mambaforge(conda_base, activate_base, logger):
         command = f'/bin/bash {mambaforge} -b -p {conda_base}'
         check_call(command, logger=logger)
         os.remove(mambaforge)
+        # so tools like deploy/disk_usage.py know that the environments in
+        # this base belong to polaris deployments
+        with open(get_deployed_marker(conda_base), 'w') as f:
+            f.write('This conda base was installed by a polaris '
+                    'deployment\n')
 
     backup_bashrc()
 
@@ -186,11 +553,50 @@ def install_mambaforge(conda_base, activate_base, logger):
                f'mamba update -y --all && ' \
                f'mamba init'
 
-    check_call(commands, logger=logger)
+    # no one else can be using the base environment while it's updated
+    with DeployLock(conda_base, 'base', 'updating the base environment',
+                    logger=logger):
+        check_call(commands, logger=logger)
 
     restore_bashrc()
 
 
+def get_deployed_marker(conda_base):
+    """
+    Get the file that marks a conda base as installed by a polaris
+    deployment
+    """
+    return os.path.join(conda_base, '.polaris_deployed')
+
+
+@contextmanager
+def conda_env_lock(conda_base, env_name, purpose, logger):
+    """
+    Lock a conda environment for building, updating or removing it, with
+    shared locks on the base environment and package cache it uses.
+    Environment locks are always taken before base locks, so deployments
+    can't deadlock.
+    """
+    with DeployLock(conda_base, f'env_{env_name}', purpose, logger=logger), \
+            DeployLock(conda_base, 'base', purpose, shared=True,
+                       logger=logger), \
+            DeployLock(conda_base, 'pkgs', purpose, shared=True,
+                       logger=logger):
+        yield
+
+
+@contextmanager
+def spack_env_lock(spack_base, env_name, purpose, logger):
+    """
+    Lock a spack environment for building or removing it, with a shared
+    lock on the spack base it is in
+    """
+    with DeployLock(spack_base, f'env_{env_name}', purpose, logger=logger), \
+            DeployLock(spack_base, 'base', purpose, shared=True,
+                       logger=logger):
+        yield
+
+
 def backup_bashrc():
     home_dir = os.path.expanduser('~')
     files = ['.bashrc', '.bash_profile']
@@ -211,28 +617,109 @@ def restore_bashrc():
             shutil.move(src, dst)
 
 
-def get_logger(name, log_filename):
+def get_logger(name, log_filename, json_lines=False, **context):
     print(f'Logging to: {log_filename}\n')
     try:
         os.remove(log_filename)
     except OSError:
         pass
     logger = logging.getLogger(name)
+    # loggers are global, so a logger set up by an earlier call (e.g. for
+    # an earlier deployment in the same process) is set up again from
+    # scratch
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    for log_filter in list(logger.filters):
+        if isinstance(log_filter, DeployContextFilter):
+            logger.removeFilter(log_filter)
     handler = logging.FileHandler(log_filename)
-    formatter = PolarisFormatter()
+    formatter: logging.Formatter
+    if json_lines:
+        formatter = PolarisJsonFormatter()
+    else:
+        formatter = PolarisFormatter()
     handler.setFormatter(formatter)
     logger.addHandler(handler)
+    logger.addFilter(DeployContextFilter(**context))
     logger.setLevel(logging.INFO)
     logger.propagate = False
     return logger
 
 
+def log_message(logger, message):
+    if logger is None:
+        print(message)
+    else:
+        logger.info(message)
+
+
+def set_log_context(logger, **context):
+    """
+    Update the context fields (machine, compiler, mpi, step) attached to
+    every record the current thread sends to the given logger
+
+    Parameters
+    ----------
+    logger : logging.Logger or None
+        The logger from ``get_logger()``.  Nothing is done if the logger is
+        ``None`` (i.e. output is going to the terminal)
+
+    **context
+        The context fields to update
+    """
+    if logger is None:
+        return
+    for log_filter in logger.filters:
+        if isinstance(log_filter, DeployContextFilter):
+            log_filter.set_context(**context)
+
+
+class DeployContextFilter(logging.Filter):
+    """
+    A filter that attaches deployment context to each log record.  The
+    context is stored per thread so that concurrent deployment steps can
+    share a single log sink and still be separated afterwards.
+    """
+
+    fields = ('machine', 'compiler', 'mpi', 'step')
+
+    def __init__(self, **context):
+        logging.Filter.__init__(self)
+        self._defaults = dict.fromkeys(DeployContextFilter.fields)
+        self._defaults.update(context)
+        self._local = threading.local()
+
+    def set_context(self, **context):
+        local_context = dict(getattr(self._local, 'context', {}))
+        local_context.update(context)
+        self._local.context = local_context
+
+    def get_context(self):
+        context = dict(self._defaults)
+        context.update(getattr(self._local, 'context', {}))
+        return context
+
+    def filter(self, record):
+        for key, value in self.get_context().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        if not hasattr(record, 'pid'):
+            # the subprocess pid is supplied with "extra" for subprocess
+            # output, otherwise this is our own process
+            record.pid = record.process
+        return True
+
+
 class PolarisFormatter(logging.Formatter):
     """
     A custom formatter for logging
     Modified from:
     https://stackoverflow.com/a/8349076/7728169
     https://stackoverflow.com/a/14859558/7728169
+
+    A formatter is created for each level up front so that ``format()``
+    does not modify the shared formatter when several threads log at once
     """
 
     # printing error messages without a prefix because they are sometimes
@@ -242,29 +729,235 @@ class PolarisFormatter(logging.Formatter):
     err_fmt = info_fmt
 
     def __init__(self, fmt=info_fmt):
-        self._fmt = None
         logging.Formatter.__init__(self, fmt)
+        self._level_formatters = {
+            logging.DEBUG: logging.Formatter(PolarisFormatter.dbg_fmt),
+            logging.INFO: logging.Formatter(PolarisFormatter.info_fmt),
+            logging.ERROR: logging.Formatter(PolarisFormatter.err_fmt)}
 
     def format(self, record):
+        formatter = self._level_formatters.get(record.levelno)
+        if formatter is None:
+            # fall back on the format configured by the user
+            return logging.Formatter.format(self, record)
+        return formatter.format(record)
 
-        # Save the original format configured by the user
-        # when the logger formatter was instantiated
-        format_orig = self._fmt
 
-        # Replace the original format with one customized by logging level
-        if record.levelno == logging.DEBUG:
-            self._fmt = PolarisFormatter.dbg_fmt
+class PolarisJsonFormatter(logging.Formatter):
+    """
+    A formatter that writes each record as a single line of JSON, including
+    the deployment context fields from ``DeployContextFilter``
+    """
 
-        elif record.levelno == logging.INFO:
-            self._fmt = PolarisFormatter.info_fmt
+    def format(self, record):
+        entry = dict(time=self.formatTime(record),
+                     level=record.levelname,
+                     message=record.getMessage())
+        for field in DeployContextFilter.fields + ('pid',):
+            entry[field] = getattr(record, field, None)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
 
-        elif record.levelno == logging.ERROR:
-            self._fmt = PolarisFormatter.err_fmt
 
-        # Call the original formatter class to do the grunt work
-        result = logging.Formatter.format(self, record)
+class DeployLock:
+    """
+    A file lock on a shared resource (e.g. a conda base, its package cache,
+    an environment or a spack branch) so that independent deployments into
+    the same shared directories can run at the same time.  Each lock opens
+    the lock file itself and locks it with ``flock()``, which also works on
+    NFS and most parallel file systems.  Since file locks don't always
+    exclude each other within a process (on NFS, ``flock()`` is emulated
+    with POSIX record locks, which belong to the whole process), locks in
+    the same process also exclude each other through a ``_ProcessLock``.
+
+    Deployments that only use a resource take a shared lock, and those that
+    change it (e.g. updating the base environment, ``conda clean`` or
+    updating permissions) take an exclusive lock.  While waiting, the user,
+    host and purpose of each holder are reported.
+    """
 
-        # Restore the original format configured by the user
-        self._fmt = format_orig
+    def __init__(self, directory, name, purpose, shared=False, logger=None,
+                 report_interval=60.):
+        """
+        Parameters
+        ----------
+        directory : str
+            The shared directory; lock files go in its ``.polaris_locks``
+            subdirectory
+
+        name : str
+            The name of the resource within the directory
+
+        purpose : str
+            What the lock is held for, reported to anyone waiting for it
+
+        shared : bool, optional
+            Whether to take a shared (rather than exclusive) lock
+
+        logger : logging.Logger, optional
+            A logger for messages about waiting for the lock
+
+        report_interval : float, optional
+            How often in seconds to report who holds the lock while waiting
+        """
+        self.lock_dir = os.path.join(directory, '.polaris_locks')
+        self.name = name
+        self.purpose = purpose
+        self.shared = shared
+        self.logger = logger
+        self.report_interval = report_interval
+        self._file = None
+        self._process_lock = _get_process_lock(
+            os.path.join(self.lock_dir, f'{name}.lock'))
+        self._holder_filename = os.path.join(
+            self.lock_dir, f'{name}.holders',
+            f'{socket.gethostname()}_{os.getpid()}_{id(self)}')
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        for directory in [self.lock_dir,
+                          os.path.dirname(self._holder_filename)]:
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+                try:
+                    # so others in the group can add locks and holders
+                    os.chmod(directory, 0o2775)
+                except OSError:
+                    pass
+        filename = os.path.join(self.lock_dir, f'{self.name}.lock')
+        self._file = open(filename, 'a+')
+        try:
+            # so others in the group can lock it too
+            os.chmod(filename, 0o664)
+        except OSError:
+            pass
+
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        start = time.time()
+        next_report = start
+        while True:
+            if self._process_lock.try_acquire(self.shared):
+                try:
+                    fcntl.flock(self._file, mode | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    self._process_lock.release(self.shared)
+            now = time.time()
+            if now >= next_report:
+                log_message(self.logger, self._get_wait_message(start))
+                next_report = now + self.report_interval
+            time.sleep(1.)
+
+        if time.time() - start > 1.:
+            log_message(self.logger, f'Acquired the {self.name} lock after '
+                                     f'{time.time() - start:.0f} s')
+        with open(self._holder_filename, 'w') as f:
+            json.dump(dict(user=getpass.getuser(), host=socket.gethostname(),
+                           pid=os.getpid(), purpose=self.purpose,
+                           shared=self.shared, since=time.time()), f)
+
+    def release(self):
+        if self._file is None:
+            return
+        try:
+            os.remove(self._holder_filename)
+        except OSError:
+            pass
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+        self._process_lock.release(self.shared)
+
+    def _get_wait_message(self, start):
+        kind = 'shared' if self.shared else 'exclusive'
+        message = f'Waiting for a {kind} lock on {self.name} in ' \
+                  f'{os.path.dirname(self.lock_dir)} (waited ' \
+                  f'{time.time() - start:.0f} s) for {self.purpose}.  ' \
+                  f'Held by:'
+        holders = list()
+        for filename in glob.glob(os.path.join(os.path.dirname(
+                self._holder_filename), '*')):
+            try:
+                with open(filename) as f:
+                    holder = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if _is_stale_holder(holder):
+                # left behind by a process that was killed
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                continue
+            holders.append(holder)
+        if len(holders) == 0:
+            message = f'{message}\n  unknown'
+        for holder in holders:
+            since = time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(holder['since']))
+            message = f'{message}\n  {holder["user"]} on {holder["host"]} ' \
+                      f'(pid {holder["pid"]}) for {holder["purpose"]} ' \
+                      f'since {since}'
+        return message
+
+
+class _ProcessLock:
+    """
+    Shared and exclusive locking of a lock file among the ``DeployLock``
+    objects (possibly in different threads) of this process
+    """
 
-        return result
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shared = 0
+        self._exclusive = False
+
+    def try_acquire(self, shared):
+        with self._lock:
+            if self._exclusive or (not shared and self._shared > 0):
+                return False
+            if shared:
+                self._shared += 1
+            else:
+                self._exclusive = True
+            return True
+
+    def release(self, shared):
+        with self._lock:
+            if shared:
+                self._shared -= 1
+            else:
+                self._exclusive = False
+
+
+_process_locks: dict = dict()
+_process_locks_lock = threading.Lock()
+
+
+def _get_process_lock(filename):
+    filename = os.path.abspath(filename)
+    with _process_locks_lock:
+        if filename not in _process_locks:
+            _process_locks[filename] = _ProcessLock()
+        return _process_locks[filename]
+
+
+def _is_stale_holder(holder):
+    # we can only tell whether processes on this host are still running
+    if holder.get('host') != socket.gethostname():
+        return False
+    try:
+        os.kill(holder['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, KeyError, TypeError):
+        # e.g. the process belongs to another user
+        return False
+    return False
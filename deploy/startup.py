@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ENTRY_POINTS = ['configure_polaris_envs.py', 'deploy/bootstrap.py']
+
+
+def time_startup(source_path, entry_point, python, runs=5):
+    """
+    Time how long an entry point takes to start up and exit with ``--help``,
+    which loads all the modules the entry point imports at startup but
+    doesn't deploy anything
+
+    Parameters
+    ----------
+    source_path : str
+        The polaris checkout with the entry point
+
+    entry_point : str
+        The entry point, relative to ``source_path``
+
+    python : str
+        The python executable to run the entry point with
+
+    runs : int, optional
+        The number of cold and of warm runs, the medians of which are
+        reported
+
+    Returns
+    -------
+    timings : dict
+        The median ``cold`` and ``warm`` times in seconds, and the
+        ``imports`` taking the most time in a warm run
+    """
+    cold = list()
+    warm = list()
+    imports: dict = dict()
+    for _ in range(runs):
+        # a fresh copy of the deployment scripts has no bytecode yet, like
+        # the first deployment after a checkout or an update
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _copy_scripts(source_path, tmpdir)
+            cold.append(_run(python, tmpdir, entry_point))
+            warm.append(_run(python, tmpdir, entry_point))
+            if len(imports) == 0:
+                imports = _get_slowest_imports(python, tmpdir, entry_point)
+
+    return dict(cold=statistics.median(cold), warm=statistics.median(warm),
+                imports=imports)
+
+
+def print_table(results, baseline=None):
+    """
+    Print the cold and warm startup times of each entry point, with the
+    change from a baseline if one is given
+    """
+    width = max([len('entry point')] + [len(name) for name in results])
+    print(f'{"entry point":<{width}}  {"cold":>14}  {"warm":>14}')
+    print('(times in ms; change from baseline in parentheses)'
+          if baseline is not None else '(times in ms)')
+    for name, timings in results.items():
+        row = f'{name:<{width}}'
+        previous = None
+        if baseline is not None:
+            previous = baseline.get(name)
+        for key in ['cold', 'warm']:
+            value = f'{1e3 * timings[key]:.0f}'
+            if previous is not None and key in previous:
+                change = 1e3 * (timings[key] - previous[key])
+                value = f'{value} ({change:+.0f})'
+            row = f'{row}  {value:>14}'
+        print(row)
+
+    for name, timings in results.items():
+        print(f'\nslowest imports in a warm start of {name} (ms):')
+        for module, seconds in timings['imports'].items():
+            print(f'  {1e3 * seconds:8.1f}  {module}')
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Find the startup times that are more than ``tolerance`` (a fraction)
+    slower than in the baseline
+    """
+    regressions = list()
+    for name, timings in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for key in ['cold', 'warm']:
+            if key in previous and \
+                    timings[key] > (1. + tolerance) * previous[key]:
+                regressions.append(
+                    f'{name} ({key}): {1e3 * timings[key]:.0f} ms vs. '
+                    f'{1e3 * previous[key]:.0f} ms in the baseline')
+    return regressions
+
+
+def _copy_scripts(source_path, tmpdir):
+    shutil.copytree(os.path.join(source_path, 'deploy'),
+                    os.path.join(tmpdir, 'deploy'),
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    for entry_point in ENTRY_POINTS:
+        if not entry_point.startswith('deploy/'):
+            shutil.copy(os.path.join(source_path, entry_point), tmpdir)
+
+
+def _run(python, cwd, entry_point):
+    start = time.perf_counter()
+    subprocess.run([python, entry_point, '--help'], cwd=cwd, check=True,
+                   env=_get_env(), stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def _get_env():
+    env = dict(os.environ)
+    # warm starts need the bytecode written by earlier runs
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def _get_slowest_imports(python, cwd, entry_point, count=5):
+    process = subprocess.run(
+        [python, '-X', 'importtime', entry_point, '--help'], cwd=cwd,
+        check=True, env=_get_env(), stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    imports = dict()
+    for line in process.stderr.decode('utf-8', errors='replace').split('\n'):
+        # e.g. "import time:       925 |      17192 | artifacts", where
+        # nested imports are indented
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[0].startswith('import time:'):
+            continue
+        name = parts[2].rstrip()
+        if not parts[1].strip().isdigit() or name.startswith('  '):
+            continue
+        imports[name.strip()] = 1e-6 * int(parts[1])
+    slowest = sorted(imports.items(), key=lambda item: -item[1])[:count]
+    return dict(slowest)
+
+
+def main():
+    here = os.path.abspath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(
+        description='Time how long the deployment entry points take to '
+                    'start up, with and without bytecode already compiled, '
+                    'to catch startup regressions')
+    parser.add_argument('--source', dest='source_path',
+                        default=os.path.dirname(here),
+                        help='The polaris checkout to time')
+    parser.add_argument('-p', '--python', dest='python',
+                        default=sys.executable,
+                        help='The python (e.g. from the bootstrap '
+                             'environment) to run the entry points with')
+    parser.add_argument('-n', '--runs', dest='runs', type=int, default=5,
+                        help='The number of cold and warm starts of each '
+                             'entry point')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='A JSON file to save the timings to')
+    parser.add_argument('--baseline', dest='baseline',
+                        help='A JSON file of earlier timings to compare with')
+    parser.add_argument('--tolerance', dest='tolerance', type=float,
+                        default=0.2,
+                        help='How much slower (as a fraction) than the '
+                             'baseline a startup time can be before it is '
+                             'reported as a regression')
+    args = parser.parse_args()
+
+    results = dict()
+    for entry_point in ENTRY_POINTS:
+        print(f'Timing {entry_point}')
+        results[entry_point] = time_startup(args.source_path, entry_point,
+                                            args.python, args.runs)
+    print('')
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print('\nStartup regressions:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
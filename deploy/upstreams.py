@@ -0,0 +1,179 @@
+import glob
+import os
+import re
+import subprocess
+
+from shared import log_message
+
+TREE_PREFIX = 'spack_for_mache_'
+
+
+def get_install_tree(spack_branch_base):
+    """
+    Get the install tree of a spack tree
+    """
+    return os.path.join(spack_branch_base, 'opt', 'spack')
+
+
+def get_upstreams(config, spack_base, spack_branch_base, logger):
+    """
+    Get the install trees a spack tree uses as upstreams.  Once chosen,
+    they stay the same because packages already installed in the tree may
+    depend on packages in them.
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Deployment config options
+
+    spack_base : str
+        The directory with a spack tree for each version of mache
+
+    spack_branch_base : str
+        The spack tree being built
+
+    logger : logging.Logger
+        A logger for output from the deployment
+
+    Returns
+    -------
+    upstreams : dict
+        The install trees to use as upstreams, with the names of their
+        spack trees as keys
+    """
+    if not config.getboolean('spack_build', 'use_upstreams'):
+        return dict()
+    upstreams = read_upstreams(spack_branch_base)
+    if len(upstreams) == 0:
+        upstreams = find_upstreams(spack_base, spack_branch_base)
+    for name, install_tree in upstreams.items():
+        log_message(logger, f'Using {install_tree} from {name} as a spack '
+                            f'upstream')
+    return upstreams
+
+
+def find_upstreams(spack_base, spack_branch_base):
+    """
+    Find the install trees that a new spack tree can use as upstreams: that
+    of the spack tree for the newest earlier version of mache, along with
+    that tree's own upstreams (spack doesn't follow chains of upstreams)
+
+    Parameters
+    ----------
+    spack_base : str
+        The directory with a spack tree for each version of mache
+
+    spack_branch_base : str
+        The spack tree being built
+
+    Returns
+    -------
+    upstreams : dict
+        The install trees to use as upstreams, with the names of their
+        spack trees as keys
+    """
+    name = os.path.basename(spack_branch_base)
+    version = _parse_version(name[len(TREE_PREFIX):])
+    candidates = list()
+    for path in glob.glob(os.path.join(spack_base, f'{TREE_PREFIX}*')):
+        candidate = os.path.basename(path)
+        candidate_version = _parse_version(candidate[len(TREE_PREFIX):])
+        install_tree = get_install_tree(path)
+        if candidate_version < version and \
+                os.path.exists(os.path.join(install_tree, '.spack-db')):
+            candidates.append((candidate_version, candidate, path))
+    if len(candidates) == 0:
+        return dict()
+
+    _, candidate, path = max(candidates)
+    upstreams = {candidate: get_install_tree(path)}
+    for upstream, install_tree in read_upstreams(path).items():
+        if os.path.exists(install_tree):
+            upstreams.setdefault(upstream, install_tree)
+    return upstreams
+
+
+def read_upstreams(spack_branch_base):
+    """
+    Read the upstreams written by ``write_upstreams()`` for a spack tree
+    """
+    filename = _get_upstreams_filename(spack_branch_base)
+    if not os.path.exists(filename):
+        return dict()
+    with open(filename) as f:
+        content = f.read()
+    return dict(re.findall(r'^  (\S+):\n    install_tree: (\S+)$', content,
+                           flags=re.MULTILINE))
+
+
+def write_upstreams(filename, upstreams):
+    """
+    Write a spack ``upstreams.yaml`` config file
+    """
+    lines = ['upstreams:']
+    for name, install_tree in upstreams.items():
+        lines.extend([f'  {name}:', f'    install_tree: {install_tree}'])
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def save_upstreams(spack_branch_base, upstreams):
+    """
+    Save the upstreams in the site config of a spack tree, so they are
+    also used when its environments are activated
+    """
+    filename = _get_upstreams_filename(spack_branch_base)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    write_upstreams(filename, upstreams)
+
+
+def report_upstream_specs(spack_branch_base, spack_env, upstreams, logger):
+    """
+    Report the specs in a spack environment that were reused from upstream
+    install trees rather than built
+    """
+    commands = f'source {spack_branch_base}/share/spack/setup-env.sh && ' \
+               f'spack -e {spack_env} find --format "{{name}}@{{version}} ' \
+               f'{{prefix}}"'
+    process = subprocess.run(commands, shell=True, executable='/bin/bash',
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+    reused: dict = dict()
+    built: list = list()
+    for line in process.stdout.decode('utf-8').split('\n'):
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        spec, prefix = parts
+        for name, install_tree in upstreams.items():
+            if prefix.startswith(f'{install_tree}/'):
+                reused.setdefault(name, list()).append(spec)
+                break
+        else:
+            built.append(spec)
+
+    for name, specs in reused.items():
+        log_message(logger, f'Reused {len(specs)} specs from {name}: '
+                            f'{", ".join(sorted(specs))}')
+    log_message(logger, f'{len(built)} specs are installed in '
+                        f'{os.path.basename(spack_branch_base)} itself')
+
+
+def _get_upstreams_filename(spack_branch_base):
+    return os.path.join(spack_branch_base, 'etc', 'spack', 'upstreams.yaml')
+
+
+def _parse_version(version):
+    # e.g. 1.16.0 or 1.17.0rc1, where the release candidate comes before the
+    # release
+    parts = list()
+    for part in version.split('.'):
+        match = re.match(r'^(\d+)(\D*)(\d*)$', part)
+        if match is None:
+            parts.append((0, part, 0))
+            continue
+        number, tag, tag_number = match.groups()
+        # a release (no tag) sorts after its pre-releases
+        parts.append((int(number), tag if tag else '~',
+                      int(tag_number) if tag_number else 0))
+    return tuple(parts)
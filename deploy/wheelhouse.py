@@ -0,0 +1,162 @@
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+
+from shared import check_call, log_message
+
+# the files that determine how polaris is installed in edit mode
+POLARIS_METADATA = ['setup.py', 'setup.cfg', 'pyproject.toml']
+
+
+def get_polaris_hash(source_path):
+    """
+    Get a hash of the polaris source that determines its installation in
+    edit mode: the location of the source and its packaging metadata.
+    Changes to the python modules themselves don't require reinstalling.
+    """
+    sha256 = hashlib.sha256(source_path.encode('utf-8'))
+    for filename in POLARIS_METADATA:
+        path = os.path.join(source_path, filename)
+        if os.path.exists(path):
+            sha256.update(filename.encode('utf-8'))
+            with open(path, 'rb') as f:
+                sha256.update(f.read())
+    return sha256.hexdigest()
+
+
+def get_file_hash(filename):
+    """
+    Get the SHA-256 hash of a file, such as a wheel
+    """
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_wheelhouse_dir(source_path, name, source_hash):
+    """
+    Get the directory in the wheelhouse for a package with a given hash
+    """
+    return os.path.join(source_path, 'deploy_tmp', 'wheelhouse', name,
+                        source_hash[:16])
+
+
+def install_polaris(activate_env, env_path, source_path, logger):
+    """
+    Install polaris in edit mode in a conda environment, skipping the
+    install if the environment already has polaris installed from the same
+    source.  The editable wheel is built once per source hash into the
+    wheelhouse and installed from there in each environment.
+
+    Parameters
+    ----------
+    activate_env : str
+        Commands to activate the conda environment
+
+    env_path : str
+        The path to the conda environment
+
+    source_path : str
+        The polaris source to install
+
+    logger : logging.Logger
+        A logger for output from the deployment
+    """
+    source_hash = get_polaris_hash(source_path)
+    if _get_installed_hash(env_path, 'polaris') == source_hash:
+        log_message(logger, f'polaris is already installed from '
+                            f'{source_path} in {env_path}')
+        return
+
+    wheel_dir = get_wheelhouse_dir(source_path, 'polaris', source_hash)
+    wheels = glob.glob(os.path.join(wheel_dir, '*.whl'))
+    if len(wheels) == 0:
+        wheels = _build_editable_wheel(activate_env, source_path, wheel_dir,
+                                       logger)
+
+    if len(wheels) == 0:
+        # the build backend doesn't support editable wheels
+        commands = f'{activate_env} && ' \
+                   f'cd {source_path} && ' \
+                   f'python -m pip install --no-deps -e .'
+    else:
+        commands = f'{activate_env} && ' \
+                   f'python -m pip install --no-deps --force-reinstall ' \
+                   f'{wheels[0]}'
+    check_call(commands, logger=logger)
+    _set_installed_hash(env_path, 'polaris', source_hash)
+
+
+def install_wheel(activate_env, env_path, name, wheel, logger):
+    """
+    Install a wheel (with its dependencies) in a conda environment, skipping
+    the install if the same wheel is already installed
+
+    Parameters
+    ----------
+    activate_env : str
+        Commands to activate the conda environment
+
+    env_path : str
+        The path to the conda environment
+
+    name : str
+        The name of the package
+
+    wheel : str
+        The wheel to install
+
+    logger : logging.Logger
+        A logger for output from the deployment
+    """
+    wheel_hash = get_file_hash(wheel)
+    if _get_installed_hash(env_path, name) == wheel_hash:
+        log_message(logger, f'{os.path.basename(wheel)} is already installed '
+                            f'in {env_path}')
+        return
+    commands = f'{activate_env} && ' \
+               f'python -m pip install --force-reinstall {wheel}'
+    check_call(commands, logger=logger)
+    _set_installed_hash(env_path, name, wheel_hash)
+
+
+def _build_editable_wheel(activate_env, source_path, wheel_dir, logger):
+    tmp_dir = f'{wheel_dir}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    commands = f'{activate_env} && ' \
+               f'cd {source_path} && ' \
+               f'python -c "import setuptools.build_meta as backend; ' \
+               f'backend.build_editable(\'{tmp_dir}\')"'
+    try:
+        check_call(commands, logger=logger)
+    except subprocess.CalledProcessError:
+        log_message(logger, 'Could not build an editable wheel for polaris')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return list()
+    shutil.rmtree(wheel_dir, ignore_errors=True)
+    os.rename(tmp_dir, wheel_dir)
+    return glob.glob(os.path.join(wheel_dir, '*.whl'))
+
+
+def _get_installed_hash(env_path, name):
+    filename = _get_hash_filename(env_path, name)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return f.read().strip()
+
+
+def _set_installed_hash(env_path, name, source_hash):
+    with open(_get_hash_filename(env_path, name), 'w') as f:
+        f.write(f'{source_hash}\n')
+
+
+def _get_hash_filename(env_path, name):
+    # conda only reads the *.json files in conda-meta, and recreating the
+    # environment removes this file
+    return os.path.join(env_path, 'conda-meta', f'polaris_{name}_hash.txt')
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Build the documentation for each tagged version and whitelisted branch in
+parallel, caching each version's HTML and doctrees by its commit hash so
+that only new or changed versions are rebuilt.  This is an incremental
+alternative to ``sphinx-multiversion`` that uses the same whitelists from
+``conf.py``.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from jinja2 import Template
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, here)
+
+from conf import (  # noqa: E402
+    smv_branch_whitelist,
+    smv_remote_whitelist,
+    smv_tag_whitelist,
+)
+
+
+def get_versions():
+    """
+    Get the name, commit hash and type (tag or branch) of each version to
+    build
+    """
+    output = subprocess.check_output(
+        ['git', 'for-each-ref', '--format=%(objectname) %(refname)',
+         'refs/heads', 'refs/remotes', 'refs/tags'],
+        cwd=here).decode('utf-8')
+
+    versions = dict()
+    for line in output.strip().split('\n'):
+        if line == '':
+            continue
+        _, refname = line.split()
+        parts = refname.split('/')
+        if parts[1] == 'tags':
+            name = '/'.join(parts[2:])
+            kind = 'tags'
+            if not re.match(smv_tag_whitelist, name):
+                continue
+        elif parts[1] == 'heads':
+            name = '/'.join(parts[2:])
+            kind = 'branches'
+            if not re.match(smv_branch_whitelist, name):
+                continue
+        else:
+            remote = parts[2]
+            name = '/'.join(parts[3:])
+            kind = 'branches'
+            if not re.match(smv_remote_whitelist, remote) or \
+                    not re.match(smv_branch_whitelist, name):
+                continue
+        if name in versions:
+            # prefer local branches over remote ones with the same name
+            continue
+        # dereference annotated tags to their commits
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', f'{refname}^{{commit}}'],
+            cwd=here).decode('utf-8').strip()
+        versions[name] = dict(name=name, commit=commit, kind=kind)
+
+    return list(versions.values())
+
+
+def update_worktree(version, cache_dir):
+    """
+    Create or update a git worktree for the version in the cache.  Only the
+    files that changed since the cached commit are touched, so sphinx can
+    rebuild incrementally from the cached doctrees.
+    """
+    src = os.path.join(cache_dir, version['name'], 'src')
+    if os.path.exists(src):
+        subprocess.check_call(
+            ['git', 'checkout', '--quiet', '--force', '--detach',
+             version['commit']], cwd=src)
+    else:
+        subprocess.check_call(
+            ['git', 'worktree', 'add', '--force', '--detach', src,
+             version['commit']], cwd=here)
+
+
+def build_version(version, cache_dir):
+    """
+    Build the HTML for one version into the cache
+    """
+    version_dir = os.path.join(cache_dir, version['name'])
+    src = os.path.join(version_dir, 'src')
+    log_filename = os.path.join(version_dir, 'build.log')
+    env = dict(os.environ)
+    env['DOCS_VERSION'] = version['name']
+    # make sure the docs import this version of polaris
+    env['PYTHONPATH'] = os.pathsep.join(
+        [src] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+    # always use the current templates so the version list can be updated
+    # in cached pages
+    templates = os.path.join(here, '_templates')
+    args = [sys.executable, '-m', 'sphinx', '-b', 'html', '-q',
+            '-D', f'templates_path={templates}',
+            '-d', os.path.join(version_dir, 'doctrees'),
+            os.path.join(src, 'docs'), os.path.join(version_dir, 'html')]
+    with open(log_filename, 'w') as log_file:
+        returncode = subprocess.call(args, env=env, stdout=log_file,
+                                     stderr=subprocess.STDOUT)
+    if returncode == 0:
+        with open(os.path.join(version_dir, 'commit.json'), 'w') as f:
+            json.dump(version, f)
+    return returncode, log_filename
+
+
+def render_versions(template, current, versions, html_dir, page):
+    """
+    Render the version list for a page with links relative to that page
+    """
+    page_dir = os.path.dirname(page)
+    links = dict(tags=list(), branches=list())
+    for version in versions:
+        url = os.path.relpath(
+            os.path.join(html_dir, version['name'], 'index.html'), page_dir)
+        links[version['kind']].append(dict(name=version['name'], url=url))
+    # newest tags first
+    links['tags'].sort(key=lambda link: [
+        int(part) for part in re.findall(r'\d+', link['name'])],
+        reverse=True)
+    return template.render(current_version=dict(name=current['name']),
+                           versions=links)
+
+
+def assemble(versions, cache_dir, html_dir):
+    """
+    Copy each version from the cache and regenerate the version list in
+    every page
+    """
+    with open(os.path.join(here, '_templates', 'versions.html')) as f:
+        template = Template(f.read())
+
+    pattern = re.compile(r'<!-- versions -->.*?<!-- /versions -->',
+                         flags=re.DOTALL)
+    for version in versions:
+        dest = os.path.join(html_dir, version['name'])
+        shutil.rmtree(dest, ignore_errors=True)
+        shutil.copytree(
+            os.path.join(cache_dir, version['name'], 'html'), dest,
+            ignore=shutil.ignore_patterns('.buildinfo', '.doctrees'))
+        for root, _, files in os.walk(dest):
+            for filename in files:
+                if not filename.endswith('.html'):
+                    continue
+                page = os.path.join(root, filename)
+                with open(page) as f:
+                    content = f.read()
+                if '<!-- versions -->' not in content:
+                    continue
+                rendered = render_versions(template, version, versions,
+                                           html_dir, page)
+                content = pattern.sub(lambda _: rendered, content)
+                with open(page, 'w') as f:
+                    f.write(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the documentation for all versions in parallel, '
+                    'reusing cached versions')
+    parser.add_argument('-o', '--output', dest='output',
+                        default=os.path.join(here, '_build', 'html'),
+                        help='The output directory for the HTML')
+    parser.add_argument('--cache', dest='cache',
+                        default=os.path.join(here, '_build', 'versions'),
+                        help='The cache directory for versions')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                        default=os.cpu_count(),
+                        help='The number of versions to build at once')
+    args = parser.parse_args()
+
+    cache_dir = os.path.abspath(args.cache)
+    html_dir = os.path.abspath(args.output)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.makedirs(html_dir, exist_ok=True)
+    subprocess.check_call(['git', 'worktree', 'prune'], cwd=here)
+
+    versions = get_versions()
+    stale = list()
+    for version in versions:
+        filename = os.path.join(cache_dir, version['name'], 'commit.json')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                if json.load(f)['commit'] == version['commit']:
+                    print(f'{version["name"]}: up to date')
+                    continue
+        stale.append(version)
+
+    # git doesn't like concurrent worktree updates, so these are serial
+    for version in stale:
+        print(f'{version["name"]}: building {version["commit"][:12]}')
+        update_worktree(version, cache_dir)
+
+    failed = list()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(lambda v: build_version(v, cache_dir), stale)
+        for version, (returncode, log_filename) in zip(stale, results):
+            if returncode != 0:
+                print(f'{version["name"]}: failed, see {log_filename}')
+                failed.append(version)
+
+    versions = [version for version in versions if version not in failed]
+    assemble(versions, cache_dir, html_dir)
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()